@@ -2,3 +2,25 @@ top_customers_cache_key_duration = 100 * 60  # 60 часов
 top_customers_cache_key_prefix = 'top_customers_cache_key_prefix'
 
 top_customers_limit = 5
+
+# параметр запроса, включающий поэтапный импорт с контрольными точками
+deals_upload_chunk_size_param = 'chunk_size'
+
+# параметр запроса, задающий режим загрузки
+deals_upload_mode_param = 'mode'
+deals_upload_mode_append = 'append'
+deals_upload_mode_replace = 'replace'
+
+# параметр запроса, при котором файл только проверяется, без записи в базу
+deals_upload_dry_run_param = 'dry_run'
+
+gem_stats_cache_key_duration = top_customers_cache_key_duration
+gem_stats_cache_key_prefix = 'gem_stats_cache_key_prefix'
+
+gem_stats_limit = 10
+
+# параметр запроса, задающий сортировку статистики камней;
+# минус перед полем - сортировка по убыванию
+gem_stats_ordering_param = 'ordering'
+gem_stats_ordering_fields = ('revenue', 'quantity', 'deals_count', 'customers_count', 'name')
+gem_stats_ordering_default = '-revenue'
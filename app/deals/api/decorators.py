@@ -0,0 +1,60 @@
+import calendar
+from functools import wraps
+
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+
+def condition(etag_func, last_modified_func):
+    """
+    Аналог django.views.decorators.http.condition для представлений
+    за кешем страниц.
+
+    Отличие в том, что ETag и Last-Modified всегда выставляются заново:
+    ответ из кеша страниц хранит заголовки с момента кеширования,
+    а они должны соответствовать текущему поколению данных.
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def inner(request, *args, **kwargs):
+            etag = quote_etag(etag_func(request, *args, **kwargs))
+            last_modified = last_modified_func(request, *args, **kwargs)
+            timestamp = (
+                calendar.timegm(last_modified.utctimetuple())
+                if last_modified else None
+            )
+
+            response = get_conditional_response(
+                request, etag=etag, last_modified=timestamp
+            )
+            if response is None:
+                response = view_func(request, *args, **kwargs)
+
+            if request.method in ('GET', 'HEAD') and response.status_code in (200, 304):
+                response.headers['ETag'] = etag
+                if timestamp is not None:
+                    response.headers['Last-Modified'] = http_date(timestamp)
+            return response
+        return inner
+    return decorator
+
+
+def cache_status(view_func):
+    """
+    Заголовок X-Cache для представлений за кешем страниц: MISS, если
+    представление выполнилось (и отметило запрос через mark_cache_miss),
+    HIT, если ответ взят из кеша. Декоратор оборачивает кеш страниц
+    снаружи, поэтому заголовок не попадает в закешированный ответ.
+    """
+    @wraps(view_func)
+    def inner(request, *args, **kwargs):
+        response = view_func(request, *args, **kwargs)
+        if response.status_code == 200:
+            response.headers['X-Cache'] = 'MISS' if getattr(request, '_cache_miss', False) else 'HIT'
+        return response
+    return inner
+
+
+def mark_cache_miss(request) -> None:
+    """Отмечает, что ответ на запрос строится заново, а не берется из кеша."""
+    request._cache_miss = True
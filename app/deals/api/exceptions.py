@@ -0,0 +1,35 @@
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+
+class UploadQueueFull(APIException):
+    """
+    Все слоты загрузки заняты.
+    Клиенту возвращается 429 с заголовком Retry-After.
+    """
+    status_code = status.HTTP_429_TOO_MANY_REQUESTS
+
+    def __init__(self, wait: int):
+        super().__init__({
+            'detail': 'Сервер обрабатывает другие загрузки, повторите запрос позже.',
+            'code': 'upload_queue_full',
+        })
+        # используется обработчиком исключений DRF для заголовка Retry-After
+        self.wait = wait
+
+
+class FileCorruptData(APIException):
+    """
+    Ошибки в данных загруженных файлов.
+    Отчет об ошибках отдается как есть: номера строк остаются числами.
+    """
+    status_code = status.HTTP_400_BAD_REQUEST
+
+    def __init__(self, detail: str, errors: list, errors_count: int):
+        super().__init__()
+        self.detail = {
+            'detail': detail,
+            'code': 'file_corrupt_data',
+            'errors': errors,
+            'errors_count': errors_count,
+        }
@@ -0,0 +1,114 @@
+"""
+Выборочная инвалидация кеша страниц топа покупателей.
+
+Вместе с каждой страницей топа кешируется рейтинг, по которому она
+построена: id покупателей и сумма последнего из них (порог входа).
+Рейтинг хранится в самом закешированном ответе, поэтому страница
+и ее рейтинг истекают и вытесняются из кеша только вместе.
+После загрузки сделок кеш сбрасывается, только если загрузка может
+изменить хотя бы одну закешированную страницу:
+- затронуты сделки покупателя из ее рейтинга (меняется его сумма,
+  место или список камней);
+- сумма покупателя вне рейтинга достигла порога (он может войти в топ).
+
+Если рейтинг какой-то страницы неизвестен, кеш сбрасывается целиком,
+как и раньше.
+"""
+from typing import Dict, List, Optional
+
+from django.core.cache import cache
+from django.db import DatabaseError
+from django.db.models import Sum
+from django.http import HttpResponse
+
+from app.deals import generation, ingest
+from app.deals.api import const, payloads
+from app.deals.models import Deal
+
+# атрибут ответа с рейтингом, по которому построена страница
+_ranking_attr = 'deals_ranking'
+
+
+def _cached_pages() -> List[HttpResponse]:
+    """Закешированные страницы топа (cache_page хранит ответы целиком)."""
+    pattern = f'*cache_page.{const.top_customers_cache_key_prefix}.*'
+    return list(cache.get_many(cache.keys(pattern)).values())
+
+
+def remember_ranking(response: HttpResponse, limit: int, top: List[payloads.RankingRow]) -> None:
+    """
+    Запоминает в ответе рейтинг, по которому построена страница топа
+    с лимитом limit: ответ попадет в кеш страниц вместе с ним.
+    """
+    setattr(response, _ranking_attr, {
+        'limit': limit,
+        'ids': [customer_id for customer_id, _, _ in top],
+        # неполный рейтинг включает всех покупателей: порога нет
+        'cutoff': top[-1][2] if top and len(top) == limit else None,
+    })
+
+
+def ranking_may_change(spend_deltas: Optional[Dict[int, int]]) -> bool:
+    """
+    Может ли загрузка с переданными изменениями сумм по покупателям
+    изменить закешированные страницы топа. None означает, что
+    изменения неизвестны (например, при полной замене сделок).
+    Вызывается после коммита загрузки.
+    """
+    if spend_deltas is None:
+        return True
+    if not spend_deltas:
+        return False
+
+    pages = _cached_pages()
+    if not pages:
+        # сбрасывать нечего, сброс ничего не стоит
+        return True
+    rankings = [getattr(page, _ranking_attr, None) for page in pages]
+    if None in rankings:
+        return True
+
+    for ranking in rankings:
+        cutoff = ranking['cutoff']
+        # при пороге не выше нуля место в хвосте рейтинга
+        # может занять даже покупатель без покупок
+        if cutoff is None or cutoff <= 0:
+            return True
+        if not spend_deltas.keys().isdisjoint(ranking['ids']):
+            return True
+
+    # покупатель вне рейтинга был ниже порога (или равен ему при большем id),
+    # поэтому войти в рейтинг может, только если его сумма выросла;
+    # достаточно сравнить суммы с наименьшим из порогов
+    cutoff = min(ranking['cutoff'] for ranking in rankings)
+    grown = [customer_id for customer_id, delta in spend_deltas.items() if delta > 0]
+    for chunk in ingest.chunks(grown):
+        reached_cutoff = (
+            Deal.objects.filter(customer_id__in=chunk)
+            .values('customer_id')
+            .annotate(spent=Sum('total_cost_cents'))
+            .filter(spent__gte=cutoff)
+        )
+        if reached_cutoff.exists():
+            return True
+    return False
+
+
+def invalidate_top_customers(spend_deltas: Optional[Dict[int, int]]) -> bool:
+    """
+    Сбрасывает кеш страниц топа и меняет поколение данных,
+    если загрузка могла изменить ответ. Возвращает, был ли сброшен кеш.
+    """
+    try:
+        may_change = ranking_may_change(spend_deltas)
+    except DatabaseError:
+        # проверить не удалось: надежнее сбросить кеш целиком
+        may_change = True
+    if not may_change:
+        return False
+
+    cache.delete_many(
+        keys=cache.keys(f'*{const.top_customers_cache_key_prefix}*')
+    )
+    generation.bump(generation.deals)
+    return True
@@ -24,3 +24,8 @@ class SimpleLimitPagination(LimitOffsetPagination):
 
     def get_paginated_response(self, data):
         return Response({'response': data})
+
+
+class GemStatsPagination(SimpleLimitPagination):
+    """Пагинатор статистики камней: свой лимит по умолчанию."""
+    default_limit = const.gem_stats_limit
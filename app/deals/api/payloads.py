@@ -0,0 +1,59 @@
+"""
+Быстрое построение ответов API из простых кортежей,
+без полей сериализаторов DRF и объектов моделей.
+"""
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+from django.db.models import Count, QuerySet
+
+from app.deals import money
+from app.deals.models import Deal
+
+
+# строка рейтинга: id покупателя, имя, потраченная сумма в копейках
+RankingRow = Tuple[int, str, int]
+
+
+def ranking(queryset: QuerySet, limit: int) -> List[RankingRow]:
+    """Первые limit строк рейтинга покупателей по потраченной сумме."""
+    return list(queryset.values_list('id', 'username', 'spent_money')[:limit])
+
+
+def shared_gems(customer_ids: List[int]) -> Dict[int, List[str]]:
+    """
+    Камни, которые есть как минимум у двух покупателей из списка,
+    по id покупателей (в порядке id камней).
+    """
+    shared = (
+        Deal.objects.filter(customer_id__in=customer_ids)
+        .values('item_id')
+        .annotate(cnt=Count('customer_id', distinct=True))
+        .filter(cnt__gte=2)
+        .values('item_id')
+    )
+    gems = defaultdict(list)
+    pairs = (
+        Deal.objects.filter(customer_id__in=customer_ids, item_id__in=shared)
+        .values_list('customer_id', 'item_id', 'item__name')
+        .distinct()
+        .order_by('customer_id', 'item_id')
+    )
+    for customer_id, _, name in pairs:
+        gems[customer_id].append(name)
+    return gems
+
+
+def top_customers(top: List[RankingRow], gems: Dict[int, List[str]]) -> List[Dict]:
+    """
+    Список наиболее потративших покупателей в том же виде,
+    что и TopCustomersSerializer: имя, потраченная сумма и камни,
+    которые есть как минимум у двух покупателей из списка.
+    """
+    return [
+        {
+            'username': username,
+            'spent_money': money.format_cents(spent_money),
+            'gems': gems.get(customer_id, []),
+        } for customer_id, username, spent_money in top
+    ]
@@ -0,0 +1,32 @@
+from rest_framework.utils import encoders
+from rest_framework.renderers import JSONRenderer
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSON-рендерер, использующий orjson, если он установлен.
+
+    Результат побайтово совпадает с JSONRenderer при настройках DRF
+    по умолчанию (компактный вывод, unicode без экранирования).
+    Для вывода с отступами и без orjson используется обычный JSONRenderer.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if (
+            orjson is None
+            or data is None
+            or self.ensure_ascii
+            or not self.compact
+            or self.get_indent(accepted_media_type, renderer_context or {}) is not None
+        ):
+            return super().render(data, accepted_media_type, renderer_context)
+
+        ret = orjson.dumps(data, default=encoders.JSONEncoder().default)
+        # как и JSONRenderer, экранируем разделители строк,
+        # недопустимые в строковых литералах javascript
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
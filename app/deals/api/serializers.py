@@ -2,8 +2,17 @@ from django.db.models import (Count, F, Prefetch, Q, Value,
                               prefetch_related_objects)
 from rest_framework import serializers
 
+from app.deals import money
 from app.deals.models import Customer, Gem
-from sibdev_job import const
+
+
+class CentsField(serializers.ReadOnlyField):
+    """
+    Поле для сумм, хранящихся в копейках.
+    Выводит строку с двумя знаками после запятой, как DecimalField.
+    """
+    def to_representation(self, value):
+        return money.format_cents(value)
 
 
 class DealsUploadSerializer(serializers.Serializer):
@@ -21,10 +30,7 @@ class GemNameSerializer(serializers.ModelSerializer):
 class TopCustomersSerializer(serializers.ModelSerializer):
     """Сериализатор для отображения наиболее потратившихся покупателей."""
     username = serializers.CharField()
-    spent_money = serializers.DecimalField(
-        decimal_places=2,
-        max_digits=const.decimal_max_digits,
-    )
+    spent_money = CentsField()
     gems = serializers.SerializerMethodField()
 
     class Meta:
@@ -51,9 +57,18 @@ class TopCustomersSerializer(serializers.ModelSerializer):
             top_customers,
             Prefetch(
                 'gems',
-                Gem.objects.filter(name__in=filtered_gems).distinct()
+                Gem.objects.filter(name__in=filtered_gems).distinct().order_by('id')
             )
         )
 
     def get_gems(self, obj):
         return [f'{gem.name}' for gem in obj.gems.all()]
+
+
+class GemStatsSerializer(serializers.Serializer):
+    """Сериализатор сводной статистики по камню."""
+    name = serializers.CharField()
+    revenue = CentsField()
+    quantity = serializers.IntegerField()
+    deals_count = serializers.IntegerField()
+    customers_count = serializers.IntegerField()
@@ -1,12 +1,116 @@
+import csv
+import datetime
 from decimal import Decimal
+from io import StringIO
+from typing import List
+from urllib.parse import urlencode
 
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.urls import reverse
 from faker import Faker
+from rest_framework import status
+from rest_framework.response import Response
+
+from app.deals import stats
+from app.deals.api import payloads
+from app.deals.api.tests.common import Deal
+from app.deals.api.views import TopCustomersView
+from app.deals.models import GemStats
 
 fake = Faker()
 Faker.seed(420)
 
+# начало отсчета дат сделок в тестах
+start_date = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
 
 def fake_decimal(right_digits=2, min_value=0.1, max_value=10000) -> Decimal:
     """Генерирует случайное число типа Decimal."""
     num = fake.pyfloat(min_value=min_value, max_value=max_value)
     return Decimal(f'{num:.{right_digits}f}')
+
+
+def redis_cache_keys(pattern: str) -> List[str]:
+    """
+    Аналог cache.keys() из django-redis для встроенного
+    redis-бэкенда Django, который используется в тестах.
+    """
+    prefix = cache.make_key('')
+    client = cache._cache.get_client()
+    return [
+        key.decode()[len(prefix):]
+        for key in client.keys(cache.make_key(pattern))
+    ]
+
+
+def build_csv_data(deals: List[Deal]) -> List[List]:
+    """Переводит список сделок в формат, удобный для записи в csv."""
+    csv_header = ['customer', 'item', 'total', 'quantity', 'date']
+    return [
+        csv_header,
+        *(deal.to_list() for deal in deals)
+    ]
+
+
+def build_csv_content(data: List[List]) -> bytes:
+    """Содержимое csv-файла с переданными строками."""
+    f = StringIO()
+    csv.writer(f).writerows(data)
+    return f.getvalue().encode('utf-8')
+
+
+def expected_top_customers(limit: int) -> List[dict]:
+    """Топ покупателей, посчитанный по базе в обход кешей."""
+    top = payloads.ranking(TopCustomersView().get_queryset(), limit)
+    gems = payloads.shared_gems([customer_id for customer_id, _, _ in top])
+    return payloads.top_customers(top, gems)
+
+
+class UploadMixin:
+    """Загрузка сделок через эндпоинт импорта для тестов на TestCase."""
+    upload_url: str = reverse('deals:deals-upload')
+
+    def upload_deals(self, deals: List[Deal], **params) -> Response:
+        """Вспомогательный метод для загрузки файла со сделками."""
+        return self.upload_csv_data(build_csv_data(deals), **params)
+
+    def upload_csv_data(self, data: List[List], **params) -> Response:
+        """Загружает данные в виде csv-файла."""
+        data = SimpleUploadedFile(content=build_csv_content(data), name='deals.csv')
+        return self.upload_files([data], **params)
+
+    def upload_files(self, files: List[SimpleUploadedFile], **params) -> Response:
+        """Загружает несколько файлов одним запросом."""
+        url = f'{self.upload_url}?{urlencode(params)}' if params else self.upload_url
+        # кеши сбрасываются после коммита загрузки
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(url, {'deals': files})
+
+    def assert_uploaded(self, deals: List[Deal], **params) -> None:
+        """Загружает сделки и проверяет, что загрузка прошла успешно."""
+        response = self.upload_deals(deals, **params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.content)
+
+
+class GemStatsMixin:
+    """Проверка статистики камней для тестов на TestCase."""
+
+    def assert_stats_consistent(self) -> None:
+        """Поддерживаемая статистика камней совпадает с посчитанной по сделкам."""
+        expected = {
+            row['item_id']: tuple(row[field] for field in stats.stats_fields)
+            for row in stats.aggregate()
+        }
+        actual = {
+            row[0]: row[1:]
+            for row in GemStats.objects.filter(deals_count__gt=0)
+            .values_list('gem_id', *stats.stats_fields)
+        }
+        self.assertEqual(actual, expected)
+        # у камней без сделок статистика обнулена
+        self.assertFalse(
+            GemStats.objects.filter(deals_count=0)
+            .exclude(revenue_cents=0, quantity=0, customers_count=0)
+            .exists()
+        )
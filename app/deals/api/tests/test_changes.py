@@ -0,0 +1,181 @@
+import datetime
+from unittest import mock
+
+from django.core.cache import cache
+from django.db import DatabaseError, transaction
+from django.test import TestCase
+from django.urls import reverse
+from rest_framework import status
+
+from app.deals import changes, generation, stats
+from app.deals.api.tests.factories import DealFactory, GemFactory
+from app.deals.api.tests.helpers import GemStatsMixin, redis_cache_keys, start_date
+from app.deals.models import Customer, Deal, Gem
+
+
+@mock.patch('app.deals.api.invalidation.cache.keys', redis_cache_keys, create=True)
+class ChangeTrackingTestCase(GemStatsMixin, TestCase):
+    """Кейс для отслеживания изменений данных в обход загрузки."""
+    top_customers_url: str = reverse('deals:top-customers')
+
+    def setUp(self):
+        cache.clear()
+        with changes.untracked():
+            self.gems = GemFactory.create_batch(3)
+            self.deals = [
+                DealFactory(item=self.gems[i % 3], date=start_date + datetime.timedelta(days=i))
+                for i in range(6)
+            ]
+        stats.rebuild()
+
+    def committed(self):
+        """Перехватывает отправленные после коммита изменения."""
+        sent = []
+        receiver = mock.Mock(side_effect=lambda changes, **kwargs: sent.append(changes))
+        changes.committed.connect(receiver, weak=False, dispatch_uid='test')
+        self.addCleanup(changes.committed.disconnect, dispatch_uid='test')
+        return sent
+
+    def get_top_customers(self) -> list:
+        response = self.client.get(self.top_customers_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.json()['response']
+
+    def test_single_invalidation_per_transaction(self):
+        """Сколько бы строк ни изменилось, после коммита одна инвалидация."""
+        sent = self.committed()
+        data_generation = generation.get(generation.deals)
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with transaction.atomic():
+                for deal in self.deals:
+                    deal.total_cost_cents += 100
+                    deal.save()
+                Gem.objects.filter(pk=self.gems[0].pk).update(name='Изумруд')
+                Customer.objects.bulk_create([Customer(username='Новичок')])
+
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(sent), 1)
+        self.assertIsNone(sent[0].spend_deltas)
+        self.assertEqual(sent[0].gem_ids, {gem.pk for gem in self.gems})
+        self.assertTrue(sent[0].names)
+        self.assertEqual(generation.get(generation.deals), data_generation + 1)
+        self.assert_stats_consistent()
+
+    def test_precise_spend_deltas(self):
+        """Сохранение сделок дает точные изменения сумм по покупателям."""
+        sent = self.committed()
+        first, second = self.deals[:2]
+        previous_customer_id = second.customer_id
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                first.total_cost_cents += 100
+                first.save()
+                second.customer = first.customer
+                second.save()
+
+        self.assertEqual(sent[0].spend_deltas, {
+            first.customer_id: 100 + second.total_cost_cents,
+            previous_customer_id: -second.total_cost_cents,
+        })
+        self.assertFalse(sent[0].names)
+
+    def test_rollback_discards_changes(self):
+        """Откаченная транзакция ничего не сбрасывает."""
+        sent = self.committed()
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    Deal.objects.all().delete()
+                    raise RuntimeError()
+            except RuntimeError:
+                pass
+
+        self.assertEqual(callbacks, [])
+        self.assertEqual(sent, [])
+
+    def test_savepoint_rollback_keeps_outer_changes(self):
+        """Изменения после откаченной точки сохранения не теряются."""
+        sent = self.committed()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                try:
+                    with transaction.atomic():
+                        self.deals[0].delete()
+                        raise RuntimeError()
+                except RuntimeError:
+                    pass
+                self.deals[1].delete()
+
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(sent[0].gem_ids, {self.deals[1].item_id})
+        self.assertEqual(
+            sent[0].spend_deltas,
+            {self.deals[1].customer_id: -self.deals[1].total_cost_cents},
+        )
+
+    def test_bulk_operations_reset_cache(self):
+        """Массовые операции сбрасывают кеш страниц и обновляют статистику."""
+        self.get_top_customers()
+        gem = self.gems[0]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Deal.objects.filter(item=gem).update(total_cost_cents=10 ** 9)
+
+        top = self.get_top_customers()
+        self.assertEqual(top[0]['spent_money'], '10000000.00')
+        self.assert_stats_consistent()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Deal.objects.filter(item=gem).delete()
+
+        self.assertNotEqual(self.get_top_customers()[0]['spent_money'], '10000000.00')
+        self.assert_stats_consistent()
+
+    def test_delete_cascades_tracked(self):
+        """Удаление покупателя учитывает каскадно удаленные сделки."""
+        customer = self.deals[0].customer
+
+        with self.captureOnCommitCallbacks(execute=True):
+            customer.delete()
+
+        self.assertNotIn(
+            customer.username,
+            [row['username'] for row in self.get_top_customers()],
+        )
+        self.assert_stats_consistent()
+
+    def test_stats_failure_still_invalidates(self):
+        """
+        Ошибка пересчета статистики после коммита не мешает сбросу
+        кеша страниц и смене поколений: ETag и кеш не устаревают.
+        """
+        self.get_top_customers()
+        rows_generation = generation.get(generation.rows)
+
+        with (
+            mock.patch.object(stats, 'refresh', side_effect=DatabaseError()),
+            self.assertLogs('django.dispatch', 'ERROR'),
+            self.captureOnCommitCallbacks(execute=True),
+        ):
+            Deal.objects.filter(item=self.gems[0]).update(total_cost_cents=10 ** 9)
+
+        self.assertEqual(self.get_top_customers()[0]['spent_money'], '10000000.00')
+        self.assertGreater(generation.get(generation.rows), rows_generation)
+
+    def test_stats_refresh_bumps_stats_generation(self):
+        """
+        После пересчета статистики меняется ее поколение: ответ,
+        закешированный во время пересчета, не переживает его.
+        """
+        stats_generation = generation.get(generation.stats)
+        rows_generation = generation.get(generation.rows)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Deal.objects.filter(item=self.gems[0]).update(total_cost_cents=10 ** 9)
+
+        self.assertEqual(generation.get(generation.rows), rows_generation + 1)
+        self.assertEqual(generation.get(generation.stats), stats_generation + 2)
@@ -0,0 +1,143 @@
+import datetime
+import random
+import unittest
+from unittest import mock
+
+from django.core.cache import cache
+from django.db.models import Q, Sum
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+
+from app.deals import changes, columnar, models, stats
+from app.deals.api import payloads
+from app.deals.api.tests.common import Deal
+from app.deals.api.tests.helpers import UploadMixin, redis_cache_keys, start_date
+from app.deals.api.views import TopCustomersView
+
+
+@unittest.skipIf(columnar.import_numpy() is None, 'numpy не установлен')
+@mock.patch('app.deals.api.invalidation.cache.keys',
+            mock.Mock(return_value=[]),
+            create=True)
+class ColumnarEngineTestCase(UploadMixin, TestCase):
+    """Кейс для колоночного движка рейтинга покупателей."""
+    top_customers_url: str = reverse('deals:top-customers')
+
+    def setUp(self):
+        cache.clear()
+        rnd = random.Random(36)
+
+        # исходные данные теста: кешам еще нечего сбрасывать, а статистику
+        # камней, которую пересчитал бы коммит, считаем сразу
+        with changes.untracked():
+            self.gems = models.Gem.objects.bulk_create(
+                models.Gem(name=f'gem-{i}') for i in range(6)
+            )
+            # покупатели без сделок тоже участвуют в рейтинге
+            self.customers = models.Customer.objects.bulk_create(
+                models.Customer(username=f'customer-{i}') for i in range(40)
+            )
+            models.Deal.objects.bulk_create(
+                models.Deal(
+                    customer=customer,
+                    item=rnd.choice(self.gems),
+                    # мелкие суммы дают много равных итогов
+                    total_cost_cents=rnd.choice([100, 200, 300, rnd.randint(1, 10 ** 6)]),
+                    quantity=1,
+                    date=start_date + datetime.timedelta(
+                        days=rnd.randint(0, 60), microseconds=rnd.randint(0, 10 ** 6)
+                    ),
+                )
+                for customer in self.customers[:35]
+                for _ in range(rnd.randint(1, 4))
+            )
+        stats.rebuild()
+        self.engine = columnar.Engine()
+
+    def assert_matches_orm(self, snapshot: columnar.Snapshot):
+        """Рейтинг и общие камни снимка совпадают с запросами ORM."""
+        queryset = TopCustomersView().get_queryset()
+        for limit in (1, 3, 5, 10, 39, 40, 100):
+            top = snapshot.ranking(limit)
+            self.assertEqual(top, payloads.ranking(queryset, limit))
+
+            customer_ids = [customer_id for customer_id, _, _ in top]
+            self.assertEqual(
+                snapshot.shared_gems(customer_ids),
+                dict(payloads.shared_gems(customer_ids)),
+            )
+
+    def test_matches_orm(self):
+        """Снимок дает те же результаты, что и ORM."""
+        self.assert_matches_orm(self.engine.snapshot())
+
+    def test_filters_match_orm(self):
+        """Рейтинг за интервал и по камням совпадает с ORM."""
+        snapshot = self.engine.snapshot()
+        date_from = start_date + datetime.timedelta(days=10, microseconds=500)
+        date_to = start_date + datetime.timedelta(days=40)
+        item_ids = [self.gems[0].id, self.gems[3].id]
+
+        deals = (
+            Q(deals__date__gte=date_from)
+            & Q(deals__date__lt=date_to)
+            & Q(deals__item_id__in=item_ids)
+        )
+        queryset = models.Customer.objects.annotate(
+            spent_money=Sum('deals__total_cost_cents', filter=deals, default=0),
+        ).order_by('-spent_money', 'id')
+
+        for limit in (1, 5, 40):
+            self.assertEqual(
+                snapshot.ranking(limit, date_from=date_from, date_to=date_to, item_ids=item_ids),
+                payloads.ranking(queryset, limit),
+            )
+
+    def test_incremental_refresh(self):
+        """
+        После загрузки перечитываются только затронутые покупатели,
+        после полной замены - все сделки.
+        """
+        self.engine.snapshot()
+        existing = models.Deal.objects.select_related('customer', 'item').first()
+
+        deals = [
+            # исправление имеющейся сделки
+            Deal(existing.customer.username, 'gem-5', '0.01', 1, existing.date),
+            # новый покупатель и новый камень
+            Deal('Новичок', 'Новый камень', '99999.99', 1, start_date),
+            Deal('Новичок', 'gem-1', '1.00', 1, start_date + datetime.timedelta(days=1)),
+            # покупатель, у которого не было сделок
+            Deal(self.customers[-1].username, 'gem-1', '5000.00', 1, start_date),
+        ]
+        with mock.patch.object(self.engine, 'load', wraps=self.engine.load) as load_mock:
+            self.assert_uploaded(deals)
+            self.assert_matches_orm(self.engine.snapshot())
+            self.assertEqual(load_mock.call_count, 0)
+
+            self.assert_uploaded(deals[1:], mode='replace')
+            self.assert_matches_orm(self.engine.snapshot())
+            self.assertEqual(load_mock.call_count, 1)
+
+    def test_missing_changes_reload(self):
+        """Если журнал изменений неполон, снимок перечитывается целиком."""
+        self.engine.snapshot()
+        self.assert_uploaded([Deal('Новичок', 'gem-1', '1.00', 1, start_date)])
+        cache.delete_many(redis_cache_keys('*:changes:*'))
+
+        with mock.patch.object(self.engine, 'load', wraps=self.engine.load) as load_mock:
+            self.assert_matches_orm(self.engine.snapshot())
+        self.assertEqual(load_mock.call_count, 1)
+
+    @override_settings(DEALS_COLUMNAR_ENGINE=1)
+    def test_view_uses_engine(self):
+        """При включенном движке ответ совпадает с ответом через ORM."""
+        with mock.patch.object(columnar, '_engine', self.engine):
+            response = self.client.get(self.top_customers_url, {'limit': 10})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsNotNone(self.engine._snapshot)
+
+        top = payloads.ranking(TopCustomersView().get_queryset(), 10)
+        gems = payloads.shared_gems([customer_id for customer_id, _, _ in top])
+        self.assertEqual(response.json()['response'], payloads.top_customers(top, gems))
@@ -0,0 +1,169 @@
+import csv
+import datetime
+import threading
+import unittest
+from io import StringIO
+from collections import defaultdict
+from decimal import Decimal
+from typing import List, Tuple
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import Client, TransactionTestCase
+from django.urls import reverse
+from faker import Faker
+from rest_framework import status
+
+from app.deals import changes, models, stats
+from app.deals.api.tests.common import Deal
+from app.deals.api.tests.helpers import fake_decimal
+
+fake = Faker()
+Faker.seed(4242)
+
+
+@unittest.skipUnless(
+    connection.vendor == 'postgresql',
+    'одновременные загрузки проверяются на PostgreSQL',
+)
+# cache - прокси к объекту кеша своего потока, поэтому патчим класс бэкенда
+@mock.patch('django.core.cache.backends.redis.RedisCache.keys',
+            mock.Mock(return_value=[]),
+            create=True)
+class ConcurrentUploadTestCase(TransactionTestCase):
+    """Кейс для проверки одновременных загрузок файлов со сделками."""
+    url: str = reverse('deals:deals-upload')
+    top_customers_url: str = reverse('deals:top-customers')
+
+    files_count = 6
+
+    def build_file(self, deals: List[Deal]) -> SimpleUploadedFile:
+        f = StringIO()
+        writer = csv.writer(f)
+        writer.writerow(['customer', 'item', 'total', 'quantity', 'date'])
+        writer.writerows(deal.to_list() for deal in deals)
+        return SimpleUploadedFile(content=f.getvalue().encode('utf-8'), name='deals.csv')
+
+    def generate_deals(self, customers: List[str], gems: List[str], num: int) -> List[Deal]:
+        return [
+            Deal(
+                customer=fake.random_element(customers),
+                gem=fake.random_element(gems),
+                total=fake_decimal(),
+                quantity=fake.pyint(min_value=1, max_value=100),
+                date=fake.unique.date_time(tzinfo=datetime.timezone.utc),
+            ) for _ in range(num)
+        ]
+
+    def upload_concurrently(self, files: List[List[Deal]]) -> Tuple[List[int], List[int]]:
+        """
+        Загружает файлы одновременно из нескольких потоков.
+        Возвращает коды ответов и номера файлов в порядке коммита.
+        """
+        barrier = threading.Barrier(len(files))
+        statuses = [None] * len(files)
+
+        # после коммита загрузки сигнал отправляется в ее же потоке
+        local = threading.local()
+        committed = []
+        changes.committed.connect(
+            lambda **kwargs: committed.append(local.file),
+            weak=False, dispatch_uid='test_concurrency',
+        )
+        self.addCleanup(changes.committed.disconnect, dispatch_uid='test_concurrency')
+
+        def upload(i: int):
+            local.file = i
+            try:
+                barrier.wait()
+                response = Client().post(self.url, {'deals': self.build_file(files[i])})
+                statuses[i] = response.status_code
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=upload, args=(i, )) for i in range(len(files))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        changes.committed.disconnect(dispatch_uid='test_concurrency')
+        return statuses, committed
+
+    def db_snapshot(self) -> List[tuple]:
+        return sorted(
+            (deal.customer.username, deal.item.name, deal.total_cost, deal.quantity, deal.date)
+            for deal in models.Deal.objects.select_related('customer', 'item')
+        )
+
+    def assert_totals_match_deals(self):
+        """Статистика камней и суммы в топе совпадают с посчитанными по сделкам."""
+        fields = ('revenue_cents', 'quantity', 'deals_count', 'customers_count')
+        self.assertEqual(
+            {row[0]: row[1:] for row in models.GemStats.objects.values_list('gem_id', *fields)},
+            {row['item_id']: tuple(row[field] for field in fields) for row in stats.aggregate()},
+        )
+
+        spent = defaultdict(Decimal)
+        for deal in models.Deal.objects.select_related('customer'):
+            spent[deal.customer.username] += deal.total_cost
+        # кеш страниц топа в этом кейсе не сбрасывается (keys замокан)
+        cache.clear()
+        response = self.client.get(self.top_customers_url, {'limit': len(spent)})
+        self.assertEqual(
+            {row['username']: Decimal(row['spent_money']) for row in response.json()['response']},
+            dict(spent),
+        )
+
+    def test_overlapping_uploads_are_deterministic(self):
+        """
+        Файлы с общими покупателями, камнями и сделками, загруженные
+        одновременно, применяются целиком по очереди: без ошибок, дублей
+        покупателей, камней и сделок, а общие сделки, которые файлы
+        присылают с разными значениями, берутся из последнего
+        зафиксированного файла.
+        """
+        customers = [fake.unique.name() for _ in range(10)]
+        gems = ['Сапфир', 'Рубин', 'Изумруд', 'Кварц']
+
+        # общие для всех файлов сделки (те же покупатель и время,
+        # но в каждом файле свои камень, сумма и количество)
+        # и уникальные сделки каждого файла
+        common = self.generate_deals(customers, gems, 300)
+        files = [
+            [
+                Deal(
+                    customer=deal.customer,
+                    gem=fake.random_element(gems),
+                    total=fake_decimal(),
+                    quantity=fake.pyint(min_value=1, max_value=100),
+                    date=deal.date,
+                ) for deal in common
+            ] + self.generate_deals(customers, gems, 100)
+            for _ in range(self.files_count)
+        ]
+
+        # первый прогон создает справочники с нуля, последующие -
+        # пишут сделки уже известных покупателей, без ожидания
+        # на уникальных индексах справочников
+        for _ in range(3):
+            models.Deal.objects.all().delete()
+
+            statuses, committed = self.upload_concurrently(files)
+
+            self.assertEqual(statuses, [status.HTTP_200_OK] * self.files_count)
+            self.assertEqual(sorted(committed), list(range(self.files_count)))
+            # порядок коммитов заранее неизвестен: ожидаемое состояние -
+            # последовательная загрузка файлов в этом порядке
+            expected = sorted(
+                (deal.customer, deal.gem, deal.total, deal.quantity, deal.date)
+                for deal in {
+                    (deal.customer, deal.date): deal for i in committed for deal in files[i]
+                }.values()
+            )
+            self.assertEqual(self.db_snapshot(), expected)
+            self.assertEqual(models.Customer.objects.count(), len(customers))
+            self.assertEqual(models.Gem.objects.count(), len(gems))
+            self.assert_totals_match_deals()
+
@@ -0,0 +1,125 @@
+import datetime
+import random
+from typing import List
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.urls import reverse
+from rest_framework import status
+
+from app.deals.api.tests.common import Deal
+from app.deals.api.tests.helpers import (
+    GemStatsMixin, UploadMixin, redis_cache_keys, start_date,
+)
+from app.deals.models import Gem
+
+
+@mock.patch('app.deals.api.invalidation.cache.keys', redis_cache_keys, create=True)
+class GemStatsTestCase(UploadMixin, GemStatsMixin, TestCase):
+    """Кейс для статистики камней и эндпоинта /api/gems/stats/."""
+    gem_stats_url: str = reverse('deals:gem-stats')
+
+    def setUp(self):
+        cache.clear()
+
+    def get_stats(self, **params) -> List[dict]:
+        response = self.client.get(self.gem_stats_url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.json()['response']
+
+    def test_incremental_updates(self):
+        """
+        Статистика остается точной при дозагрузках, исправлениях
+        (в том числе со сменой камня) и полной замене сделок.
+        """
+        rnd = random.Random(37)
+        customers = [f'customer-{i}' for i in range(8)]
+        gems = [f'gem-{i}' for i in range(5)]
+        uploaded = []
+
+        for _ in range(15):
+            deals = []
+            for _ in range(rnd.randint(1, 12)):
+                if uploaded and rnd.random() < 0.4:
+                    # исправление ранее загруженной сделки
+                    previous = rnd.choice(uploaded)
+                    customer, date = previous.customer, previous.date
+                else:
+                    customer = rnd.choice(customers)
+                    date = start_date + datetime.timedelta(hours=rnd.randint(0, 500))
+                deals.append(Deal(
+                    customer, rnd.choice(gems),
+                    f'{rnd.randint(1, 100000) / 100:.2f}', rnd.randint(1, 5), date,
+                ))
+            self.assert_uploaded(deals)
+            uploaded.extend(deals)
+            self.assert_stats_consistent()
+
+        self.assert_uploaded(uploaded[:10], mode='replace')
+        self.assert_stats_consistent()
+
+    def test_customers_count(self):
+        """Число покупателей меняется при первой и последней сделке с камнем."""
+        self.assert_uploaded([
+            Deal('alice', 'Рубин', '10.00', 1, start_date),
+            Deal('alice', 'Рубин', '20.00', 2, start_date + datetime.timedelta(days=1)),
+            Deal('bob', 'Рубин', '5.00', 1, start_date),
+        ])
+        self.assertEqual(
+            self.get_stats(),
+            [{
+                'name': 'Рубин', 'revenue': '35.00', 'quantity': 4,
+                'deals_count': 3, 'customers_count': 2,
+            }],
+        )
+
+        # у bob больше нет сделок с рубином
+        self.assert_uploaded([Deal('bob', 'Сапфир', '5.00', 1, start_date)])
+        self.assertEqual(
+            [(row['name'], row['deals_count'], row['customers_count']) for row in self.get_stats()],
+            [('Рубин', 2, 1), ('Сапфир', 1, 1)],
+        )
+        self.assert_stats_consistent()
+
+    def test_ordering_and_limit(self):
+        """Сортировка по любому полю и ограничение количества камней."""
+        self.assert_uploaded([
+            Deal('alice', 'Агат', '300.00', 1, start_date),
+            Deal('bob', 'Агат', '1.00', 1, start_date),
+            Deal('alice', 'Берилл', '100.00', 5, start_date + datetime.timedelta(days=1)),
+            Deal('alice', 'Гранат', '200.00', 3, start_date + datetime.timedelta(days=2)),
+        ])
+
+        def names(**params):
+            return [row['name'] for row in self.get_stats(**params)]
+
+        self.assertEqual(names(), ['Агат', 'Гранат', 'Берилл'])
+        self.assertEqual(names(ordering='quantity'), ['Агат', 'Гранат', 'Берилл'])
+        self.assertEqual(names(ordering='-quantity'), ['Берилл', 'Гранат', 'Агат'])
+        self.assertEqual(names(ordering='-customers_count', limit=1), ['Агат'])
+        # при равенстве порядок определяется id камня
+        ties = sorted(Gem.objects.filter(name__in=['Берилл', 'Гранат']), key=lambda gem: gem.id)
+        self.assertEqual(
+            names(ordering='deals_count'), [gem.name for gem in ties] + ['Агат']
+        )
+        self.assertEqual(names(ordering='-name', limit=2), ['Гранат', 'Берилл'])
+
+        response = self.client.get(self.gem_stats_url, {'ordering': 'gem__name'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json()['code'], 'invalid_ordering')
+
+    def test_cache(self):
+        """Ответ кешируется до следующей загрузки сделок."""
+        self.assert_uploaded([Deal('alice', 'Рубин', '10.00', 1, start_date)])
+        self.get_stats()
+
+        with self.assertNumQueries(0):
+            self.get_stats()
+
+        response = self.client.get(self.gem_stats_url)
+        response = self.client.get(self.gem_stats_url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.assert_uploaded([Deal('bob', 'Рубин', '5.00', 1, start_date)])
+        self.assertEqual(self.get_stats()[0]['revenue'], '15.00')
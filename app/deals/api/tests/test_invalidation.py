@@ -0,0 +1,181 @@
+import datetime
+import random
+from decimal import Decimal
+from typing import List
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import RequestFactory, TestCase
+from django.urls import reverse
+from django.utils.cache import _generate_cache_header_key, get_cache_key
+from rest_framework import status
+
+from app.deals import generation
+from app.deals.api import const, invalidation
+from app.deals.api.tests.common import Deal
+from app.deals.api.tests.helpers import (
+    UploadMixin, expected_top_customers, redis_cache_keys, start_date,
+)
+
+
+@mock.patch('app.deals.api.invalidation.cache.keys', redis_cache_keys, create=True)
+class SelectiveInvalidationTestCase(UploadMixin, TestCase):
+    """Кейс для выборочной инвалидации кеша топа покупателей."""
+    top_customers_url: str = reverse('deals:top-customers')
+
+    def setUp(self):
+        cache.clear()
+
+    def get_top_customers(self, limit: int) -> List[dict]:
+        response = self.client.get(self.top_customers_url, {'limit': limit})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.json()['response']
+
+    def expire(self, limit: int):
+        """Удаляет из кеша страницу топа с лимитом limit (вместе с рейтингом), как по истечении срока."""
+        request = RequestFactory().get(self.top_customers_url, {'limit': limit})
+        prefix = const.top_customers_cache_key_prefix
+        keys = [_generate_cache_header_key(prefix, request)]
+        page_key = get_cache_key(request, prefix, 'GET', cache)
+        if page_key is not None:
+            keys.append(page_key)
+        cache.delete_many(keys)
+
+    @staticmethod
+    def deal(customer: str, total: str, day: int, gem: str = 'Рубин') -> Deal:
+        return Deal(
+            customer=customer,
+            gem=gem,
+            total=total,
+            quantity=1,
+            date=start_date + datetime.timedelta(days=day),
+        )
+
+    def test_upload_below_cutoff_keeps_cache(self):
+        """Загрузка, не достающая до порога рейтинга, не сбрасывает кеш."""
+        self.assert_uploaded([
+            self.deal('Лиза', '300', 1),
+            self.deal('Вова', '200', 1),
+            self.deal('Кирилл', '100', 1),
+        ])
+        self.get_top_customers(limit=2)
+        data_generation = generation.get(generation.deals)
+
+        self.assert_uploaded([self.deal('Кирилл', '50', 2), self.deal('Женя', '10', 1)])
+
+        self.assertEqual(generation.get(generation.deals), data_generation)
+        self.assertEqual(self.get_top_customers(limit=2), expected_top_customers(2))
+
+    def test_upload_reaching_cutoff_resets_cache(self):
+        """Покупатель, достигший порога рейтинга, сбрасывает кеш."""
+        self.assert_uploaded([
+            self.deal('Лиза', '300', 1),
+            self.deal('Вова', '200', 1),
+            self.deal('Кирилл', '100', 1),
+        ])
+        self.get_top_customers(limit=2)
+        data_generation = generation.get(generation.deals)
+
+        self.assert_uploaded([self.deal('Кирилл', '100', 2)])
+
+        self.assertNotEqual(generation.get(generation.deals), data_generation)
+        self.assertEqual(self.get_top_customers(limit=2), expected_top_customers(2))
+
+    def test_page_without_ranking_resets_cache(self):
+        """
+        Рейтинг хранится в закешированной странице; если у страницы
+        его нет, загрузка сбрасывает кеш целиком.
+        """
+        self.assert_uploaded([
+            self.deal('Лиза', '300', 1),
+            self.deal('Вова', '200', 1),
+            self.deal('Кирилл', '100', 1),
+        ])
+        self.get_top_customers(limit=2)
+        keys = invalidation.cache.keys(f'*cache_page.{const.top_customers_cache_key_prefix}.*')
+        for key, page in cache.get_many(keys).items():
+            delattr(page, invalidation._ranking_attr)
+            cache.set(key, page)
+        data_generation = generation.get(generation.deals)
+
+        self.assert_uploaded([self.deal('Женя', '10', 1)])
+
+        self.assertNotEqual(generation.get(generation.deals), data_generation)
+
+    def test_cached_pages_match_database(self):
+        """
+        Рандомизированный регрессионный тест (фиксированные seed):
+        после каждой загрузки закешированные страницы топа совпадают
+        с ответом, посчитанным по базе, а условный запрос с ранее
+        полученным ETag получает 304, только если ответ не изменился.
+        Загрузки случайные: новые сделки, исправления уже загруженных
+        (в том числе с уменьшением суммы) и смена камней; страницы
+        случайно истекают.
+        """
+        for seed in (34, 35, 36):
+            with self.subTest(seed=seed):
+                cache.clear()
+                self.check_random_uploads(random.Random(seed))
+
+    def check_random_uploads(self, rnd: random.Random):
+        customers = [f'customer-{i}' for i in range(50)]
+        gems = [f'gem-{i}' for i in range(5)]
+        limits = [1, 2, 3, 5, 10]
+        requested = set()
+        # последний полученный ETag и ответ по лимитам
+        received = {}
+        uploaded: List[Deal] = []
+        invalidations = []
+
+        original = invalidation.invalidate_top_customers
+
+        def invalidate(spend_deltas):
+            invalidations.append(original(spend_deltas))
+            return invalidations[-1]
+
+        def random_deal() -> Deal:
+            if uploaded and rnd.random() < 0.3:
+                # исправление загруженной сделки: меньшая сумма или другой камень
+                deal = rnd.choice(uploaded)
+                total = Decimal(deal.total)
+                if rnd.random() < 0.5:
+                    total = max(total - rnd.randint(1, 500), Decimal('0.01'))
+                return Deal(deal.customer, rnd.choice(gems), total, 1, deal.date)
+
+            # в основном мелкие сделки и изредка крупные, меняющие лидеров
+            total = rnd.choice([rnd.randint(1, 500), rnd.randint(1, 50000)])
+            return self.deal(
+                customer=rnd.choice(customers),
+                total=f'{total}.{rnd.randint(0, 99):02d}',
+                day=rnd.randint(0, 365),
+                gem=rnd.choice(gems),
+            )
+
+        with mock.patch.object(invalidation, 'invalidate_top_customers', invalidate):
+            for _ in range(80):
+                deals = [random_deal() for _ in range(rnd.randint(1, 4))]
+                self.assert_uploaded(deals)
+                uploaded.extend(deals)
+
+                requested.update(rnd.sample(limits, rnd.randint(0, 2)))
+                for limit in sorted(requested):
+                    expected = expected_top_customers(limit)
+                    if limit in received:
+                        etag, body = received[limit]
+                        response = self.client.get(
+                            self.top_customers_url, {'limit': limit}, HTTP_IF_NONE_MATCH=etag
+                        )
+                        if response.status_code == status.HTTP_304_NOT_MODIFIED:
+                            self.assertEqual(body, expected)
+
+                    response = self.client.get(self.top_customers_url, {'limit': limit})
+                    self.assertEqual(response.json()['response'], expected)
+                    received[limit] = response['ETag'], expected
+
+                for limit in requested:
+                    if rnd.random() < 0.2:
+                        self.expire(limit)
+
+        # проверка имеет смысл, только если встречались оба исхода
+        self.assertIn(True, invalidations)
+        self.assertIn(False, invalidations)
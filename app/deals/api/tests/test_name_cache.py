@@ -0,0 +1,77 @@
+from unittest import mock
+
+from django.db import transaction
+from django.test import TestCase
+
+from app.deals import ingest, name_cache
+from app.deals.models import Customer, Gem
+
+
+@mock.patch('app.deals.api.invalidation.cache.keys',
+            mock.Mock(return_value=[]),
+            create=True)
+class NameCacheTestCase(TestCase):
+    """Кейс для кеша соответствия имя -> id справочников."""
+
+    def setUp(self):
+        name_cache.customers.clear()
+        name_cache.gems.clear()
+
+    def test_ids_cached_after_commit(self):
+        """Id попадают в кеш после коммита и совпадают с базой."""
+        names = {'Лиза', 'Вова', 'Кирилл'}
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ids = ingest.get_or_create_ids(Customer, 'username', names)
+
+        cached, _ = name_cache.customers.get_many(names)
+        self.assertEqual(cached, ids)
+        self.assertEqual(
+            cached,
+            dict(Customer.objects.values_list('username', 'id')),
+        )
+
+        # повторное разрешение имен обходится без запросов к базе
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                ingest.get_or_create_ids(Customer, 'username', names), ids
+            )
+
+    def test_rollback_not_cached(self):
+        """Id записей из откаченной транзакции не попадают в кеш."""
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    ingest.get_or_create_ids(Gem, 'name', {'Сапфир'})
+                    raise RuntimeError()
+            except RuntimeError:
+                pass
+
+        cached, _ = name_cache.gems.get_many({'Сапфир'})
+        self.assertEqual(cached, {})
+
+    def test_invalidated_on_delete(self):
+        """Удаление записей справочника сбрасывает кеш во всех процессах."""
+        with self.captureOnCommitCallbacks(execute=True):
+            ingest.get_or_create_ids(Gem, 'name', {'Сапфир', 'Рубин'})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Gem.objects.filter(name='Рубин').delete()
+
+        cached, _ = name_cache.gems.get_many({'Сапфир', 'Рубин'})
+        self.assertEqual(cached, {})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ids = ingest.get_or_create_ids(Gem, 'name', {'Сапфир', 'Рубин'})
+        self.assertEqual(ids, dict(Gem.objects.values_list('name', 'id')))
+
+    def test_lru_eviction(self):
+        """Кеш покупателей ограничен по размеру и вытесняет давние записи."""
+        cache = name_cache.NameCache(maxsize=2)
+        _, stamp = cache.get_many([])
+        cache.set_many({'a': 1, 'b': 2}, stamp)
+        cache.get_many(['a'])
+        cache.set_many({'c': 3}, stamp)
+
+        cached, _ = cache.get_many(['a', 'b', 'c'])
+        self.assertEqual(cached, {'a': 1, 'c': 3})
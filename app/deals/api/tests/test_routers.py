@@ -0,0 +1,79 @@
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connections
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework import status
+
+from app.deals import changes
+from app.deals.api.tests.factories import DealFactory
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+@mock.patch('app.deals.api.invalidation.cache.keys',
+            mock.Mock(return_value=[]),
+            create=True)
+class ReplicaRoutingTestCase(TransactionTestCase):
+    """
+    Кейс для маршрутизации чтения на реплику.
+    Реплику изображает второй алиас той же тестовой базы.
+    """
+    databases = {'default', 'replica'}
+
+    top_customers_url: str = reverse('deals:top-customers')
+    upload_url: str = reverse('deals:deals-upload')
+
+    def setUp(self):
+        cache.clear()
+        # исходные данные теста не закрепляют чтение за основной базой
+        with changes.untracked():
+            DealFactory.create_batch(5)
+
+    def get_top_customers(self):
+        """Запрашивает топ покупателей, возвращая запросы к каждой базе."""
+        with (
+            CaptureQueriesContext(connections['default']) as primary,
+            CaptureQueriesContext(connections['replica']) as replica,
+        ):
+            response = self.client.get(self.top_customers_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.json()['response']), 5)
+        return primary, replica
+
+    def test_top_customers_read_from_replica(self):
+        """Список топовых покупателей читается с реплики."""
+        primary, replica = self.get_top_customers()
+
+        self.assertEqual(len(primary), 0)
+        self.assertGreater(len(replica), 0)
+
+    def test_primary_pinned_after_upload(self):
+        """
+        После загрузки сделок чтение закрепляется за основной базой,
+        а загрузка пишет только в основную базу.
+        """
+        content = (
+            'customer,item,total,quantity,date\n'
+            'bob,Сапфир,100,1,2018-12-14 08:29:52.506166\n'
+        ).encode('utf-8')
+
+        with CaptureQueriesContext(connections['replica']) as replica:
+            response = self.client.post(
+                self.upload_url,
+                {'deals': SimpleUploadedFile(content=content, name='deals.csv')},
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(replica), 0)
+
+        primary, replica = self.get_top_customers()
+        self.assertGreater(len(primary), 0)
+        self.assertEqual(len(replica), 0)
+
+        # окно закрепления истекло - снова читаем с реплики
+        cache.clear()
+        primary, replica = self.get_top_customers()
+        self.assertEqual(len(primary), 0)
+        self.assertGreater(len(replica), 0)
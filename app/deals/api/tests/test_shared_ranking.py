@@ -0,0 +1,154 @@
+import datetime
+import fcntl
+import os
+import tempfile
+import threading
+from typing import List
+from unittest import mock
+
+from django.core.cache import cache
+from django.db import DatabaseError
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+
+from app.deals import shared_ranking
+from app.deals.api import const
+from app.deals.api.tests.common import Deal
+from app.deals.api.tests.helpers import (
+    UploadMixin, expected_top_customers, redis_cache_keys, start_date,
+)
+
+
+@mock.patch('app.deals.api.invalidation.cache.keys', redis_cache_keys, create=True)
+class SharedRankingTestCase(UploadMixin, TestCase):
+    """Кейс для общего файла рейтинга покупателей."""
+    top_customers_url: str = reverse('deals:top-customers')
+
+    def setUp(self):
+        cache.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'ranking.bin')
+
+        settings = override_settings(DEALS_SHARED_RANKING=1, DEALS_SHARED_RANKING_PATH=self.path)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.use_process_ranking()
+
+    def use_process_ranking(self):
+        """
+        Подменяет файл рейтинга процесса еще не открывавшим его. Фоновый
+        поток не видит данных незавершенной транзакции теста, поэтому
+        файл строится сразу; сам поток проверяется отдельно.
+        """
+        ranking = shared_ranking.SharedRanking()
+        ranking._start_build = shared_ranking.rebuild
+        self.enterContext(mock.patch.object(shared_ranking, '_shared', ranking))
+
+    def get_top_customers(self, limit: int) -> List[dict]:
+        # страницы из кеша не интересны: проверяется построение ответа
+        cache.delete_many(redis_cache_keys(f'*{const.top_customers_cache_key_prefix}*'))
+        response = self.client.get(self.top_customers_url, {'limit': limit})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.json()['response']
+
+    @staticmethod
+    def deals(offset: int = 0) -> List[Deal]:
+        """Сделки с равными суммами и общими камнями у части покупателей."""
+        return [
+            Deal(
+                customer=f'customer-{i % 7}',
+                gem=f'gem-{i % 11}',
+                total=str(100 * (i % 3 + 1)),
+                quantity=1,
+                date=start_date + datetime.timedelta(days=offset + i),
+            ) for i in range(40)
+        ]
+
+    def test_built_on_first_request(self):
+        """
+        Загрузка файл не строит: его построение запускает первый запрос топа,
+        дальше рейтинг с любым лимитом отдается из файла без запросов к базе.
+        """
+        self.assert_uploaded(self.deals())
+        self.assertFalse(os.path.exists(self.path))
+
+        self.assertEqual(self.get_top_customers(5), expected_top_customers(5))
+        self.assertTrue(os.path.exists(self.path))
+
+        for limit in (1, 3, 7, 100):
+            expected = expected_top_customers(limit)
+            with self.assertNumQueries(0):
+                self.assertEqual(self.get_top_customers(limit), expected)
+
+    def test_swapped_on_new_generation(self):
+        """Новая загрузка подменяет файл, открытый прежний файл остается читаемым."""
+        self.assert_uploaded(self.deals())
+        shared_ranking.publish()
+        previous = shared_ranking.get()
+        previous_top = previous.ranking(3)
+
+        self.assert_uploaded(self.deals(offset=100)[:5])
+        self.assertIsNone(shared_ranking.get())
+        current = shared_ranking.get()
+
+        self.assertGreater(current.rows_generation, previous.rows_generation)
+        self.assertNotEqual(current.inode, previous.inode)
+        self.assertEqual(previous.ranking(3), previous_top)
+        self.assertEqual(self.get_top_customers(5), expected_top_customers(5))
+
+    def test_rebuilt_when_missing(self):
+        """Отсутствующий файл строит первый обратившийся воркер."""
+        self.assert_uploaded(self.deals())
+        self.get_top_customers(5)
+        os.remove(self.path)
+        # процесс, еще не открывавший файл
+        self.use_process_ranking()
+
+        self.assertEqual(self.get_top_customers(5), expected_top_customers(5))
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_database_fallback_while_building(self):
+        """Пока файл строит другой процесс, рейтинг читается из базы."""
+        self.assert_uploaded(self.deals())
+
+        with open(f'{self.path}.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.assertIsNone(shared_ranking.get())
+            self.assertEqual(self.get_top_customers(5), expected_top_customers(5))
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_database_fallback_on_build_error(self):
+        """Ошибка построения файла не ломает запрос: рейтинг читается из базы."""
+        self.assert_uploaded(self.deals())
+
+        with mock.patch.object(shared_ranking, 'write', side_effect=DatabaseError()):
+            self.assertIsNone(shared_ranking.get())
+            self.assertEqual(self.get_top_customers(5), expected_top_customers(5))
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_built_in_background(self):
+        """
+        Запрос не ждет построения файла: оно идет в фоновом потоке,
+        один поток на процесс, а рейтинг до публикации читается из базы.
+        """
+        ranking = shared_ranking.SharedRanking()
+        started, release = threading.Event(), threading.Event()
+        builders = []
+
+        def rebuild(path):
+            builders.append(threading.current_thread())
+            started.set()
+            release.wait(5)
+
+        with mock.patch.object(shared_ranking, 'rebuild', rebuild):
+            self.assertIsNone(ranking.get(self.path))
+            self.assertTrue(started.wait(5))
+            self.assertIsNone(ranking.get(self.path))
+            release.set()
+            ranking._builder.join(5)
+
+        self.assertEqual(len(builders), 1)
+        self.assertIsNot(builders[0], threading.current_thread())
@@ -0,0 +1,56 @@
+import os
+import tempfile
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+
+from app.deals.management.commands import startup
+
+
+class StartupCommandTestCase(TestCase):
+    """Кейс для подготовки контейнера к запуску."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.static_root = directory.name
+
+        settings = override_settings(
+            DEBUG=False,
+            STATIC_ROOT=self.static_root,
+            STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def run_startup(self, *args) -> list:
+        """Запускает startup и возвращает имена выполненных им команд."""
+        with mock.patch.object(startup, 'call_command', wraps=call_command) as called:
+            call_command('startup', *args, verbosity=0, stdout=StringIO())
+        return [call.args[0] for call in called.call_args_list]
+
+    def test_skips_up_to_date_steps(self):
+        """Повторный запуск ничего не делает, пока миграции и статика не устарели."""
+        self.assertEqual(self.run_startup(), ['collectstatic'])
+        self.assertTrue(os.path.exists(os.path.join(self.static_root, startup.static_hash_name)))
+
+        self.assertEqual(self.run_startup(), [])
+
+    def test_collects_static_again_when_removed(self):
+        """Статика собирается заново, если отпечаток не совпадает."""
+        self.run_startup()
+        os.remove(os.path.join(self.static_root, startup.static_hash_name))
+
+        self.assertEqual(self.run_startup(), ['collectstatic'])
+
+    def test_force(self):
+        """--force выполняет все шаги без проверок."""
+        with mock.patch.object(startup, 'call_command') as called:
+            call_command('startup', '--force', verbosity=0, stdout=StringIO())
+
+        self.assertEqual(
+            [call.args[0] for call in called.call_args_list],
+            ['migrate', 'collectstatic'],
+        )
@@ -1,48 +1,59 @@
-import csv
 import datetime
 import random
+import tarfile
+import unittest
+import zipfile
 from collections import defaultdict
 from decimal import Decimal
-from io import StringIO
+from io import BytesIO, StringIO
 from typing import List
 from unittest import mock
 
 from django.core.cache import cache
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Sum
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from faker import Faker
 from rest_framework import status
-from rest_framework.response import Response
+from rest_framework.renderers import JSONRenderer
 
-from app.deals import models
+from app.deals import generation, ingest, locks, models, shadow
 from app.deals.api import const
+from app.deals.api.serializers import TopCustomersSerializer
 from app.deals.api.tests.common import Deal
 from app.deals.api.tests.factories import (CustomerFactory, DealFactory,
                                            GemFactory)
-from app.deals.api.tests.helpers import fake_decimal
+from app.deals.api.tests.helpers import (UploadMixin, build_csv_content,
+                                         build_csv_data, fake_decimal)
 
 fake = Faker()
 Faker.seed(42)
 
 
-@mock.patch('app.deals.api.views.cache.keys',
+@mock.patch('app.deals.api.invalidation.cache.keys',
             mock.Mock(return_value=[]),
             create=True)
-class DealsUploadViewTestCase(TestCase):
+class DealsUploadViewTestCase(UploadMixin, TestCase):
     """Кейс для проверки загрузки данных о сделках."""
     customers: List[str]
     gems: List[str]
     deals: List[Deal]
 
-    url: str = reverse('deals:deals-upload')
-
     @classmethod
     def setUpTestData(cls):
         cls.customers = [fake.unique.name() for _ in range(20)]
         cls.gems = [f'gem-{i}' for i in range(20)]
         cls.deals = cls.generate_deals(cls.customers, cls.gems)
 
+    def setUp(self):
+        # поколения сбрасываются вместе с кешами имен, запомнившими
+        # id из откаченных транзакций предыдущих тестов
+        cache.clear()
+
     @classmethod
     def generate_deals(cls,
                        customers: List[str],
@@ -59,27 +70,6 @@ class DealsUploadViewTestCase(TestCase):
             ) for _ in range(num)
         ]
 
-    def upload_deals(self, deals: List[Deal]) -> Response:
-        """Вспомогательный метод для загрузки файла со сделками."""
-        data = self.build_csv_data(deals)
-        return self.upload_csv_data(data)
-
-    def build_csv_data(self, deals: List[Deal]) -> List[List]:
-        """Переводит список сделок в формат, удобный для записи в csv."""
-        csv_header = ['customer', 'item', 'total', 'quantity', 'date']
-        return [
-            csv_header,
-            *(deal.to_list() for deal in deals)
-        ]
-
-    def upload_csv_data(self, data: List[List]):
-        """Загружает данные в виде csv-файла."""
-        f = StringIO()
-        csv.writer(f).writerows(data)
-
-        data = SimpleUploadedFile(content=f.getvalue().encode('utf-8'), name='deals.csv')
-        return self.client.post(self.url, {'deals': data})
-
     def assert_data_from_deals(self, deals: List[Deal]):
         """
         Функция для проверки соответствия созданных объектов
@@ -145,7 +135,7 @@ class DealsUploadViewTestCase(TestCase):
 
     def test_file_is_missing(self):
         """Обращение к api без указания файла."""
-        response = self.client.post(self.url)
+        response = self.client.post(self.upload_url)
         data = response.json()
 
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
@@ -156,7 +146,7 @@ class DealsUploadViewTestCase(TestCase):
         f = StringIO()
         data = SimpleUploadedFile(content=f.read(), name='deals.csv')
 
-        response = self.client.post(self.url, {'deals': data})
+        response = self.client.post(self.upload_url, {'deals': data})
         data = response.json()
 
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
@@ -164,7 +154,7 @@ class DealsUploadViewTestCase(TestCase):
 
     def test_file_invalid_header(self):
         """Загрузка csv с неправильным названием столбца."""
-        data = self.build_csv_data(self.deals)
+        data = build_csv_data(self.deals)
         data[0][0] = 'Неправильное название столбца.'
 
         response = self.upload_csv_data(data)
@@ -175,7 +165,7 @@ class DealsUploadViewTestCase(TestCase):
 
     def test_file_invalid_data(self):
         """Загрузка csv с испорченными данными."""
-        data = self.build_csv_data(self.deals)
+        data = build_csv_data(self.deals)
         data[1][3] = 'Строка вместо числа.'
 
         response = self.upload_csv_data(data)
@@ -184,6 +174,476 @@ class DealsUploadViewTestCase(TestCase):
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertEqual(data['code'], 'file_corrupt_data')
 
+    def test_deals_chunked_upload_success(self):
+        """Поэтапная загрузка сохраняет те же данные, что и обычная."""
+        response = self.upload_deals(self.deals, chunk_size=7)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assert_data_from_deals(self.deals)
+        self.assertFalse(models.ImportCheckpoint.objects.exists())
+        self.assertFalse(models.StagedDeal.objects.exists())
+
+    def test_deals_chunked_upload_resume(self):
+        """
+        Прерванная поэтапная загрузка:
+        - не публикует частично импортированный файл;
+        - при повторной загрузке продолжается с контрольной точки.
+        """
+        deals_count = models.Deal.objects.count()
+        parse_row = ingest.parse_row
+
+        def broken_parse_row(row):
+            if broken_parse_row.calls == 50:
+                raise ValueError('обрыв загрузки')
+            broken_parse_row.calls += 1
+            return parse_row(row)
+        broken_parse_row.calls = 0
+
+        with mock.patch('app.deals.ingest.parse_row', broken_parse_row):
+            response = self.upload_deals(self.deals, chunk_size=10)
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(models.Deal.objects.count(), deals_count)
+        checkpoint = models.ImportCheckpoint.objects.get()
+        self.assertEqual(checkpoint.rows_committed, 50)
+
+        with mock.patch('app.deals.ingest.parse_row', wraps=parse_row) as parse_mock:
+            response = self.upload_deals(self.deals, chunk_size=10)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(parse_mock.call_count, len(self.deals) - 50)
+        self.assert_data_from_deals(self.deals)
+        self.assertFalse(models.ImportCheckpoint.objects.exists())
+
+    def test_deals_chunked_replace_publish_failure(self):
+        """
+        При полной замене контрольная точка удаляется в транзакции,
+        публикующей данные: если удаление не удалось, данные
+        не опубликованы и загрузку можно повторить.
+        """
+        self.upload_deals(self.deals)
+        deals_count = models.Deal.objects.count()
+        deals = self.generate_deals(self.customers, self.gems, 10)
+
+        with mock.patch.object(models.ImportCheckpoint, 'delete',
+                               side_effect=RuntimeError('сбой при публикации')):
+            response = self.upload_deals(deals, mode='replace', chunk_size=3)
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(models.Deal.objects.count(), deals_count)
+        self.assertEqual(models.ImportCheckpoint.objects.get().rows_committed, len(deals))
+
+        response = self.upload_deals(deals, mode='replace', chunk_size=3)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(models.Deal.objects.count(), len(deals))
+        self.assertFalse(models.ImportCheckpoint.objects.exists())
+
+    def test_clean_expired_checkpoints(self):
+        """Команда clean_checkpoints удаляет только брошенные контрольные точки."""
+        parse_row = ingest.parse_row
+
+        def broken_parse_row(row):
+            if broken_parse_row.calls == 10:
+                raise ValueError('обрыв загрузки')
+            broken_parse_row.calls += 1
+            return parse_row(row)
+
+        # две разные загрузки, прерванные после первой пачки
+        for deals in (self.deals[:50], self.deals[50:]):
+            broken_parse_row.calls = 0
+            with mock.patch('app.deals.ingest.parse_row', broken_parse_row):
+                response = self.upload_deals(deals, chunk_size=10)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        expired, fresh = models.ImportCheckpoint.objects.order_by('id')
+        models.ImportCheckpoint.objects.filter(id=expired.id).update(
+            updated_at=expired.updated_at - datetime.timedelta(days=8)
+        )
+
+        call_command('clean_checkpoints', max_age=7 * 24 * 60 * 60, stdout=StringIO())
+
+        self.assertEqual(list(models.ImportCheckpoint.objects.all()), [fresh])
+        self.assertEqual(
+            set(models.StagedDeal.objects.values_list('checkpoint_id', flat=True)),
+            {fresh.id},
+        )
+
+    def test_invalid_chunk_size(self):
+        """Некорректный размер пачки для поэтапной загрузки."""
+        response = self.upload_deals(self.deals, chunk_size='abc')
+        data = response.json()
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(data['code'], 'invalid_chunk_size')
+
+    def test_deals_replace_upload(self):
+        """
+        Загрузка в режиме replace полностью заменяет ранее загруженные сделки:
+        старые сделки, а также покупатели и камни без сделок удаляются.
+        """
+        self.upload_deals(self.deals)
+
+        customers = [fake.unique.name() for _ in range(5)]
+        gems = ['Сапфир', 'Рубин']
+        deals = self.generate_deals(customers, gems, 10)
+        # повтор пары покупатель + таймстамп: побеждает последняя строка
+        deals.append(Deal(
+            customer=deals[0].customer,
+            gem=gems[1],
+            total=Decimal('1.23'),
+            quantity=1,
+            date=deals[0].date,
+        ))
+
+        for params in ({'mode': 'replace'}, {'mode': 'replace', 'chunk_size': 3}):
+            response = self.upload_deals(deals, **params)
+
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assert_data_from_deals(deals[1:])
+            self.assertEqual(models.Deal.objects.count(), len(deals) - 1)
+            self.assertEqual(
+                set(models.Customer.objects.values_list('username', flat=True)),
+                set(deal.customer for deal in deals[1:]),
+            )
+            self.assertEqual(
+                set(models.Gem.objects.values_list('name', flat=True)),
+                set(deal.gem for deal in deals[1:]),
+            )
+
+    @unittest.skipUnless(shadow.is_supported(), 'теневая таблица только для PostgreSQL')
+    def test_deals_replace_swap_failure(self):
+        """
+        Новые покупатели и камни замены создаются только при подмене таблиц:
+        если подмена не удалась, в базе их нет.
+        """
+        self.upload_deals(self.deals)
+        deals = self.generate_deals([fake.unique.name() for _ in range(3)], ['Опал'], 5)
+
+        with mock.patch.object(shadow, 'swap', side_effect=RuntimeError()):
+            response = self.upload_deals(deals, mode='replace')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(
+            models.Customer.objects.filter(username__in={deal.customer for deal in deals}).exists()
+        )
+        self.assertFalse(models.Gem.objects.filter(name='Опал').exists())
+        self.assertEqual(models.Deal.objects.count(), len(self.deals))
+
+    @unittest.skipUnless(shadow.is_supported(), 'теневая таблица только для PostgreSQL')
+    def test_deals_replace_swap_without_scans(self):
+        """
+        Покупатели и камни без сделок находятся, а статистика камней
+        считается по теневой таблице до подмены: в транзакции подмены
+        нет проходов по сделкам.
+        """
+        self.upload_deals(self.deals)
+        deals = self.generate_deals(self.customers[:3], self.gems[:2], 10)
+        swap = shadow.swap
+        swap_queries = []
+
+        def capturing_swap(on_swap):
+            def capturing_on_swap():
+                with CaptureQueriesContext(connection) as queries:
+                    on_swap()
+                swap_queries.extend(query['sql'] for query in queries)
+            swap(on_swap=capturing_on_swap)
+
+        with mock.patch.object(shadow, 'swap', capturing_swap):
+            response = self.upload_deals(deals, mode='replace')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            set(models.Customer.objects.values_list('username', flat=True)),
+            {deal.customer for deal in deals},
+        )
+        self.assertEqual(
+            set(models.Gem.objects.values_list('name', flat=True)),
+            {deal.gem for deal in deals},
+        )
+        for sql in swap_queries:
+            self.assertNotIn('IS NULL', sql)
+            self.assertNotIn('NOT EXISTS', sql)
+            self.assertNotIn('GROUP BY', sql)
+
+    def test_upload_post_commit_failure(self):
+        """
+        Ошибка после коммита загрузки (например, недоступен redis)
+        не превращает успешную загрузку в ошибку обработки файла.
+        """
+        with (
+            mock.patch('app.deals.signals.invalidation.invalidate_top_customers',
+                       side_effect=ConnectionError()),
+            self.assertLogs('django.dispatch', 'ERROR'),
+        ):
+            response = self.upload_deals(self.deals)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assert_data_from_deals(self.deals)
+
+    def test_invalid_mode(self):
+        """Неизвестный режим загрузки."""
+        response = self.upload_deals(self.deals, mode='merge')
+        data = response.json()
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(data['code'], 'invalid_mode')
+
+    def test_file_sub_cent_total(self):
+        """Суммы с долями копеек отклоняются, а не округляются."""
+        data = build_csv_data(self.deals)
+        data[1][2] = '10.005'
+
+        response = self.upload_csv_data(data)
+        data = response.json()
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(data['code'], 'file_corrupt_data')
+
+    def test_file_invalid_data_report(self):
+        """
+        Файл проверяется целиком до записи в базу: в ответе все ошибки
+        с номерами строк (заголовок - строка 1) и колонками.
+        """
+        data = build_csv_data(self.deals)
+        data[1][2] = '0'
+        data[3][3] = '-1'
+        data[3][4] = '2020-13-01'
+        data[10] = data[10][:4]
+        data[20][0] = ''
+        data[30][2] = '1' * 30
+        data[-1][4] = 'вчера'
+
+        with self.assertNumQueries(0):
+            response = self.upload_csv_data(data)
+        data = response.json()
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(data['code'], 'file_corrupt_data')
+        self.assertIn('deals.csv', data['detail'])
+        self.assertEqual(data['errors_count'], 7)
+        self.assertEqual(
+            [(error['line'], error['column']) for error in data['errors']],
+            [
+                (2, 'total'), (4, 'quantity'), (4, 'date'), (11, 'date'),
+                (21, 'customer'), (31, 'total'), (len(self.deals) + 1, 'date'),
+            ],
+        )
+        self.assertTrue(all(error['file'] == 'deals.csv' for error in data['errors']))
+
+    def test_file_missing_columns(self):
+        """Отсутствующие колонки перечисляются в отчете."""
+        data = [[row[0], row[2], row[4]] for row in build_csv_data(self.deals)]
+
+        response = self.upload_csv_data(data)
+        data = response.json()
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(
+            [(error['line'], error['column']) for error in data['errors']],
+            [(1, 'item'), (1, 'quantity')],
+        )
+
+    def test_file_errors_report_limit(self):
+        """В отчет попадают первые ошибки, посчитаны все."""
+        data = build_csv_data(self.deals)
+        for row in data[1:]:
+            row[3] = 'много'
+
+        with mock.patch('app.deals.parsing.max_errors', 10):
+            response = self.upload_csv_data(data)
+        data = response.json()
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(len(data['errors']), 10)
+        self.assertEqual(data['errors_count'], len(self.deals))
+
+    def test_file_dates_timezones(self):
+        """Даты со смещением приводятся к UTC, даты без смещения считаются UTC."""
+        data = build_csv_data(self.deals[:3])
+        # один момент времени у разных покупателей: иначе сделки совпадут
+        for row, customer in zip(data[1:], self.customers):
+            row[0] = customer
+        data[1][4] = '2021-06-01T12:00:00Z'
+        data[2][4] = '2021-06-01 15:00:00+03:00'
+        data[3][4] = '2021-06-02 12:00:00'
+
+        response = self.upload_csv_data(data)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        utc = datetime.timezone.utc
+        self.assertEqual(
+            sorted(models.Deal.objects.values_list('date', flat=True)),
+            [
+                datetime.datetime(2021, 6, 1, 12, tzinfo=utc),
+                datetime.datetime(2021, 6, 1, 12, tzinfo=utc),
+                datetime.datetime(2021, 6, 2, 12, tzinfo=utc),
+            ],
+        )
+
+    def test_upload_dry_run(self):
+        """Режим dry_run возвращает отчет о проверке и ничего не записывает."""
+        response = self.upload_deals(self.deals, dry_run=1)
+        data = response.json()
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(data['rows'], len(self.deals))
+        self.assertTrue(data['dry_run'])
+        self.assertEqual([file['name'] for file in data['files']], ['deals.csv'])
+        self.assertFalse(models.Deal.objects.exists())
+
+        broken = build_csv_data(self.deals)
+        broken[5][2] = 'сто'
+        response = self.upload_csv_data(broken, dry_run=1)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json()['errors'][0]['line'], 6)
+
+        response = self.upload_deals(self.deals, dry_run='yes')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json()['code'], 'invalid_dry_run')
+
+    def test_chunked_upload_invalid_data(self):
+        """Испорченный файл не начинает поэтапную загрузку."""
+        data = build_csv_data(self.deals)
+        data[-1][3] = 'Строка вместо числа.'
+
+        response = self.upload_csv_data(data, chunk_size=10)
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json()['errors'][0]['line'], len(self.deals) + 1)
+        self.assertFalse(models.ImportCheckpoint.objects.exists())
+        self.assertFalse(models.StagedDeal.objects.exists())
+
+    @mock.patch('app.deals.locks.upload_slots', 0)
+    def test_upload_queue_full(self):
+        """Если все слоты загрузки заняты, сервер отвечает 429 с Retry-After."""
+        deals_count = models.Deal.objects.count()
+
+        response = self.upload_deals(self.deals)
+        data = response.json()
+
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(data['code'], 'upload_queue_full')
+        self.assertEqual(response['Retry-After'], str(locks.upload_retry_after))
+        self.assertEqual(models.Deal.objects.count(), deals_count)
+
+    # разбор в пуле процессов даже на машине с одним процессором
+    @mock.patch('app.deals.parsing.parse_workers', 2)
+    @mock.patch('app.deals.parsing.parallel_min_size', 0)
+    def test_multiple_files_upload(self):
+        """
+        Несколько файлов в одном запросе:
+        - сохраняются одной загрузкой с одним сбросом кеша;
+        - при повторе пары покупатель + таймстамп побеждает более поздний файл;
+        - в ответе есть количество строк и время разбора каждого файла.
+        """
+        first, second = self.deals[:60], self.deals[60:]
+        fix = Deal(
+            customer=first[0].customer,
+            gem=first[0].gem,
+            total=Decimal('1.23'),
+            quantity=1,
+            date=first[0].date,
+        )
+        second = [*second, fix]
+
+        files = [
+            SimpleUploadedFile(
+                content=build_csv_content(build_csv_data(deals)),
+                name=name,
+            ) for name, deals in (('north.csv', first), ('south.csv', second))
+        ]
+        with mock.patch(
+            'app.deals.api.invalidation.invalidate_top_customers'
+        ) as invalidate_mock:
+            response = self.upload_files(files)
+        data = response.json()
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assert_data_from_deals([*first[1:], *second])
+        self.assertEqual(invalidate_mock.call_count, 1)
+        self.assertEqual(data['rows'], len(self.deals) + 1)
+        self.assertEqual(
+            [(file['name'], file['rows']) for file in data['files']],
+            [('north.csv', len(first)), ('south.csv', len(second))],
+        )
+        self.assertTrue(all(file['parse_ms'] >= 0 for file in data['files']))
+
+    def test_archive_upload(self):
+        """
+        Архивы zip и tar.gz заменяются содержащимися в них файлами,
+        которые применяются в порядке имен; служебные файлы пропускаются.
+        """
+        first, second = self.deals[:50], self.deals[50:]
+        members = {
+            'b-south.csv': build_csv_content(build_csv_data(second)),
+            'a-north.csv': build_csv_content(build_csv_data(first)),
+            '__MACOSX/._a-north.csv': b'\x00\x05\x16\x07',
+        }
+
+        zip_buffer = BytesIO()
+        with zipfile.ZipFile(zip_buffer, 'w') as archive:
+            for name, content in members.items():
+                archive.writestr(name, content)
+
+        tar_buffer = BytesIO()
+        with tarfile.open(fileobj=tar_buffer, mode='w:gz') as archive:
+            for name, content in members.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                archive.addfile(info, BytesIO(content))
+
+        for name, buffer in (('deals.zip', zip_buffer), ('deals.tar.gz', tar_buffer)):
+            response = self.upload_files(
+                [SimpleUploadedFile(content=buffer.getvalue(), name=name)]
+            )
+            data = response.json()
+
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assert_data_from_deals(self.deals)
+            self.assertEqual(
+                [(file['name'], file['rows']) for file in data['files']],
+                [(f'{name}/a-north.csv', len(first)), (f'{name}/b-south.csv', len(second))],
+            )
+
+    # разбор в пуле процессов даже на машине с одним процессором
+    @mock.patch('app.deals.parsing.parse_workers', 2)
+    @mock.patch('app.deals.parsing.parallel_min_size', 0)
+    def test_multiple_files_invalid_data(self):
+        """Ошибка в одном из файлов отклоняет всю загрузку и называет файл."""
+        deals_count = models.Deal.objects.count()
+        broken = build_csv_data(self.deals[50:])
+        broken[1][3] = 'Строка вместо числа.'
+
+        response = self.upload_files([
+            SimpleUploadedFile(
+                content=build_csv_content(build_csv_data(self.deals[:50])),
+                name='north.csv',
+            ),
+            SimpleUploadedFile(content=build_csv_content(broken), name='south.csv'),
+        ])
+        data = response.json()
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(data['code'], 'file_corrupt_data')
+        self.assertIn('south.csv', data['detail'])
+        self.assertEqual(models.Deal.objects.count(), deals_count)
+
+    def test_multiple_files_chunked(self):
+        """Поэтапная загрузка нескольких файлов не поддерживается."""
+        files = [
+            SimpleUploadedFile(
+                content=build_csv_content(build_csv_data(self.deals)),
+                name=name,
+            ) for name in ('north.csv', 'south.csv')
+        ]
+
+        response = self.upload_files(files, chunk_size=10)
+        data = response.json()
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(data['code'], 'chunked_multiple_files')
+
     def test_cache_reset_on_new_data(self):
         """
         При загрузке новых данных сбрасывается кеш страниц.
@@ -195,8 +655,8 @@ class DealsUploadViewTestCase(TestCase):
         cache_key_pattern = f'*{const.top_customers_cache_key_prefix}*'
 
         with (
-            mock.patch('app.deals.api.views.cache.keys') as keys_mock,
-            mock.patch('app.deals.api.views.cache.delete_many') as delete_mock
+            mock.patch('app.deals.api.invalidation.cache.keys') as keys_mock,
+            mock.patch('app.deals.api.invalidation.cache.delete_many') as delete_mock
         ):
             found_keys = [f'cache-key-{i}' for i in range(5)]
             keys_mock.return_value = found_keys
@@ -206,6 +666,15 @@ class DealsUploadViewTestCase(TestCase):
         keys_mock.assert_called_with(cache_key_pattern)
         delete_mock.assert_called_with(keys=found_keys)
 
+    def test_generation_bumped_on_new_data(self):
+        """При загрузке новых данных меняется поколение данных."""
+        data_generation = generation.get(generation.deals)
+
+        self.upload_deals(self.deals)
+
+        self.assertNotEqual(generation.get(generation.deals), data_generation)
+        self.assertIsNotNone(generation.modified(generation.deals))
+
 
 class TopCustomersViewTestCase(TestCase):
     """Кейс для страницы с данными о топовых покупателях."""
@@ -263,6 +732,19 @@ class TopCustomersViewTestCase(TestCase):
             self.assertEqual(customer['username'], expected_data[0])
             self.assertEqual(Decimal(customer['spent_money']), expected_data[1])
 
+    def test_spent_money_format(self):
+        """Потраченная сумма выводится строкой с двумя знаками после запятой."""
+        models.Deal.objects.all().delete()
+
+        DealFactory(customer=self.customers[0], total_cost=Decimal('1000.5'))
+        DealFactory(customer=self.customers[0], total_cost=Decimal('0.07'))
+
+        response = self.client.get(self.url)
+        data = response.json()['response']
+
+        self.assertEqual(data[0]['spent_money'], '1000.57')
+        self.assertEqual(data[1]['spent_money'], '0.00')
+
     def test_popular_gems_detection(self):
         """
         В списке камней ползователей должны быть только те камни,
@@ -363,6 +845,7 @@ class TopCustomersViewTestCase(TestCase):
         data = [customer['gems'] for customer in data]
 
         self.assertEqual(data, expected_data)
+        self.assertEqual(response['X-Cache'], 'MISS')
 
         # очищаем данные в БД и проверяем, что ответ api не изменился
         models.Deal.objects.all().delete()
@@ -372,6 +855,7 @@ class TopCustomersViewTestCase(TestCase):
         data = [customer['gems'] for customer in data]
 
         self.assertEqual(data, expected_data)
+        self.assertEqual(response['X-Cache'], 'HIT')
 
         # очищаем кеш и проверяем, что в ответe api теперь свежие данные
         cache.clear()
@@ -382,3 +866,69 @@ class TopCustomersViewTestCase(TestCase):
         data = [customer['gems'] for customer in data]
 
         self.assertEqual(data, empty_data)
+
+    def test_conditional_get(self):
+        """
+        Ответ содержит ETag и Last-Modified, привязанные к поколению строк сделок.
+        Повторный запрос с тем же ETag получает 304 без обращения
+        к кешу страниц и базе.
+        """
+        generation.bump(generation.rows)
+
+        response = self.client.get(self.url, {'limit': 3})
+        etag = response['ETag']
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.has_header('Last-Modified'))
+
+        with (
+            self.assertNumQueries(0),
+            mock.patch('django.middleware.cache.FetchFromCacheMiddleware.process_request') as cache_mock,
+        ):
+            response = self.client.get(self.url, {'limit': 3}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+        cache_mock.assert_not_called()
+
+        # другой лимит - другой ответ
+        response = self.client.get(self.url, {'limit': 4}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # некорректный лимит равнозначен лимиту по умолчанию
+        default_etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, {'limit': 'abc'}, HTTP_IF_NONE_MATCH=default_etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # после загрузки новых данных ETag меняется
+        generation.bump(generation.rows)
+        response = self.client.get(self.url, {'limit': 3}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_fast_path_matches_serializer(self):
+        """
+        Быстрый путь формирования ответа побайтово совпадает
+        с ответом через сериализатор и JSONRenderer DRF.
+        """
+        models.Deal.objects.all().delete()
+
+        customers = self.customers + [
+            CustomerFactory(username='Ёжик "в тумане"'),
+            CustomerFactory(username='line\u2028separator'),
+        ]
+        for customer in customers:
+            for gem in random.sample(self.gems, 3):
+                DealFactory(customer=customer, item=gem)
+
+        queryset = models.Customer.objects.annotate(
+            spent_money=Sum('deals__total_cost_cents', default=0),
+        ).order_by('-spent_money', 'id')
+
+        for limit in (1, 5, 10, len(customers)):
+            top_customers = list(queryset[:limit])
+            data = TopCustomersSerializer(top_customers, many=True).data
+            expected = JSONRenderer().render({'response': data})
+
+            cache.clear()
+            response = self.client.get(self.url, {'limit': limit})
+
+            self.assertEqual(response.content, expected)
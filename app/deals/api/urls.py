@@ -15,4 +15,9 @@ urlpatterns = [
         views.TopCustomersView.as_view(),
         name='top-customers'
     ),
+    path(
+        'gems/stats/',
+        views.GemStatsView.as_view(),
+        name='gem-stats'
+    ),
 ]
@@ -1,18 +1,25 @@
 import csv
 import datetime
+import time
+from typing import List, Optional, Tuple
 
 from django.core.cache import cache
-from django.db import transaction
-from django.db.models import Sum
+from django.db.models import F, Sum
 from django.utils.decorators import method_decorator
 from django.views.decorators.cache import cache_page
 from rest_framework import generics, status, views
 from rest_framework.exceptions import ValidationError
+from rest_framework.renderers import BrowsableAPIRenderer, JSONRenderer
 from rest_framework.response import Response
 
-from app.deals.api import const, serializers
-from app.deals.api.paginators import SimpleLimitPagination
-from app.deals.models import Customer, Deal, Gem
+from app.deals import (archives, columnar, generation, ingest, locks,
+                       parsing, routers, shared_ranking)
+from app.deals.api import (const, exceptions, invalidation, payloads,
+                           serializers)
+from app.deals.api.decorators import cache_status, condition, mark_cache_miss
+from app.deals.api.paginators import GemStatsPagination, SimpleLimitPagination
+from app.deals.api.renderers import FastJSONRenderer
+from app.deals.models import Customer, GemStats
 
 
 class DealsUploadView(views.APIView):
@@ -24,29 +31,64 @@ class DealsUploadView(views.APIView):
     serializer_class = serializers.DealsUploadSerializer
 
     def post(self, request, version=None):
-        file = request.FILES.get('deals')
-        if not file:
+        chunk_size = self._get_chunk_size(request)
+        replace = self._get_replace_mode(request)
+        dry_run = self._get_dry_run(request)
+        files = self._read_files(request)
+
+        if chunk_size and len(files) > 1:
             raise ValidationError({
-                    'detail': 'Отсутствует файл со сделками.',
-                    'code': 'file_missing',
-                })
+                'detail': 'Поэтапная загрузка поддерживается только для одного файла.',
+                'code': 'chunked_multiple_files',
+            })
 
-        try:
-            text = file.read().decode('utf-8')
-            if not text:
-                raise ValidationError({
-                    'detail': 'В файле отсутствуют данные.',
-                    'code': 'file_empty',
-                })
-            data = csv.DictReader(text.splitlines())
-        except (UnicodeDecodeError, AttributeError):
+        # файлы целиком проверяются без обращения к базе, запись
+        # начинается, только если ошибок нет; при поэтапной загрузке
+        # строки разбираются заново по мере записи пачек
+        parsed = parsing.parse_files(
+            [(name, text) for name, _, text in files],
+            keep_rows=not (chunk_size or dry_run),
+        )
+        self._check_errors(parsed)
+
+        rows_count = sum(file.rows_count for file in parsed)
+        if rows_count == 0:
             raise ValidationError({
-                'detail': 'Формат файла не поддерживается.',
-                'code': 'file_wrong_format',
+                'detail': 'В файле отсутствуют данные.',
+                'code': 'file_empty',
             })
+        report = [
+            {
+                'name': file.name,
+                'rows': file.rows_count,
+                'parse_ms': round(file.seconds * 1000, 1),
+            } for file in parsed
+        ]
+        if dry_run:
+            return Response(
+                {'rows': rows_count, 'files': report, 'dry_run': True},
+                status=status.HTTP_200_OK,
+            )
 
         try:
-            rows_count = self._parse_deals_data_from_csv(data)
+            # слот ограничивает число одновременных загрузок,
+            # лишние получают отказ вместо ожидания в очереди
+            with locks.upload_slot():
+                start = time.perf_counter()
+                if chunk_size:
+                    _, content, text = files[0]
+                    result = ingest.import_deals_chunked(
+                        content, csv.DictReader(text.splitlines()), chunk_size, replace
+                    )
+                else:
+                    # файлы применяются в порядке загрузки, поэтому при повторе
+                    # пары пользователь + таймстамп побеждает более поздний файл
+                    result = ingest.import_rows(
+                        [row for file in parsed for row in file.rows], replace
+                    )
+                write_seconds = time.perf_counter() - start
+        except locks.UploadQueueFull:
+            raise exceptions.UploadQueueFull(wait=locks.upload_retry_after)
         except (KeyError, ValueError) as e:
             raise ValidationError({
                 'detail': f'Ошибка в данных: {e.__class__.__name__} ({e})',
@@ -57,77 +99,272 @@ class DealsUploadView(views.APIView):
                 f'Неизвестная ошибка при обработке файла: {e.__class__.__name__} ({e})'
             )
 
-        if rows_count == 0:
+        # кеши сбрасываются после коммита загрузки по отмеченным
+        # в ней изменениям, как и при любой другой записи данных;
+        # ошибки на этом шаге не влияют на ответ (см. app/deals/changes.py)
+
+        return Response(
+            {
+                'rows': result.rows_count,
+                'files': report,
+                'write_ms': round(write_seconds * 1000, 1),
+            },
+            status=status.HTTP_200_OK,
+        )
+
+    @staticmethod
+    def _read_files(request) -> List[Tuple[str, bytes, str]]:
+        """
+        Загруженные файлы в виде списка (имя, содержимое, текст).
+        Файлов deals может быть несколько, архивы (zip, tar)
+        заменяются содержащимися в них файлами.
+        """
+        uploads = request.FILES.getlist('deals')
+        if not uploads:
+            raise ValidationError({
+                    'detail': 'Отсутствует файл со сделками.',
+                    'code': 'file_missing',
+                })
+
+        files = []
+        try:
+            for upload in uploads:
+                for name, content in archives.expand(upload.name, upload.read()):
+                    files.append((name, content, content.decode('utf-8')))
+        except (UnicodeDecodeError, AttributeError, archives.ArchiveError):
+            raise ValidationError({
+                'detail': 'Формат файла не поддерживается.',
+                'code': 'file_wrong_format',
+            })
+
+        if not any(text for _, _, text in files):
             raise ValidationError({
                 'detail': 'В файле отсутствуют данные.',
                 'code': 'file_empty',
             })
+        return files
+
+    @staticmethod
+    def _check_errors(parsed: List[parsing.ParsedFile]) -> None:
+        """Отклоняет загрузку, если в каком-либо из файлов есть ошибки."""
+        corrupt = [file for file in parsed if file.errors_count]
+        if not corrupt:
+            return
 
-        # успешно импортировали сделки в базу,
-        # нужно очистить кеш страницы с данными о сделках
-        # TODO: В будущем если будут предусмотрены другие способы
-        #       обновления данных (админка, скрипт, др.), то логично будет
-        #       повесить очищение кэша на сигнал при сохранении моделей.
-        cache.delete_many(
-            keys=cache.keys(f'*{const.top_customers_cache_key_prefix}*')
+        raise exceptions.FileCorruptData(
+            detail=f'Ошибки в данных файлов: {", ".join(file.name for file in corrupt)}.',
+            errors=[
+                {
+                    'file': file.name,
+                    'line': error.line,
+                    'column': error.column,
+                    'message': error.message,
+                } for file in corrupt for error in file.errors
+            ],
+            errors_count=sum(file.errors_count for file in corrupt),
         )
 
-        return Response(status=status.HTTP_200_OK)
+    @staticmethod
+    def _get_dry_run(request) -> bool:
+        """
+        Режим проверки (параметр dry_run=1): файлы проверяются
+        без записи в базу, в ответе - только отчет о проверке.
+        """
+        dry_run = request.query_params.get(const.deals_upload_dry_run_param, '0')
+        if dry_run not in ('0', '1'):
+            raise ValidationError({
+                'detail': 'Параметр dry_run принимает значения 0 или 1.',
+                'code': 'invalid_dry_run',
+            })
+        return dry_run == '1'
+
+    @staticmethod
+    def _get_replace_mode(request) -> bool:
+        """
+        Режим загрузки (параметр mode):
+        - append (по умолчанию) - сделки файла дополняют и исправляют имеющиеся;
+        - replace - сделки файла полностью заменяют ранее загруженные.
+        """
+        mode = request.query_params.get(
+            const.deals_upload_mode_param, const.deals_upload_mode_append
+        )
+        if mode not in (const.deals_upload_mode_append, const.deals_upload_mode_replace):
+            raise ValidationError({
+                'detail': f'Неизвестный режим загрузки: {mode}.',
+                'code': 'invalid_mode',
+            })
+        return mode == const.deals_upload_mode_replace
 
     @staticmethod
-    def _parse_deals_data_from_csv(data: csv.DictReader) -> int:
+    def _get_chunk_size(request) -> Optional[int]:
         """
-        Логика сохранения информации о сделках.
-        Возвращает количество обработанных записей.
+        Размер пачки для поэтапного импорта (параметр chunk_size).
+        Если параметр не указан, файл импортируется одной транзакцией.
         """
-        row_counter = 0
-        with transaction.atomic():
-            for row in data:
-                # TODO: если будет нужна оптимизация, можно сделать следующим образом:
-                #       1) составить список всех имен в файле
-                #       2) одним запросом определить, какие имена отсутсвуют
-                #       3) добавить в базу отсутствующие
-                #       (аналогично для камней)
-                customer = Customer.objects.get_or_create(username=row['customer'])[0]
-                customer.save()
-
-                item = Gem.objects.get_or_create(name=row['item'])[0]
-                item.save()
-
-                # Если в базе уже имеется сделка по паре пользователь + таймстамп,
-                # то считаем новые данные исправлением и перезаписываем данные из БД.
-                # TODO: уточнить у заказчика, возможно несколько валидных сделок
-                #       могут провести по одному таймстампу. В таком случае все сделки
-                #       нужно будет считать правильными и сохранять.
-                deal = Deal.objects.update_or_create(
-                    customer=customer,
-                    date=datetime.datetime.fromisoformat(row['date']),
-                    defaults={
-                        'item': item,
-                        'total_cost': row['total'],
-                        'quantity': row['quantity'],
-                    }
-                )[0]
-                deal.save()
-                row_counter += 1
-        return row_counter
+        chunk_size = request.query_params.get(const.deals_upload_chunk_size_param)
+        if chunk_size is None:
+            return None
+
+        try:
+            chunk_size = int(chunk_size)
+        except ValueError:
+            chunk_size = 0
+        if chunk_size <= 0:
+            raise ValidationError({
+                'detail': 'Размер пачки должен быть положительным числом.',
+                'code': 'invalid_chunk_size',
+            })
+        return chunk_size
+
+
+def top_customers_etag(request, *args, **kwargs) -> str:
+    """
+    ETag списка топовых покупателей: поколение строк сделок и нормализованный
+    лимит (некорректный или отсутствующий лимит дает лимит по умолчанию).
+    Поколение данных (generation.deals) не подходит: оно меняется, только
+    если могли измениться рейтинги, которые еще есть в кеше.
+    """
+    limit = SimpleLimitPagination().get_limit(request)
+    return f'{generation.get(generation.rows)}-{limit}'
+
+
+def top_customers_last_modified(request, *args, **kwargs) -> Optional[datetime.datetime]:
+    """Время последнего изменения сделок."""
+    return generation.modified(generation.rows)
 
 
 class TopCustomersView(generics.ListAPIView):
     """Эндпоинт для отображение наиболее потратившихся покупателей."""
     serializer_class = serializers.TopCustomersSerializer
     pagination_class = SimpleLimitPagination
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]
 
+    # условный GET проверяется до кеша страниц: для 304 достаточно
+    # сверить ETag с поколением строк сделок, не трогая ни кеш, ни базу
+    @method_decorator(condition(
+        etag_func=top_customers_etag,
+        last_modified_func=top_customers_last_modified,
+    ))
+    @method_decorator(cache_status)
     @method_decorator(cache_page(
         const.top_customers_cache_key_duration,
         key_prefix=const.top_customers_cache_key_prefix
     ))
-    def get(self, *args, **kwargs):
-        return super().get(*args, **kwargs)
+    def get(self, request, *args, **kwargs):
+        mark_cache_miss(request)
+        with routers.read_from_replica():
+            return super().get(request, *args, **kwargs)
+
+    def list(self, request, *args, **kwargs):
+        # при включенном общем файле рейтинга или колоночном движке
+        # рейтинг и общие камни берутся из памяти, без запросов к базе
+        ranking_file = shared_ranking.get()
+        snapshot = None if ranking_file is not None else columnar.snapshot()
+
+        limit = self.paginator.get_limit(request)
+        if ranking_file is not None:
+            top = ranking_file.ranking(limit)
+        elif snapshot is not None:
+            top = snapshot.ranking(limit)
+        else:
+            top = payloads.ranking(self.get_queryset(), limit)
+
+        # для JSON ответ строится из простых кортежей, минуя сериализатор;
+        # веб-морда DRF использует обычный путь через сериализатор
+        if not isinstance(request.accepted_renderer, JSONRenderer):
+            response = super().list(request, *args, **kwargs)
+        else:
+            customer_ids = [customer_id for customer_id, _, _ in top]
+            if ranking_file is not None:
+                gems = ranking_file.shared_gems(len(top))
+            elif snapshot is not None:
+                gems = snapshot.shared_gems(customer_ids)
+            else:
+                gems = payloads.shared_gems(customer_ids)
+            response = Response({'response': payloads.top_customers(top, gems)})
+
+        # рейтинг, по которому построена страница, кешируется вместе с ней
+        # для выборочной инвалидации кеша при загрузке сделок
+        invalidation.remember_ranking(response, limit, top)
+        return response
 
     def get_queryset(self):
+        # при равных суммах порядок определяется id покупателя
         qs = Customer.objects.annotate(
-            spent_money=Sum('deals__total_cost', default=0),
-        ).order_by('-spent_money')
+            spent_money=Sum('deals__total_cost_cents', default=0),
+        ).order_by('-spent_money', 'id')
 
         return qs
+
+
+def gem_stats_ordering(request) -> str:
+    """Сортировка статистики камней из параметра ordering."""
+    ordering = request.query_params.get(
+        const.gem_stats_ordering_param, const.gem_stats_ordering_default
+    )
+    if ordering.removeprefix('-') not in const.gem_stats_ordering_fields:
+        raise ValidationError({
+            'detail': f'Неизвестное поле сортировки: {ordering}.',
+            'code': 'invalid_ordering',
+        })
+    return ordering
+
+
+def gem_stats_etag(request, *args, **kwargs) -> str:
+    """
+    ETag статистики камней: поколение статистики, сортировка
+    и нормализованный лимит.
+    """
+    ordering = request.query_params.get(
+        const.gem_stats_ordering_param, const.gem_stats_ordering_default
+    )
+    limit = GemStatsPagination().get_limit(request)
+    return f'{generation.get(generation.stats)}-{ordering}-{limit}'
+
+
+def gem_stats_last_modified(request, *args, **kwargs) -> Optional[datetime.datetime]:
+    """Время последнего изменения статистики."""
+    return generation.modified(generation.stats)
+
+
+class GemStatsView(generics.ListAPIView):
+    """
+    Эндпоинт сводной статистики по камням: выручка, количество,
+    число сделок и различных покупателей. Данные берутся из таблицы
+    статистики, которую поддерживает импорт сделок.
+    """
+    serializer_class = serializers.GemStatsSerializer
+    pagination_class = GemStatsPagination
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]
+
+    @method_decorator(condition(
+        etag_func=gem_stats_etag,
+        last_modified_func=gem_stats_last_modified,
+    ))
+    def get(self, *args, **kwargs):
+        with routers.read_from_replica():
+            return super().get(*args, **kwargs)
+
+    def list(self, request, *args, **kwargs):
+        # ответ кешируется по поколению статистики: после изменения
+        # данных ключ меняется, а прежние записи истекают сами
+        ordering = gem_stats_ordering(request)
+        limit = self.paginator.get_limit(request)
+        key = (
+            f'{const.gem_stats_cache_key_prefix}:'
+            f'{generation.get(generation.stats)}:{ordering}:{limit}'
+        )
+
+        data = cache.get(key)
+        if data is None:
+            queryset = self.get_queryset().order_by(ordering, 'gem_id')[:limit]
+            data = self.get_serializer(queryset, many=True).data
+            cache.set(key, data, const.gem_stats_cache_key_duration)
+        return Response({'response': data})
+
+    def get_queryset(self):
+        # камни без сделок (например, после исправлений) не выводятся
+        return GemStats.objects.filter(deals_count__gt=0).annotate(
+            name=F('gem__name'),
+            revenue=F('revenue_cents'),
+        )
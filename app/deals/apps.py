@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class DealsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'app.deals'
+
+    def ready(self):
+        from app.deals import signals  # noqa: F401
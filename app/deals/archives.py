@@ -0,0 +1,69 @@
+"""Распаковка загруженных архивов (zip, tar) с csv-файлами сделок."""
+import io
+import posixpath
+import tarfile
+import zipfile
+from typing import List, Tuple
+
+# суммарный размер распакованных файлов одного архива
+max_unpacked_size = 1024 ** 3
+
+
+class ArchiveError(Exception):
+    """Архив поврежден или слишком велик."""
+
+
+def expand(name: str, content: bytes) -> List[Tuple[str, bytes]]:
+    """
+    Возвращает файлы архива в виде списка (имя, содержимое),
+    упорядоченного по именам файлов внутри архива. Имена файлов
+    предваряются именем архива. Если content не является архивом,
+    возвращается сам файл.
+    """
+    try:
+        if zipfile.is_zipfile(io.BytesIO(content)):
+            members = _expand_zip(io.BytesIO(content))
+        elif tarfile.is_tarfile(io.BytesIO(content)):
+            members = _expand_tar(io.BytesIO(content))
+        else:
+            return [(name, content)]
+    except (zipfile.BadZipFile, tarfile.TarError, EOFError, OSError) as e:
+        raise ArchiveError(f'{name}: {e}')
+
+    return [
+        (f'{name}/{member}', data)
+        for member, data in sorted(members, key=lambda member: member[0])
+    ]
+
+
+def _is_hidden(path: str) -> bool:
+    # служебные файлы архиваторов: __MACOSX/, .DS_Store и т.п.
+    return any(part.startswith(('.', '__MACOSX')) for part in path.split('/'))
+
+
+def _expand_zip(buffer: io.BytesIO) -> List[Tuple[str, bytes]]:
+    with zipfile.ZipFile(buffer) as archive:
+        infos = [
+            info for info in archive.infolist()
+            if not info.is_dir() and not _is_hidden(info.filename)
+        ]
+        _check_size(sum(info.file_size for info in infos))
+        return [(info.filename, archive.read(info)) for info in infos]
+
+
+def _expand_tar(buffer: io.BytesIO) -> List[Tuple[str, bytes]]:
+    with tarfile.open(fileobj=buffer) as archive:
+        members = [
+            member for member in archive.getmembers()
+            if member.isfile() and not _is_hidden(posixpath.normpath(member.name))
+        ]
+        _check_size(sum(member.size for member in members))
+        return [
+            (member.name, archive.extractfile(member).read())
+            for member in members
+        ]
+
+
+def _check_size(size: int) -> None:
+    if size > max_unpacked_size:
+        raise ArchiveError(f'распакованные файлы превышают {max_unpacked_size} байт')
@@ -0,0 +1,57 @@
+"""
+Общие функции нагрузочных команд bench_load и loadtest:
+разбор адреса сервера, запрос по постоянному HTTP-соединению
+и перцентили задержек.
+"""
+import http.client
+import time
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import SplitResult, urlsplit
+
+from django.core.management.base import CommandError
+
+
+def parse_url(value: str) -> SplitResult:
+    """Адрес запущенного сервера вида http://host:port."""
+    url = urlsplit(value)
+    if url.scheme != 'http' or not url.hostname:
+        raise CommandError('Ожидается адрес вида http://host:port.')
+    return url
+
+
+def request(connection: http.client.HTTPConnection,
+            method: str,
+            path: str,
+            body: Optional[bytes] = None,
+            headers: Optional[Dict[str, str]] = None) -> Tuple[str, Optional[str], float]:
+    """
+    Выполняет запрос по постоянному соединению. Возвращает код ответа
+    (или имя исключения при сетевой ошибке), заголовок X-Cache
+    и задержку в миллисекундах. После ошибки соединение закрывается,
+    следующий запрос откроет его заново.
+    """
+    start = time.perf_counter()
+    try:
+        connection.request(method, path, body=body, headers={
+            'Accept': 'application/json', **(headers or {}),
+        })
+        response = connection.getresponse()
+        response.read()
+    except (OSError, http.client.HTTPException) as e:
+        connection.close()
+        return e.__class__.__name__, None, (time.perf_counter() - start) * 1000
+    return (
+        str(response.status),
+        response.getheader('X-Cache'),
+        (time.perf_counter() - start) * 1000,
+    )
+
+
+def is_success(status: str) -> bool:
+    """Успешный ответ (2xx или 3xx), а не ошибка или сетевой сбой."""
+    return status.startswith(('2', '3'))
+
+
+def percentile(sorted_timings: List[float], percent: int) -> float:
+    index = min(len(sorted_timings) - 1, len(sorted_timings) * percent // 100)
+    return sorted_timings[index]
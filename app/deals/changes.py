@@ -0,0 +1,171 @@
+"""
+Отслеживание изменений покупателей, камней и сделок.
+
+Любая запись - сохранение и удаление объектов (сигналы моделей,
+см. app/deals/signals.py) и массовые операции QuerySet (TrackedQuerySet) -
+отмечает изменение данных в текущей транзакции. Изменения транзакции
+накапливаются в одном объекте Changes, и после коммита отправляется
+один сигнал committed, сколько бы строк ни изменилось: по нему
+сбрасываются кеши и пересчитывается статистика камней. При откате
+изменения отбрасываются вместе с on_commit-колбэками транзакции.
+Данные к этому моменту уже зафиксированы, поэтому ошибки получателей
+сигнала (например, недоступен redis) только логируются Django
+и не доходят до кода, выполнившего запись.
+
+Загрузка сделок (app/deals/ingest.py) знает об изменениях больше:
+она сама сообщает точные изменения сумм по покупателям и поддерживает
+статистику камней, а ее собственные массовые операции не отслеживаются
+(untracked).
+"""
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, Optional, Set
+
+from django.db import DEFAULT_DB_ALIAS, models, transaction
+from django.dispatch import Signal
+
+# отправляется после коммита транзакции, изменившей данные (аргумент changes)
+committed = Signal()
+
+# атрибут соединения с изменениями его текущей транзакции
+_pending_attr = 'deals_changes'
+
+_local = threading.local()
+
+
+class Changes:
+    """Изменения данных, накопленные за одну транзакцию."""
+
+    def __init__(self):
+        # изменения сумм по id покупателей, None - неизвестны
+        # (кеши топа сбрасываются целиком)
+        self.spend_deltas: Optional[Dict[int, int]] = {}
+        # камни, статистику которых нужно пересчитать по сделкам, None - все
+        self.gem_ids: Optional[Set[int]] = set()
+        # изменились имена справочников (переименование, удаление)
+        self.names = False
+        self.sent = False
+
+    def add(self,
+            spend_deltas: Optional[Dict[int, int]],
+            gem_ids: Optional[Iterable[int]],
+            names: bool) -> None:
+        if spend_deltas is None or self.spend_deltas is None:
+            self.spend_deltas = None
+        else:
+            for customer_id, delta in spend_deltas.items():
+                self.spend_deltas[customer_id] = self.spend_deltas.get(customer_id, 0) + delta
+        if gem_ids is None or self.gem_ids is None:
+            self.gem_ids = None
+        else:
+            self.gem_ids.update(gem_ids)
+        self.names = self.names or names
+
+    def send(self) -> None:
+        self.sent = True
+        committed.send_robust(sender=Changes, changes=self)
+
+
+def _is_pending(connection, changes: Optional[Changes]) -> bool:
+    """Зарегистрирована ли отправка changes в текущей транзакции соединения."""
+    if changes is None or changes.sent or not connection.in_atomic_block:
+        return False
+    # колбэки откаченной транзакции или точки сохранения удаляются из списка
+    return any(entry[1] == changes.send for entry in connection.run_on_commit)
+
+
+def changed(spend_deltas: Optional[Dict[int, int]] = None,
+            gem_ids: Optional[Iterable[int]] = (),
+            names: bool = False,
+            using: str = DEFAULT_DB_ALIAS) -> None:
+    """
+    Отмечает изменение данных в текущей транзакции.
+    spend_deltas - изменения сумм по id покупателей (None - неизвестны),
+    gem_ids - камни, статистику которых нужно пересчитать (None - все),
+    names - изменились имена справочников.
+    Вне транзакции изменения отправляются сразу, поэтому отмечать их
+    нужно после записи.
+    """
+    connection = transaction.get_connection(using)
+    changes = getattr(connection, _pending_attr, None)
+    if _is_pending(connection, changes):
+        changes.add(spend_deltas, gem_ids, names)
+        return
+
+    changes = Changes()
+    changes.add(spend_deltas, gem_ids, names)
+    setattr(connection, _pending_attr, changes if connection.in_atomic_block else None)
+    transaction.on_commit(changes.send, using=using, robust=True)
+
+
+def is_tracked() -> bool:
+    return not getattr(_local, 'untracked', 0)
+
+
+@contextmanager
+def untracked() -> Iterator[None]:
+    """
+    Отключает отслеживание записей в текущем потоке.
+    Код внутри блока сам сообщает об изменениях через changed().
+    """
+    _local.untracked = getattr(_local, 'untracked', 0) + 1
+    try:
+        yield
+    finally:
+        _local.untracked -= 1
+
+
+class TrackedQuerySet(models.QuerySet):
+    """
+    QuerySet, массовые операции которого отмечают изменение данных.
+    Что именно изменилось, модель уточняет в changes_of(). Изменения
+    отмечаются в одной транзакции с операцией, до нее: после операции
+    затронутые строки уже не найти.
+    """
+
+    def changes_of(self,
+                   operation: str,
+                   objs: Optional[list] = None,
+                   fields: Iterable[str] = ()) -> dict:
+        """
+        Аргументы changed() для массовой операции operation (имя метода):
+        над объектами objs (bulk_create, bulk_update) или над строками
+        QuerySet (update, delete). fields - изменяемые поля.
+        """
+        return {}
+
+    def _track(self, operation: str, objs: Optional[list] = None, fields: Iterable[str] = ()) -> None:
+        if is_tracked():
+            changed(using=self.db, **self.changes_of(operation, objs, fields))
+
+    def update(self, **kwargs):
+        with transaction.atomic(using=self.db, savepoint=False):
+            self._track('update', fields=kwargs)
+            return super().update(**kwargs)
+
+    update.alters_data = True
+
+    def delete(self):
+        with transaction.atomic(using=self.db, savepoint=False):
+            self._track('delete')
+            # удаление уже учтено целиком, сигналы удаления
+            # отдельных объектов его не уточняют
+            with untracked():
+                return super().delete()
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        with transaction.atomic(using=self.db, savepoint=False):
+            self._track('bulk_create', objs=objs)
+            return super().bulk_create(objs, *args, **kwargs)
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        objs = list(objs)
+        with transaction.atomic(using=self.db, savepoint=False):
+            self._track('bulk_update', objs=objs, fields=fields)
+            return super().bulk_update(objs, fields, *args, **kwargs)
+
+    bulk_update.alters_data = True
@@ -0,0 +1,369 @@
+"""
+Колоночный движок рейтинга покупателей в памяти воркера.
+
+Сделки загружаются в компактные массивы NumPy (индекс покупателя,
+id камня, сумма в копейках, время в микросекундах от эпохи), по которым
+рейтинг и общие камни считаются векторно, без запросов к базе.
+Движок необязателен: он включается настройкой DEALS_COLUMNAR_ENGINE
+и требует установленного numpy. Numpy импортируется при первом
+обращении к движку, чтобы не замедлять запуск воркеров без него.
+
+Снимок данных обновляется по поколению строк сделок (generation.rows,
+его меняет app/deals/signals.py после каждого коммита, изменившего данные).
+Для каждого поколения в общий кеш записываются id затронутых покупателей,
+и при обновлении перечитываются только их сделки. Если журнал изменений
+неполон, загрузка была полной заменой или удалялись записи справочников,
+снимок перечитывается целиком.
+
+Результаты совпадают с запросами ORM (payloads.ranking, payloads.shared_gems),
+включая порядок покупателей с равными суммами (по id).
+"""
+import datetime
+import importlib.util
+import threading
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from app.deals import generation, ingest
+from app.deals.models import Customer, Deal, Gem
+
+# модуль numpy после import_numpy()
+np = None
+
+# журнал изменений: сколько хранить и сколько шагов применять
+# инкрементально (дальше дешевле перечитать все)
+changes_timeout = 24 * 60 * 60
+max_incremental_steps = 100
+
+# размер пачки строк при чтении сделок из базы
+load_batch_size = 100_000
+
+_epoch = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_microsecond = datetime.timedelta(microseconds=1)
+
+
+def import_numpy():
+    """Импортирует numpy при первом вызове; None, если он не установлен."""
+    global np
+    if np is None and importlib.util.find_spec('numpy') is not None:
+        import numpy
+        np = numpy
+    return np
+
+
+def _changes_key(rows_generation: int) -> str:
+    return f'{generation.rows}:changes:{rows_generation}'
+
+
+def record_changes(rows_generation: int, customer_ids: Optional[Iterable[int]]) -> None:
+    """
+    Записывает в журнал изменений id покупателей, затронутых изменением,
+    которое дало поколение строк rows_generation (None - изменились все данные).
+    """
+    cache.set(
+        _changes_key(rows_generation),
+        None if customer_ids is None else sorted(customer_ids),
+        changes_timeout,
+    )
+
+
+def to_epoch_us(date: datetime.datetime) -> int:
+    """Время в микросекундах от эпохи (точно, без округления float)."""
+    return (date - _epoch) // _microsecond
+
+
+class Snapshot(NamedTuple):
+    """Неизменяемый снимок сделок в колоночном виде."""
+    rows_generation: int
+    names_generation: int
+    # id покупателей по возрастанию и их имена
+    customer_ids: 'np.ndarray'
+    usernames: List[str]
+    # названия камней по id
+    gem_names: Dict[int, str]
+    # колонки сделок
+    customer_idx: 'np.ndarray'
+    item_ids: 'np.ndarray'
+    cents: 'np.ndarray'
+    epoch_us: 'np.ndarray'
+
+    @property
+    def nbytes(self) -> int:
+        """Объем массивов снимка в байтах (без имен)."""
+        return sum(
+            array.nbytes for array in (
+                self.customer_ids, self.customer_idx,
+                self.item_ids, self.cents, self.epoch_us,
+            )
+        )
+
+    def spent(self,
+              date_from: Optional[datetime.datetime] = None,
+              date_to: Optional[datetime.datetime] = None,
+              item_ids: Optional[Iterable[int]] = None) -> 'np.ndarray':
+        """
+        Потраченная сумма каждого покупателя (в порядке customer_ids)
+        по сделкам в интервале [date_from, date_to) и с камнями из item_ids.
+        """
+        mask = None
+        if date_from is not None:
+            mask = self.epoch_us >= to_epoch_us(date_from)
+        if date_to is not None:
+            mask = _and(mask, self.epoch_us < to_epoch_us(date_to))
+        if item_ids is not None:
+            mask = _and(mask, np.isin(self.item_ids, np.fromiter(item_ids, np.int64)))
+
+        customer_idx, cents = self.customer_idx, self.cents
+        if mask is not None:
+            customer_idx, cents = customer_idx[mask], cents[mask]
+
+        size = len(self.customer_ids)
+        # bincount суммирует во float64: точно, пока модуль
+        # любой частичной суммы меньше 2 ** 53
+        if np.abs(cents).sum(dtype=np.float64) < 2 ** 52:
+            return np.bincount(customer_idx, weights=cents, minlength=size).astype(np.int64)
+        spent = np.zeros(size, dtype=np.int64)
+        np.add.at(spent, customer_idx, cents)
+        return spent
+
+    def ranking(self, limit: int, **filters) -> List[tuple]:
+        """
+        Первые limit строк рейтинга (id, имя, сумма в копейках),
+        как payloads.ranking: по убыванию суммы, при равенстве по id.
+        Фильтры - как в spent().
+        """
+        spent = self.spent(**filters)
+        size = len(spent)
+        if limit <= 0 or size == 0:
+            return []
+
+        if limit < size:
+            # порог - limit-я по величине сумма; покупатели на пороге
+            # упорядочиваются по id вместе с остальными кандидатами
+            threshold = np.partition(spent, size - limit)[size - limit]
+            candidates = np.flatnonzero(spent >= threshold)
+        else:
+            candidates = np.arange(size)
+        # индексы упорядочены по id покупателя, поэтому
+        # вторичный ключ сортировки - сам индекс
+        order = candidates[np.lexsort((candidates, -spent[candidates]))][:limit]
+
+        return list(zip(
+            self.customer_ids[order].tolist(),
+            [self.usernames[i] for i in order.tolist()],
+            spent[order].tolist(),
+        ))
+
+    def shared_gems(self, customer_ids: List[int]) -> Dict[int, List[str]]:
+        """
+        Камни, которые есть как минимум у двух покупателей из списка,
+        по id покупателей (в порядке id камней), как payloads.shared_gems.
+        """
+        mask = np.isin(self.customer_idx, _positions(self.customer_ids, customer_ids))
+        pairs = np.unique(np.stack([
+            self.customer_idx[mask].astype(np.int64), self.item_ids[mask],
+        ]), axis=1)
+        if not pairs.size:
+            return {}
+
+        gems, owners = np.unique(pairs[1], return_counts=True)
+        shared = np.isin(pairs[1], gems[owners >= 2])
+
+        result = {}
+        # пары упорядочены по индексу покупателя, затем по id камня
+        for idx, item_id in pairs[:, shared].T.tolist():
+            result.setdefault(int(self.customer_ids[idx]), []).append(self.gem_names[item_id])
+        return result
+
+
+def _and(mask, other):
+    return other if mask is None else mask & other
+
+
+def _positions(sorted_ids: 'np.ndarray', ids: Iterable[int]) -> 'np.ndarray':
+    """Позиции присутствующих в sorted_ids значений из ids."""
+    ids = np.asarray(list(ids), dtype=np.int64)
+    positions = np.searchsorted(sorted_ids, ids)
+    found = positions < len(sorted_ids)
+    found[found] = sorted_ids[positions[found]] == ids[found]
+    return positions[found]
+
+
+def _columns(rows: 'np.ndarray', customer_ids: 'np.ndarray') -> Dict[str, 'np.ndarray']:
+    """Колонки снимка из строк сделок."""
+    return {
+        'customer_idx': np.searchsorted(customer_ids, rows[:, 0]).astype(np.int32),
+        'item_ids': np.ascontiguousarray(rows[:, 1]),
+        'cents': np.ascontiguousarray(rows[:, 2]),
+        'epoch_us': np.ascontiguousarray(rows[:, 3]),
+    }
+
+
+class Engine:
+    """Снимок сделок процесса с обновлением по поколению."""
+
+    def __init__(self, using: str = DEFAULT_DB_ALIAS):
+        # снимок читается из основной базы: реплика может отставать
+        # от поколения, и отставание закрепилось бы в снимке
+        self.using = using
+        self._snapshot: Optional[Snapshot] = None
+        self._lock = threading.Lock()
+
+    def snapshot(self) -> Snapshot:
+        """Актуальный снимок; при необходимости обновляется."""
+        import_numpy()
+        rows_generation = generation.get(generation.rows)
+        names_generation = generation.get(generation.names)
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.rows_generation == rows_generation \
+                and snapshot.names_generation == names_generation:
+            return snapshot
+
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None or snapshot.names_generation != names_generation:
+                snapshot = self.load(rows_generation, names_generation)
+            elif snapshot.rows_generation != rows_generation:
+                snapshot = self.refresh(snapshot, rows_generation)
+            self._snapshot = snapshot
+        return snapshot
+
+    def refresh(self, snapshot: Snapshot, rows_generation: int) -> Snapshot:
+        """Применяет журнал изменений к снимку."""
+        steps = range(snapshot.rows_generation + 1, rows_generation + 1)
+        keys = [_changes_key(step) for step in steps]
+        changes = cache.get_many(keys) if 0 < len(keys) <= max_incremental_steps else {}
+
+        if len(changes) != len(keys) or any(ids is None for ids in changes.values()):
+            return self.load(rows_generation, snapshot.names_generation)
+
+        touched = sorted({customer_id for ids in changes.values() for customer_id in ids})
+        return self._merge(snapshot, rows_generation, touched)
+
+    def load(self, rows_generation: int, names_generation: int) -> Snapshot:
+        """Полностью перечитывает сделки из базы."""
+        import_numpy()
+        # сделки читаются раньше справочников: покупатель и камень
+        # каждой прочитанной сделки уже зафиксированы в базе
+        rows = self._read_rows()
+        customers = list(
+            Customer.objects.using(self.using).order_by('id').values_list('id', 'username')
+        )
+        customer_ids = np.fromiter((id_ for id_, _ in customers), np.int64, len(customers))
+        return Snapshot(
+            rows_generation=rows_generation,
+            names_generation=names_generation,
+            customer_ids=customer_ids,
+            usernames=[username for _, username in customers],
+            gem_names=dict(Gem.objects.using(self.using).values_list('id', 'name')),
+            **_columns(rows, customer_ids),
+        )
+
+    def _merge(self, snapshot: Snapshot, rows_generation: int, touched: List[int]) -> Snapshot:
+        """Перечитывает сделки затронутых покупателей."""
+        rows = self._read_rows(touched)
+
+        customer_ids, usernames = snapshot.customer_ids, snapshot.usernames
+        customer_idx = snapshot.customer_idx
+        candidates = np.union1d(np.asarray(touched, dtype=np.int64), rows[:, 0])
+        new = candidates[~np.isin(candidates, customer_ids)]
+        if new.size:
+            # новые покупатели: объединяем справочник и пересчитываем индексы
+            names = dict(zip(customer_ids.tolist(), usernames))
+            names.update(
+                Customer.objects.using(self.using)
+                .filter(id__in=new.tolist())
+                .values_list('id', 'username')
+            )
+            customer_ids = np.fromiter(sorted(names), np.int64, len(names))
+            usernames = [names[id_] for id_ in customer_ids.tolist()]
+            remap = np.searchsorted(customer_ids, snapshot.customer_ids).astype(np.int32)
+            customer_idx = remap[customer_idx]
+
+        keep = ~np.isin(customer_idx, _positions(customer_ids, touched))
+        loaded = _columns(rows, customer_ids)
+
+        gem_names = snapshot.gem_names
+        unknown = set(np.unique(rows[:, 1]).tolist()) - gem_names.keys()
+        if unknown:
+            gem_names = {
+                **gem_names,
+                **dict(
+                    Gem.objects.using(self.using)
+                    .filter(id__in=unknown)
+                    .values_list('id', 'name')
+                ),
+            }
+
+        return snapshot._replace(
+            rows_generation=rows_generation,
+            customer_ids=customer_ids,
+            usernames=usernames,
+            gem_names=gem_names,
+            customer_idx=np.concatenate([customer_idx[keep], loaded['customer_idx']]),
+            item_ids=np.concatenate([snapshot.item_ids[keep], loaded['item_ids']]),
+            cents=np.concatenate([snapshot.cents[keep], loaded['cents']]),
+            epoch_us=np.concatenate([snapshot.epoch_us[keep], loaded['epoch_us']]),
+        )
+
+    def _read_rows(self, customer_ids: Optional[List[int]] = None) -> 'np.ndarray':
+        """
+        Сделки (всех или переданных покупателей) в виде массива строк
+        (id покупателя, id камня, копейки, время в микросекундах).
+        """
+        if customer_ids is None:
+            batches = list(self._read_deals())
+        else:
+            batches = [
+                batch
+                for chunk in ingest.chunks(customer_ids)
+                for batch in self._read_deals(chunk)
+            ]
+        if not batches:
+            return np.empty((0, 4), dtype=np.int64)
+        return np.concatenate(batches)
+
+    def _read_deals(self, customer_ids: Optional[List[int]] = None):
+        """Пачки строк (id покупателя, id камня, копейки, время) из базы."""
+        connection = connections[self.using]
+        if connection.vendor == 'postgresql':
+            # время в микросекундах считает база: так быстрее,
+            # чем создавать объекты datetime в Python
+            sql = (
+                'SELECT customer_id, item_id, total_cost_cents, '
+                '(EXTRACT(EPOCH FROM date) * 1000000)::bigint '
+                f'FROM {Deal._meta.db_table}'
+            )
+            params = []
+            if customer_ids is not None:
+                sql += ' WHERE customer_id = ANY(%s)'
+                params.append(customer_ids)
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                while batch := cursor.fetchmany(load_batch_size):
+                    yield np.array(batch, dtype=np.int64)
+            return
+
+        qs = Deal.objects.using(self.using)
+        if customer_ids is not None:
+            qs = qs.filter(customer_id__in=customer_ids)
+        rows = qs.values_list('customer_id', 'item_id', 'total_cost_cents', 'date')
+        for batch in ingest.chunks(rows.iterator(chunk_size=load_batch_size), load_batch_size):
+            yield np.array(
+                [(c, i, t, to_epoch_us(d)) for c, i, t, d in batch], dtype=np.int64
+            ).reshape(-1, 4)
+
+
+_engine = Engine()
+
+
+def is_enabled() -> bool:
+    return bool(settings.DEALS_COLUMNAR_ENGINE) and import_numpy() is not None
+
+
+def snapshot() -> Optional[Snapshot]:
+    """Снимок сделок процесса или None, если движок выключен."""
+    return _engine.snapshot() if is_enabled() else None
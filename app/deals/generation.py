@@ -0,0 +1,55 @@
+"""
+Счетчики поколений данных.
+
+Хранятся в общем кеше (redis), поэтому одинаково видны всем воркерам.
+Поколение увеличивается при изменении соответствующих данных и служит
+штампом, по которому локальные кеши процессов понимают, что устарели.
+"""
+import datetime
+import time
+from typing import Optional
+
+from django.core.cache import cache
+
+# поколение данных топа покупателей (меняется при загрузке,
+# которая может изменить топ, см. app/deals/api/invalidation.py)
+deals = 'deals_data_generation'
+# поколение строк сделок (меняется после каждого коммита,
+# изменившего данные, см. app/deals/signals.py)
+rows = 'deals_rows_generation'
+# поколение статистики камней (меняется при каждом изменении данных
+# и после пересчета статистики)
+stats = 'deals_stats_generation'
+# поколение справочников покупателей и камней
+# (меняется при удалении записей справочников)
+names = 'deals_names_generation'
+
+
+def get(key: str) -> int:
+    """Текущее значение поколения."""
+    value = cache.get(key)
+    if value is None:
+        # начальное значение уникально, чтобы после потери ключа
+        # в redis поколение не совпало ни с одним из прежних
+        cache.add(key, time.time_ns(), timeout=None)
+        value = cache.get(key)
+    return value
+
+
+def bump(key: str) -> int:
+    """Увеличивает поколение, возвращает новое значение."""
+    try:
+        value = cache.incr(key)
+    except ValueError:
+        get(key)
+        value = cache.incr(key)
+    cache.set(f'{key}:modified', time.time(), timeout=None)
+    return value
+
+
+def modified(key: str) -> Optional[datetime.datetime]:
+    """Время последнего изменения поколения, если оно известно."""
+    timestamp = cache.get(f'{key}:modified')
+    if timestamp is None:
+        return None
+    return datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)
@@ -0,0 +1,456 @@
+"""Логика импорта сделок из csv-файла в базу."""
+import csv
+import datetime
+import hashlib
+from collections import defaultdict
+from itertools import islice
+from typing import (Callable, Dict, Iterable, Iterator, List, NamedTuple,
+                    Optional, Set, Tuple, Type)
+
+from django.db import models, transaction
+from django.utils import timezone
+
+from app.deals import changes, locks, name_cache, shadow, stats
+from app.deals.models import (Customer, Deal, Gem, ImportCheckpoint,
+                              StagedDeal)
+from app.deals.parsing import DealRow, parse_row
+
+# размер пачки для пакетных запросов к базе
+batch_size = 500
+
+
+class ImportResult(NamedTuple):
+    """
+    Итог импорта: количество обработанных записей и изменение
+    потраченной суммы по id покупателей, чьи сделки были затронуты.
+    При полной замене сделок изменения не отслеживаются (None).
+    """
+    rows_count: int
+    spend_deltas: Optional[Dict[int, int]]
+
+
+def chunks(iterable: Iterable, size: int = batch_size) -> Iterator[List]:
+    """Разбивает последовательность на списки длиной не более size."""
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def get_or_create_ids(model: Type[models.Model],
+                      field: str,
+                      names: Set[str]) -> Dict[str, int]:
+    """
+    Возвращает словарь имя -> id для переданных имен,
+    создавая недостающие записи пакетно.
+    Известные id берутся из кеша процесса, в базу идут только остальные.
+    """
+    cache = name_cache.for_model(model)
+    ids, stamp = cache.get_many(names)
+
+    missing = names - ids.keys()
+    for chunk in chunks(sorted(missing)):
+        ids.update(
+            model.objects.filter(**{f'{field}__in': chunk})
+            .values_list(field, 'id')
+        )
+
+    created = names - ids.keys()
+    if created:
+        # ignore_conflicts: запись могла появиться параллельно
+        model.objects.bulk_create(
+            [model(**{field: name}) for name in sorted(created)],
+            batch_size=batch_size,
+            ignore_conflicts=True,
+        )
+        for chunk in chunks(sorted(created)):
+            ids.update(
+                model.objects.filter(**{f'{field}__in': chunk})
+                .values_list(field, 'id')
+            )
+
+    if missing:
+        # в кеш попадают только записи, пережившие коммит
+        resolved = {name: ids[name] for name in missing}
+        transaction.on_commit(lambda: cache.set_many(resolved, stamp))
+    return ids
+
+
+def create_missing_gems(names: Set[str]) -> None:
+    """
+    Пополняет справочник камней до основной транзакции импорта.
+    Камни без сделок ни на что не влияют, поэтому их можно
+    зафиксировать заранее и не держать блокировку справочника
+    на все время записи сделок.
+    """
+    with locks.gems():
+        get_or_create_ids(Gem, 'name', names)
+
+
+@changes.untracked()
+def apply_deals(rows: Iterable[DealRow]) -> Dict[int, int]:
+    """
+    Пакетно сохраняет сделки в базу.
+    Возвращает изменение потраченной суммы (в копейках) по id покупателей,
+    чьи сделки были созданы или перезаписаны.
+    Вызывающий код должен удерживать блокировки корзин покупателей
+    и заранее создать недостающие камни (create_missing_gems).
+
+    Если в базе уже имеется сделка по паре пользователь + таймстамп,
+    то считаем новые данные исправлением и перезаписываем данные из БД.
+    Внутри переданных строк при повторе пары побеждает последняя строка.
+
+    Статистика камней (GemStats) обновляется в той же транзакции,
+    там же отмечаются изменения сумм для сброса кешей после коммита.
+    """
+    # TODO: уточнить у заказчика, возможно несколько валидных сделок
+    #       могут провести по одному таймстампу. В таком случае все сделки
+    #       нужно будет считать правильными и сохранять.
+    latest: Dict[Tuple[str, datetime.datetime], DealRow] = {}
+    for row in rows:
+        latest[row.customer, row.date] = row
+    if not latest:
+        return {}
+
+    customer_ids = get_or_create_ids(
+        Customer, 'username', {row.customer for row in latest.values()}
+    )
+    gem_ids = get_or_create_ids(
+        Gem, 'name', {row.item for row in latest.values()}
+    )
+
+    keys = {(customer_ids[customer], date) for customer, date in latest}
+    existing: Dict[Tuple[int, datetime.datetime], Deal] = {}
+    for chunk in chunks(keys):
+        qs = Deal.objects.filter(
+            customer_id__in={customer_id for customer_id, _ in chunk},
+            date__in={date for _, date in chunk},
+        ).only('id', 'customer_id', 'date', 'item_id', 'total_cost_cents', 'quantity')
+        for deal in qs:
+            existing[deal.customer_id, deal.date] = deal
+
+    to_create, to_update = [], []
+    spend_deltas = defaultdict(int)
+    gem_deltas = defaultdict(stats.GemDelta)
+    for row in latest.values():
+        customer_id = customer_ids[row.customer]
+        deal = existing.get((customer_id, row.date))
+        if deal is None:
+            deal = Deal(customer_id=customer_id, date=row.date)
+            to_create.append(deal)
+        else:
+            spend_deltas[customer_id] -= deal.total_cost_cents
+            gem_deltas[deal.item_id].add(deal.total_cost_cents, deal.quantity, sign=-1)
+            to_update.append(deal)
+        spend_deltas[customer_id] += row.total_cost_cents
+        deal.item_id = gem_ids[row.item]
+        deal.total_cost_cents = row.total_cost_cents
+        deal.quantity = row.quantity
+        gem_deltas[deal.item_id].add(deal.total_cost_cents, deal.quantity)
+
+    # число покупателей камня меняется, только если у затронутого
+    # покупателя появилась первая или исчезла последняя сделка с камнем
+    pairs_before = stats.customer_gems(spend_deltas.keys(), gem_deltas.keys())
+
+    Deal.objects.bulk_create(to_create, batch_size=batch_size)
+    Deal.objects.bulk_update(
+        to_update,
+        fields=['item', 'total_cost_cents', 'quantity'],
+        batch_size=batch_size,
+    )
+
+    pairs_after = stats.customer_gems(spend_deltas.keys(), gem_deltas.keys())
+    stats.count_customers(gem_deltas, pairs_before, pairs_after)
+    stats.apply(gem_deltas)
+    changes.changed(spend_deltas=dict(spend_deltas))
+    return dict(spend_deltas)
+
+
+def merge_deltas(total: Dict[int, int], deltas: Dict[int, int]) -> None:
+    """Добавляет изменения сумм по покупателям к накопленным."""
+    for customer_id, delta in deltas.items():
+        total[customer_id] = total.get(customer_id, 0) + delta
+
+
+def delete_orphans() -> None:
+    """Удаляет покупателей и камни, по которым не осталось сделок."""
+    Customer.objects.filter(deals__isnull=True).delete()
+    Gem.objects.filter(deals__isnull=True).delete()
+
+
+def finish_replace() -> None:
+    """
+    Завершает полную замену сделок одной транзакцией (без теневой
+    таблицы): удаляет записи справочников без сделок, пересчитывает
+    статистику камней и отмечает, что изменились все данные.
+    """
+    delete_orphans()
+    stats.rebuild()
+    changes.changed(names=True)
+
+
+@changes.untracked()
+def replace_deals(rows: Iterable[DealRow],
+                  on_publish: Optional[Callable[[], None]] = None) -> None:
+    """
+    Полностью заменяет сделки в базе переданными.
+
+    На PostgreSQL данные загружаются в теневую таблицу, которая затем
+    атомарно подменяет основную; читатели все это время работают
+    с прежними данными. На остальных СУБД замена выполняется
+    одной транзакцией.
+    on_publish вызывается в транзакции, которая публикует новые данные.
+    """
+    with locks.all_customers(), locks.gems():
+        if shadow.is_supported():
+            _replace_deals_via_shadow(rows, on_publish)
+            return
+
+        with transaction.atomic():
+            Deal.objects.all().delete()
+            for chunk in chunks(rows):
+                apply_deals(chunk)
+            finish_replace()
+            if on_publish is not None:
+                on_publish()
+
+
+def reserve_ids(model: Type[models.Model],
+                field: str,
+                names: Set[str],
+                reserved: Dict[str, int]) -> Dict[str, int]:
+    """
+    Возвращает словарь имя -> id для переданных имен, не создавая записей:
+    недостающим именам выделяются id, которые накапливаются в reserved,
+    а сами записи создает create_reserved().
+    """
+    ids, _ = name_cache.for_model(model).get_many(names)
+    missing = names - ids.keys() - reserved.keys()
+    for chunk in chunks(sorted(missing)):
+        ids.update(
+            model.objects.filter(**{f'{field}__in': chunk})
+            .values_list(field, 'id')
+        )
+
+    created = sorted(names - ids.keys() - reserved.keys())
+    reserved.update(zip(created, shadow.reserve_ids(model, len(created))))
+    ids.update((name, reserved[name]) for name in names if name in reserved)
+    return ids
+
+
+def create_reserved(model: Type[models.Model], field: str, reserved: Dict[str, int]) -> None:
+    """Создает записи справочника с id, выделенными reserve_ids()."""
+    model.objects.bulk_create(
+        [model(id=id_, **{field: name}) for name, id_ in reserved.items()],
+        batch_size=batch_size,
+    )
+
+
+def delete_ids(model: Type[models.Model], ids: List[int]) -> None:
+    """Удаляет записи справочника по списку id."""
+    for chunk in chunks(ids):
+        model.objects.filter(id__in=chunk).delete()
+
+
+def _replace_deals_via_shadow(rows: Iterable[DealRow],
+                              on_publish: Optional[Callable[[], None]] = None) -> None:
+    """
+    Замена сделок через теневую таблицу (PostgreSQL).
+
+    Подменяются таблицы сделок и статистики камней (статистика строится
+    по теневой таблице сделок), покупатели и камни изменяются на месте
+    в транзакции подмены. Новые записи справочников получают id заранее,
+    а записи без сделок находятся по теневой таблице до подмены, поэтому
+    под блокировкой подмены нет проходов по сделкам.
+    """
+    # новые покупатели и камни создаются только в транзакции подмены:
+    # до нее они появились бы в топе без сделок, а при ошибке остались бы в базе
+    new_customers: Dict[str, int] = {}
+    new_gems: Dict[str, int] = {}
+    orphans: Dict[Type[models.Model], List[int]] = {}
+
+    def on_swap():
+        create_reserved(Customer, 'username', new_customers)
+        create_reserved(Gem, 'name', new_gems)
+        for model, ids in orphans.items():
+            delete_ids(model, ids)
+        changes.changed(names=True)
+        if on_publish is not None:
+            on_publish()
+
+    shadow.create()
+    try:
+        for chunk in chunks(rows):
+            customer_ids = reserve_ids(
+                Customer, 'username', {row.customer for row in chunk}, new_customers
+            )
+            gem_ids = reserve_ids(Gem, 'name', {row.item for row in chunk}, new_gems)
+            shadow.insert(
+                (
+                    customer_ids[row.customer],
+                    gem_ids[row.item],
+                    row.total_cost_cents,
+                    row.quantity,
+                    row.date,
+                ) for row in chunk
+            )
+        shadow.deduplicate()
+        # справочники не меняются до подмены: загрузки
+        # и пополнение камней ждут блокировок замены
+        orphans[Customer] = shadow.orphan_ids(Customer, 'customer')
+        orphans[Gem] = shadow.orphan_ids(Gem, 'item')
+        shadow.build_stats()
+        shadow.swap(on_swap=on_swap)
+    except Exception:
+        shadow.drop()
+        raise
+
+
+def import_deals(data: csv.DictReader, replace: bool = False) -> ImportResult:
+    """
+    Импортирует сделки одной транзакцией.
+    При replace=True ранее загруженные сделки заменяются данными файла.
+    """
+    return import_rows([parse_row(row) for row in data], replace)
+
+
+@changes.untracked()
+def import_rows(rows: List[DealRow], replace: bool = False) -> ImportResult:
+    """
+    Импортирует разобранные строки одной транзакцией.
+    При повторе пары пользователь + таймстамп побеждает последняя строка.
+    """
+    if replace:
+        replace_deals(rows)
+        return ImportResult(len(rows), None)
+
+    create_missing_gems({row.item for row in rows})
+    with locks.customers({row.customer for row in rows}), transaction.atomic():
+        spend_deltas = apply_deals(rows)
+    return ImportResult(len(rows), spend_deltas)
+
+
+@changes.untracked()
+def import_deals_chunked(content: bytes,
+                         data: csv.DictReader,
+                         chunk_size: int,
+                         replace: bool = False) -> ImportResult:
+    """
+    Поэтапный импорт сделок для больших файлов.
+
+    Строки файла фиксируются в staging-таблице пачками по chunk_size,
+    после каждой пачки сохраняется контрольная точка. Повторная загрузка
+    того же файла продолжает работу с последней зафиксированной строки.
+    В основные таблицы данные попадают одной транзакцией при публикации,
+    поэтому читатели не видят частично импортированный файл.
+    """
+    fingerprint = hashlib.sha256(content).hexdigest()
+    # одновременные загрузки одного и того же файла выполняются по очереди
+    with locks.checkpoint(fingerprint):
+        checkpoint = ImportCheckpoint.objects.get_or_create(
+            fingerprint=fingerprint
+        )[0]
+        rows_count = _stage_rows(checkpoint, data, chunk_size)
+
+        if rows_count == 0:
+            checkpoint.delete()
+            return ImportResult(0, {})
+
+        spend_deltas = publish_checkpoint(checkpoint, replace)
+    return ImportResult(rows_count, spend_deltas)
+
+
+def _stage_rows(checkpoint: ImportCheckpoint,
+                data: csv.DictReader,
+                chunk_size: int) -> int:
+    """
+    Фиксирует строки файла в staging-таблице пачками, пропуская
+    уже зафиксированные ранее. Возвращает количество строк в файле.
+    """
+    rows_count = 0
+    batch = []
+    for line, row in enumerate(data, start=1):
+        rows_count = line
+        if line <= checkpoint.rows_committed:
+            continue
+
+        batch.append(StagedDeal(
+            checkpoint=checkpoint,
+            line=line,
+            **parse_row(row)._asdict(),
+        ))
+        if len(batch) >= chunk_size:
+            _commit_chunk(checkpoint, batch, line)
+            batch = []
+
+    if batch:
+        _commit_chunk(checkpoint, batch, rows_count)
+    return rows_count
+
+
+def _commit_chunk(checkpoint: ImportCheckpoint,
+                  batch: List[StagedDeal],
+                  line: int) -> None:
+    """Фиксирует пачку строк в staging-таблице и сдвигает контрольную точку."""
+    with transaction.atomic():
+        StagedDeal.objects.bulk_create(batch, batch_size=batch_size)
+        checkpoint.rows_committed = line
+        checkpoint.save(update_fields=['rows_committed', 'updated_at'])
+
+
+def publish_checkpoint(checkpoint: ImportCheckpoint,
+                       replace: bool = False) -> Optional[Dict[int, int]]:
+    """
+    Переносит накопленные строки в основные таблицы одной транзакцией
+    (или подменой таблицы при replace=True) и в той же транзакции удаляет
+    контрольную точку вместе со staging-данными: после сбоя не остается
+    точки для уже опубликованных данных.
+    Возвращает изменение сумм по покупателям (None при replace=True).
+    """
+    staged = checkpoint.rows.order_by('line').iterator(chunk_size=batch_size)
+    rows = (
+        DealRow(
+            customer=deal.customer,
+            item=deal.item,
+            total_cost_cents=deal.total_cost_cents,
+            quantity=deal.quantity,
+            date=deal.date,
+        ) for deal in staged
+    )
+
+    if replace:
+        replace_deals(rows, on_publish=checkpoint.delete)
+        return None
+
+    create_missing_gems(
+        set(checkpoint.rows.values_list('item', flat=True).distinct())
+    )
+    usernames = set(checkpoint.rows.values_list('customer', flat=True).distinct())
+    spend_deltas: Dict[int, int] = {}
+    with locks.customers(usernames), transaction.atomic():
+        # пачки применяются по порядку строк, поэтому
+        # более поздние строки файла перезаписывают ранние
+        for chunk in chunks(rows):
+            merge_deltas(spend_deltas, apply_deals(chunk))
+        checkpoint.delete()
+    return spend_deltas
+
+
+def delete_expired_checkpoints(max_age: datetime.timedelta) -> int:
+    """
+    Удаляет контрольные точки брошенных загрузок (не обновлявшиеся
+    дольше max_age) вместе со staging-данными.
+    Возвращает количество удаленных точек.
+    """
+    deleted = 0
+    expired = ImportCheckpoint.objects.filter(updated_at__lt=timezone.now() - max_age)
+    for fingerprint in expired.values_list('fingerprint', flat=True):
+        # загрузка того же файла могла возобновиться: точка
+        # проверяется заново под ее блокировкой
+        with locks.checkpoint(fingerprint), transaction.atomic():
+            deleted += bool(
+                ImportCheckpoint.objects.filter(
+                    fingerprint=fingerprint,
+                    updated_at__lt=timezone.now() - max_age,
+                ).delete()[0]
+            )
+    return deleted
@@ -0,0 +1,171 @@
+"""
+Координация одновременных загрузок сделок.
+
+На PostgreSQL используются сессионные advisory-блокировки, поэтому
+координация работает между всеми процессами (воркерами gunicorn).
+Соединения с базой переиспользуются между запросами (CONN_MAX_AGE),
+поэтому блокировку, которую не удалось снять, в сессии не оставляем:
+соединение закрывается, и PostgreSQL снимает все ее блокировки.
+На остальных СУБД блокировки действуют в пределах процесса.
+
+- Покупатели разбиты на корзины по хешу имени. Загрузка блокирует
+  корзины своих покупателей в порядке возрастания номера, поэтому файлы
+  с непересекающимися покупателями обрабатываются параллельно,
+  а взаимные блокировки исключены.
+- Справочник камней пополняется под отдельной блокировкой.
+- Поэтапные загрузки одного и того же файла (одной контрольной точки)
+  выполняются по очереди.
+- Число одновременных загрузок (выполняющихся и ожидающих) ограничено
+  слотами: если свободного слота нет, загрузка сразу получает отказ.
+"""
+import threading
+import zlib
+from contextlib import contextmanager
+from typing import Iterable, Iterator, List
+
+from django.db import DatabaseError, connection
+
+# количество корзин покупателей
+customer_buckets = 64
+# ключ блокировки справочника камней (следует за ключами корзин)
+gems_key = customer_buckets
+
+# максимальное количество одновременных загрузок
+upload_slots = 8
+# через сколько секунд клиенту стоит повторить загрузку
+upload_retry_after = 5
+
+# пространства имен advisory-блокировок
+_locks_namespace = zlib.crc32(b'app.deals.locks') & 0x7fffffff
+_slots_namespace = zlib.crc32(b'app.deals.slots') & 0x7fffffff
+_checkpoints_namespace = zlib.crc32(b'app.deals.checkpoints') & 0x7fffffff
+
+# блокировки в пределах процесса для СУБД без advisory-блокировок
+_local_locks = [threading.Lock() for _ in range(customer_buckets + 1)]
+_local_checkpoints_lock = threading.Lock()
+_local_slots_lock = threading.Lock()
+_local_slots_used = 0
+
+
+class UploadQueueFull(Exception):
+    """Нет свободных слотов для загрузки."""
+
+
+def _is_postgresql() -> bool:
+    return connection.vendor == 'postgresql'
+
+
+def customer_bucket(username: str) -> int:
+    """Номер корзины покупателя (стабилен между процессами)."""
+    return zlib.crc32(username.encode('utf-8')) % customer_buckets
+
+
+def _pg_unlock(namespace: int, key: int) -> None:
+    """Снимает advisory-блокировку, при ошибке закрывает соединение."""
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_unlock(%s, %s)', [namespace, key])
+    except DatabaseError:
+        connection.close()
+        raise
+
+
+@contextmanager
+def _hold(keys: List[int]) -> Iterator[None]:
+    """Удерживает блокировки по ключам, захватывая их по возрастанию."""
+    keys = sorted(set(keys))
+    acquired = []
+    try:
+        for key in keys:
+            if _is_postgresql():
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        'SELECT pg_advisory_lock(%s, %s)', [_locks_namespace, key]
+                    )
+            else:
+                _local_locks[key].acquire()
+            acquired.append(key)
+        yield
+    finally:
+        for key in reversed(acquired):
+            if _is_postgresql():
+                _pg_unlock(_locks_namespace, key)
+            else:
+                _local_locks[key].release()
+
+
+def customers(usernames: Iterable[str]):
+    """Блокирует корзины переданных покупателей."""
+    return _hold([customer_bucket(username) for username in usernames])
+
+
+def all_customers():
+    """Блокирует все корзины покупателей (для полной замены данных)."""
+    return _hold(list(range(customer_buckets)))
+
+
+def gems():
+    """
+    Блокирует пополнение справочника камней.
+    Захватывается либо без других блокировок, либо после корзин.
+    """
+    return _hold([gems_key])
+
+
+@contextmanager
+def checkpoint(fingerprint: str) -> Iterator[None]:
+    """Блокирует контрольную точку поэтапной загрузки файла."""
+    if not _is_postgresql():
+        with _local_checkpoints_lock:
+            yield
+        return
+
+    key = zlib.crc32(fingerprint.encode('utf-8')) & 0x7fffffff
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT pg_advisory_lock(%s, %s)', [_checkpoints_namespace, key]
+        )
+    try:
+        yield
+    finally:
+        _pg_unlock(_checkpoints_namespace, key)
+
+
+@contextmanager
+def upload_slot() -> Iterator[None]:
+    """
+    Занимает слот загрузки на время обработки файла.
+    Если все слоты заняты, выбрасывает UploadQueueFull.
+    """
+    if _is_postgresql():
+        slot = _try_acquire_pg_slot()
+        if slot is None:
+            raise UploadQueueFull()
+        try:
+            yield
+        finally:
+            _pg_unlock(_slots_namespace, slot)
+        return
+
+    global _local_slots_used
+    with _local_slots_lock:
+        if _local_slots_used >= upload_slots:
+            raise UploadQueueFull()
+        _local_slots_used += 1
+    try:
+        yield
+    finally:
+        with _local_slots_lock:
+            _local_slots_used -= 1
+
+
+def _try_acquire_pg_slot():
+    """Пытается без ожидания занять один из слотов загрузки."""
+    with connection.cursor() as cursor:
+        for slot in range(upload_slots):
+            cursor.execute(
+                'SELECT pg_try_advisory_lock(%s, %s)', [_slots_namespace, slot]
+            )
+            if cursor.fetchone()[0]:
+                return slot
+    return None
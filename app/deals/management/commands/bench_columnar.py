@@ -0,0 +1,141 @@
+import statistics
+import sys
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from app.deals import columnar
+from app.deals.api import payloads
+from app.deals.api.views import TopCustomersView
+from app.deals.models import Customer, Deal, Gem
+
+
+class Command(BaseCommand):
+    """
+    Бенчмарк колоночного движка: рейтинг покупателей и общие камни
+    через ORM против снимка NumPy, а также время загрузки снимка
+    и занимаемая им память. Данные генерируются во временных таблицах
+    (см. generate), рабочие таблицы не затрагиваются.
+    """
+    help = 'Сравнивает ORM и колоночный движок на больших объемах сделок.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--deals', type=int, nargs='+', default=[1_000_000, 10_000_000])
+        parser.add_argument('--customers', type=int, default=100_000)
+        parser.add_argument('--gems', type=int, default=100)
+        parser.add_argument('--limits', type=int, nargs='+', default=[5, 100, 1000])
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, deals, customers, gems, limits, repeat, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Бенчмарк рассчитан на PostgreSQL.')
+        if columnar.import_numpy() is None:
+            raise CommandError('Для колоночного движка нужен numpy.')
+
+        for deals_count in deals:
+            self.stdout.write(f'Генерация {deals_count} сделок...')
+            with self.generate(deals_count, customers, gems):
+                self.run(deals_count, limits, repeat)
+
+    def run(self, deals_count: int, limits, repeat: int) -> None:
+        engine = columnar.Engine()
+        start = time.perf_counter()
+        snapshot = engine.load(rows_generation=0, names_generation=0)
+        load_time = time.perf_counter() - start
+
+        names_size = sum(sys.getsizeof(name) for name in snapshot.usernames)
+        names_size += sys.getsizeof(snapshot.usernames)
+        self.stdout.write(
+            f'{deals_count} сделок: загрузка снимка {load_time:.1f} с, '
+            f'массивы {snapshot.nbytes / 2 ** 20:.1f} МиБ, '
+            f'имена покупателей {names_size / 2 ** 20:.1f} МиБ'
+        )
+
+        queryset = TopCustomersView().get_queryset()
+        self.stdout.write(f'{"limit":>6} {"ORM, мс":>10} {"NumPy, мс":>10} {"ускорение":>10}')
+        for limit in limits:
+            orm_time, expected = self.measure(
+                lambda: self.query_orm(queryset, limit), repeat
+            )
+            numpy_time, result = self.measure(
+                lambda: self.query_snapshot(snapshot, limit), repeat
+            )
+            if result != expected:
+                raise CommandError(f'Результаты различаются при limit={limit}.')
+
+            self.stdout.write(
+                f'{limit:>6} {orm_time * 1000:>10.1f} {numpy_time * 1000:>10.1f} '
+                f'{orm_time / numpy_time:>9.1f}x'
+            )
+
+    @staticmethod
+    def query_orm(queryset, limit: int):
+        top = payloads.ranking(queryset, limit)
+        gems = payloads.shared_gems([customer_id for customer_id, _, _ in top])
+        return top, dict(gems)
+
+    @staticmethod
+    def query_snapshot(snapshot: columnar.Snapshot, limit: int):
+        top = snapshot.ranking(limit)
+        return top, snapshot.shared_gems([customer_id for customer_id, _, _ in top])
+
+    @staticmethod
+    @contextmanager
+    def generate(deals_count: int, customers: int, gems: int) -> Iterator[None]:
+        """
+        Генерирует данные средствами PostgreSQL (generate_series)
+        во временных таблицах с именами таблиц покупателей, камней
+        и сделок. Временные таблицы до конца сеанса перекрывают
+        одноименные рабочие, поэтому ORM и движок внутри блока читают
+        сгенерированные данные, а рабочие таблицы не затрагиваются.
+        Id задаются явно, чтобы не расходовать последовательности
+        рабочих таблиц.
+        """
+        tables = [model._meta.db_table for model in (Customer, Gem, Deal)]
+        with connection.cursor() as cursor:
+            for table in tables:
+                cursor.execute(f'DROP TABLE IF EXISTS pg_temp.{table}')
+                # внешние ключи не копируются: временные таблицы
+                # не могут ссылаться на рабочие
+                cursor.execute(f'CREATE TEMP TABLE {table} (LIKE {table} INCLUDING ALL)')
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'INSERT INTO pg_temp.{Customer._meta.db_table} (id, username) '
+                    "SELECT i, 'bench-customer-' || i FROM generate_series(1, %s) i",
+                    [customers],
+                )
+                cursor.execute(
+                    f'INSERT INTO pg_temp.{Gem._meta.db_table} (id, name) '
+                    "SELECT i, 'bench-gem-' || i FROM generate_series(1, %s) i",
+                    [gems],
+                )
+                cursor.execute(
+                    f'INSERT INTO pg_temp.{Deal._meta.db_table} '
+                    '(id, customer_id, item_id, total_cost_cents, quantity, date) '
+                    'SELECT i, 1 + (i %% %s), 1 + (random() * (%s - 1))::int, '
+                    '1 + (random() * 1000000)::bigint, 1, '
+                    "timestamptz '2020-01-01' + i * interval '1 second' "
+                    'FROM generate_series(1, %s) i',
+                    [customers, gems, deals_count],
+                )
+                for table in tables:
+                    cursor.execute(f'ANALYZE pg_temp.{table}')
+            yield
+        finally:
+            with connection.cursor() as cursor:
+                for table in tables:
+                    cursor.execute(f'DROP TABLE IF EXISTS pg_temp.{table}')
+
+    @staticmethod
+    def measure(func, repeat: int):
+        """Медианное время выполнения в секундах и результат."""
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = func()
+            timings.append(time.perf_counter() - start)
+        return statistics.median(timings), result
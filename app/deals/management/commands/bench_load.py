@@ -0,0 +1,90 @@
+import http.client
+import statistics
+import threading
+import time
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app.deals.benchmarks import is_success, parse_url, percentile, request
+
+
+class Command(BaseCommand):
+    """
+    Нагрузочный бенчмарк запущенного сервера: несколько потоков
+    в цикле запрашивают эндпоинты по постоянным HTTP-соединениям
+    (если сервер их закрывает - переподключаются). Выводит число
+    запросов в секунду, перцентили задержки и количество ошибок.
+
+    С --bust-cache к каждому запросу добавляется уникальный параметр,
+    чтобы ответ не брался из кеша страниц и запрос доходил до базы.
+    """
+    help = 'Измеряет пропускную способность запущенного сервера.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://localhost:8000')
+        parser.add_argument(
+            '--paths', nargs='+',
+            default=['/api/top-customers/', '/api/top-customers/?limit=100', '/api/gems/stats/'],
+        )
+        parser.add_argument('--concurrency', type=int, default=16)
+        parser.add_argument('--duration', type=float, default=10)
+        parser.add_argument('--warmup', type=float, default=2)
+        parser.add_argument('--bust-cache', action='store_true')
+
+    def handle(self, *args, url, paths, concurrency, duration, warmup, bust_cache, **options):
+        url = parse_url(url)
+
+        if warmup:
+            self.run(url, paths, concurrency, warmup, bust_cache)
+        timings, errors = self.run(url, paths, concurrency, duration, bust_cache)
+        if not timings:
+            raise CommandError(f'Нет успешных ответов, ошибки: {dict(errors)}.')
+
+        timings.sort()
+        self.stdout.write(
+            f'{len(timings)} запросов за {duration:.0f} с, '
+            f'{len(timings) / duration:.1f} запросов/с, потоков: {concurrency}'
+        )
+        self.stdout.write(
+            f'задержка, мс: p50 {percentile(timings, 50):.1f}, '
+            f'p95 {percentile(timings, 95):.1f}, '
+            f'p99 {percentile(timings, 99):.1f}, '
+            f'среднее {statistics.mean(timings):.1f}'
+        )
+        if errors:
+            self.stdout.write(f'ошибки: {dict(errors)}')
+
+    @staticmethod
+    def run(url, paths, concurrency: int, duration: float, bust_cache: bool):
+        """Успешные задержки в миллисекундах и счетчик ошибок."""
+        timings, errors = [], Counter()
+        lock = threading.Lock()
+        deadline = time.perf_counter() + duration
+
+        def worker(offset: int):
+            connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=30)
+            local_timings, local_errors = [], Counter()
+            i = offset
+            while time.perf_counter() < deadline:
+                path = paths[i % len(paths)]
+                if bust_cache:
+                    separator = '&' if '?' in path else '?'
+                    path = f'{path}{separator}nocache={time.time_ns()}-{offset}'
+                i += 1
+                status, _, latency = request(connection, 'GET', path)
+                if not is_success(status):
+                    local_errors[status] += 1
+                    continue
+                local_timings.append(latency)
+            connection.close()
+            with lock:
+                timings.extend(local_timings)
+                errors.update(local_errors)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return timings, errors
@@ -0,0 +1,143 @@
+import os
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from app.deals import shared_ranking
+from app.deals.api.views import TopCustomersView
+from app.deals.management.commands.bench_columnar import \
+    Command as ColumnarCommand
+
+
+class Command(BaseCommand):
+    """
+    Бенчмарк общего файла рейтинга: время построения и размер файла,
+    рейтинг с общими камнями через ORM против чтения из файла и память,
+    которую файл занимает в N процессах-читателях (Rss и Pss отображения
+    из /proc/<pid>/smaps). Данные генерируются во временных таблицах
+    (см. bench_columnar), рабочие таблицы не затрагиваются.
+    """
+    help = 'Сравнивает ORM и общий файл рейтинга и измеряет память читателей.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--deals', type=int, default=1_000_000)
+        parser.add_argument('--customers', type=int, default=100_000)
+        parser.add_argument('--gems', type=int, default=100)
+        parser.add_argument('--limits', type=int, nargs='+', default=[5, 100, 1000])
+        parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, deals, customers, gems, limits, workers, repeat, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Бенчмарк рассчитан на PostgreSQL.')
+
+        directory = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        with tempfile.TemporaryDirectory(dir=directory) as directory:
+            path = os.path.join(directory, 'ranking.bin')
+            self.stdout.write(f'Генерация {deals} сделок...')
+            with ColumnarCommand.generate(deals, customers, gems):
+                self.build(path, deals)
+                self.compare(path, limits, repeat)
+            self.memory(path, workers)
+
+    def build(self, path: str, deals_count: int) -> None:
+        start = time.perf_counter()
+        with open(path, 'wb') as f:
+            shared_ranking.write(f, rows_generation=0)
+        build_time = time.perf_counter() - start
+        self.stdout.write(
+            f'{deals_count} сделок: построение файла {build_time:.1f} с, '
+            f'размер {os.path.getsize(path) / 2 ** 20:.1f} МиБ'
+        )
+
+    def compare(self, path: str, limits, repeat: int) -> None:
+        ranking_file = shared_ranking.RankingFile(path)
+        queryset = TopCustomersView().get_queryset()
+        self.stdout.write(f'{"limit":>6} {"ORM, мс":>10} {"файл, мс":>10} {"ускорение":>10}')
+        for limit in limits:
+            orm_time, expected = ColumnarCommand.measure(
+                lambda: ColumnarCommand.query_orm(queryset, limit), repeat
+            )
+            file_time, result = ColumnarCommand.measure(
+                lambda: self.query_file(ranking_file, limit), repeat
+            )
+            if result != expected:
+                raise CommandError(f'Результаты различаются при limit={limit}.')
+
+            self.stdout.write(
+                f'{limit:>6} {orm_time * 1000:>10.1f} {file_time * 1000:>10.2f} '
+                f'{orm_time / file_time:>9.1f}x'
+            )
+
+    @staticmethod
+    def query_file(ranking_file: shared_ranking.RankingFile, limit: int):
+        top = ranking_file.ranking(limit)
+        return top, ranking_file.shared_gems(len(top))
+
+    def memory(self, path: str, workers) -> None:
+        self.stdout.write(f'{"воркеров":>8} {"Rss, МиБ":>12} {"Pss, МиБ":>12}')
+        for count in workers:
+            usage = self.readers_memory(path, count)
+            rss = sum(rss for rss, _ in usage)
+            pss = sum(pss for _, pss in usage)
+            # Rss растет с числом воркеров, но страницы общие:
+            # суммарный Pss (доля каждого процесса) остается постоянным
+            self.stdout.write(f'{count:>8} {rss / 2 ** 10:>12.1f} {pss / 2 ** 10:>12.1f}')
+
+    @staticmethod
+    def readers_memory(path: str, count: int):
+        """
+        Rss и Pss отображения файла (КиБ) в каждом из count процессов,
+        одновременно прочитавших весь рейтинг.
+        """
+        ready_read, ready_write = os.pipe()
+        go_read, go_write = os.pipe()
+        result_read, result_write = os.pipe()
+        pids = []
+        for _ in range(count):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    os.close(go_write)
+                    ranking_file = shared_ranking.RankingFile(path)
+                    ranking_file.ranking(ranking_file.size)
+                    ranking_file.shared_gems(ranking_file.size)
+                    os.write(ready_write, b'.')
+                    # Pss считается, когда файл отображен во всех читателях
+                    os.read(go_read, 1)
+                    rss, pss = mapping_memory(path)
+                    os.write(result_write, f'{rss} {pss}\n'.encode())
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+
+        for _ in range(count):
+            os.read(ready_read, 1)
+        os.close(go_write)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        os.close(result_write)
+        with os.fdopen(result_read) as f:
+            usage = [tuple(map(int, line.split())) for line in f]
+        for fd in (ready_read, ready_write, go_read):
+            os.close(fd)
+        return usage
+
+
+def mapping_memory(path: str):
+    """Rss и Pss (КиБ) отображений файла path в текущем процессе."""
+    rss = pss = 0
+    inside = False
+    with open('/proc/self/smaps') as f:
+        for line in f:
+            key, _, value = line.partition(' ')
+            if not key.endswith(':'):
+                # заголовок нового отображения: адреса, права, ..., путь
+                inside = line.rstrip('\n').endswith(path)
+            elif inside and key == 'Rss:':
+                rss += int(value.split()[0])
+            elif inside and key == 'Pss:':
+                pss += int(value.split()[0])
+    return rss, pss
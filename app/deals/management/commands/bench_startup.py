@@ -0,0 +1,102 @@
+import http.client
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+manage = f'{sys.executable} manage.py'
+
+# подготовка контейнера перед запуском gunicorn в каждом режиме
+startup_modes = {
+    # прежний entrypoint.sh: все шаги при каждом запуске
+    'full': f'{manage} makemigrations && {manage} migrate && '
+            f'{manage} collectstatic --noinput',
+    # startup пропускает неустаревшие миграции и статику
+    'fast': f'{manage} startup',
+    # без подготовки: нижняя граница
+    'none': 'true',
+}
+
+
+class Command(BaseCommand):
+    """
+    Бенчмарк запуска контейнера: время от старта подготовки
+    (как в entrypoint.sh) до первого успешного ответа gunicorn.
+    Сервер каждый раз запускается заново на свободном порту
+    с настройками из окружения, после ответа останавливается.
+    Первый запуск в режиме fast после full собирает отпечаток
+    статики, поэтому сначала выполняется прогревочный прогон.
+    """
+    help = 'Измеряет время до первого ответа после запуска контейнера.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--modes', nargs='+', choices=list(startup_modes),
+                            default=list(startup_modes))
+        parser.add_argument('--path', default='/api/top-customers/')
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--timeout', type=float, default=120)
+
+    def handle(self, *args, modes, path, workers, repeat, timeout, **options):
+        self.stdout.write(f'{"режим":>6} {"медиана, с":>11} {"мин, с":>8} {"макс, с":>8}')
+        for mode in modes:
+            self.start(mode, path, workers, timeout)
+            timings = [self.start(mode, path, workers, timeout) for _ in range(repeat)]
+            self.stdout.write(
+                f'{mode:>6} {statistics.median(timings):>11.2f} '
+                f'{min(timings):>8.2f} {max(timings):>8.2f}'
+            )
+
+    def start(self, mode: str, path: str, workers: int, timeout: float) -> float:
+        """Секунды от запуска подготовки до первого ответа сервера."""
+        port = self.free_port()
+        env = {
+            **os.environ,
+            'GUNICORN_BIND': f'127.0.0.1:{port}',
+            'GUNICORN_WORKERS': str(workers),
+        }
+        command = f'{startup_modes[mode]} && exec {sys.executable} -m gunicorn ' \
+                  f'sibdev_job.wsgi --config gunicorn.conf.py'
+
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            command, shell=True, cwd=settings.BASE_DIR, env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        try:
+            while not self.responds(port, path):
+                if process.poll() is not None:
+                    raise CommandError(
+                        f'Сервер в режиме {mode} завершился с кодом {process.returncode}.'
+                    )
+                if time.perf_counter() - start > timeout:
+                    raise CommandError(f'Сервер в режиме {mode} не ответил за {timeout:.0f} с.')
+                time.sleep(0.01)
+            return time.perf_counter() - start
+        finally:
+            os.killpg(process.pid, signal.SIGTERM)
+            process.wait()
+
+    @staticmethod
+    def responds(port: int, path: str) -> bool:
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+        try:
+            connection.request('GET', path)
+            return connection.getresponse().status < 500
+        except OSError:
+            return False
+        finally:
+            connection.close()
+
+    @staticmethod
+    def free_port() -> int:
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            return s.getsockname()[1]
@@ -0,0 +1,94 @@
+import datetime
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+
+from app.deals.api import payloads
+from app.deals.api.renderers import FastJSONRenderer
+from app.deals.api.serializers import TopCustomersSerializer
+from app.deals.api.views import TopCustomersView
+from app.deals.models import Customer, Deal, Gem
+
+
+class Command(BaseCommand):
+    """
+    Микробенчмарк формирования ответа /api/top-customers/:
+    сериализатор DRF + JSONRenderer против быстрого пути
+    (кортежи + FastJSONRenderer). Тестовые данные создаются
+    в транзакции, которая откатывается в конце.
+    """
+    help = 'Сравнивает скорость формирования ответа топа покупателей.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limits', type=int, nargs='+', default=[5, 100, 1000])
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--deals-per-customer', type=int, default=5)
+
+    def handle(self, *args, limits, repeat, deals_per_customer, **options):
+        with transaction.atomic():
+            self.generate(max(limits) * 2, deals_per_customer)
+
+            self.stdout.write(f'{"limit":>6} {"serializer, мс":>16} {"быстрый путь, мс":>18} {"ускорение":>10}')
+            for limit in limits:
+                serializer_time, expected = self.measure(self.render_serializer, limit, repeat)
+                fast_time, content = self.measure(self.render_fast, limit, repeat)
+                if content != expected:
+                    raise CommandError(f'Ответы различаются при limit={limit}.')
+
+                self.stdout.write(
+                    f'{limit:>6} {serializer_time * 1000:>16.2f} '
+                    f'{fast_time * 1000:>18.2f} {serializer_time / fast_time:>9.1f}x'
+                )
+
+            transaction.set_rollback(True)
+
+    @staticmethod
+    def generate(customers_count: int, deals_per_customer: int) -> None:
+        gems = Gem.objects.bulk_create(
+            Gem(name=f'bench-gem-{i}') for i in range(12)
+        )
+        customers = Customer.objects.bulk_create(
+            Customer(username=f'bench-customer-{i}') for i in range(customers_count)
+        )
+        date = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+        Deal.objects.bulk_create(
+            (
+                Deal(
+                    customer=customer,
+                    item=random.choice(gems),
+                    total_cost_cents=random.randint(1, 1_000_000),
+                    quantity=random.randint(1, 10),
+                    date=date + datetime.timedelta(seconds=i),
+                )
+                for customer in customers
+                for i in range(deals_per_customer)
+            ),
+            batch_size=1000,
+        )
+
+    @staticmethod
+    def render_serializer(limit: int) -> bytes:
+        top_customers = list(TopCustomersView().get_queryset()[:limit])
+        data = TopCustomersSerializer(top_customers, many=True).data
+        return JSONRenderer().render({'response': data})
+
+    @staticmethod
+    def render_fast(limit: int) -> bytes:
+        top = payloads.ranking(TopCustomersView().get_queryset(), limit)
+        gems = payloads.shared_gems([customer_id for customer_id, _, _ in top])
+        data = payloads.top_customers(top, gems)
+        return FastJSONRenderer().render({'response': data})
+
+    @staticmethod
+    def measure(render, limit: int, repeat: int):
+        """Медианное время формирования ответа в секундах и сам ответ."""
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            content = render(limit)
+            timings.append(time.perf_counter() - start)
+        return statistics.median(timings), content
@@ -0,0 +1,100 @@
+import statistics
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from rest_framework import serializers
+
+from app.deals import money
+from sibdev_job import const
+
+
+class Command(BaseCommand):
+    """
+    Бенчмарк хранения сумм: SUM по numeric(20, 2) против SUM по bigint
+    (копейки), а также стоимость вывода сумм на стороне Python.
+    Данные генерируются во временных таблицах и не затрагивают сделки.
+    """
+    help = 'Сравнивает скорость SUM по numeric и bigint (копейки).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10_000_000)
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--python-values', type=int, default=100_000)
+
+    def handle(self, *args, rows, repeat, python_values, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Бенчмарк рассчитан на PostgreSQL.')
+
+        with connection.cursor() as cursor:
+            self.stdout.write(f'Генерация {rows} строк...')
+            cursor.execute('DROP TABLE IF EXISTS bench_numeric, bench_cents')
+            cursor.execute(
+                'CREATE TEMP TABLE bench_numeric AS '
+                'SELECT (1 + random() * 10000)::numeric(20, 2) AS total_cost '
+                'FROM generate_series(1, %s)',
+                [rows],
+            )
+            cursor.execute(
+                'CREATE TEMP TABLE bench_cents AS '
+                'SELECT (total_cost * 100)::bigint AS total_cost_cents '
+                'FROM bench_numeric'
+            )
+            cursor.execute('ANALYZE bench_numeric')
+            cursor.execute('ANALYZE bench_cents')
+
+            numeric = self.measure(
+                cursor, 'SELECT SUM(total_cost) FROM bench_numeric', repeat
+            )
+            cents = self.measure(
+                cursor, 'SELECT SUM(total_cost_cents) FROM bench_cents', repeat
+            )
+
+            cursor.execute('SELECT SUM(total_cost) FROM bench_numeric')
+            numeric_sum = cursor.fetchone()[0]
+            cursor.execute('SELECT SUM(total_cost_cents) FROM bench_cents')
+            cents_sum = cursor.fetchone()[0]
+            cursor.execute('DROP TABLE bench_numeric, bench_cents')
+
+        if money.to_cents(numeric_sum) != cents_sum:
+            raise CommandError('Суммы numeric и bigint не совпадают.')
+
+        self.stdout.write(f'SUM numeric(20, 2): {numeric * 1000:.1f} мс (медиана)')
+        self.stdout.write(f'SUM bigint:         {cents * 1000:.1f} мс (медиана)')
+        self.stdout.write(f'Ускорение:          {numeric / cents:.2f}x')
+
+        # вывод сумм: DecimalField из DRF против копеек -> строка
+        values = [f'{i}.{i % 100:02d}' for i in range(python_values)]
+        decimals = [Decimal(value) for value in values]
+        cents_values = [money.to_cents(value) for value in values]
+        decimal_field = serializers.DecimalField(
+            decimal_places=2,
+            max_digits=const.decimal_max_digits,
+        )
+
+        start = time.perf_counter()
+        for value in decimals:
+            decimal_field.to_representation(value)
+        decimal_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for value in cents_values:
+            money.format_cents(value)
+        cents_time = time.perf_counter() - start
+
+        self.stdout.write(
+            f'Вывод {python_values} сумм: DecimalField {decimal_time * 1000:.1f} мс, '
+            f'копейки {cents_time * 1000:.1f} мс'
+        )
+
+    @staticmethod
+    def measure(cursor, sql: str, repeat: int) -> float:
+        """Медианное время выполнения запроса в секундах."""
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            cursor.execute(sql)
+            cursor.fetchone()
+            timings.append(time.perf_counter() - start)
+        return statistics.median(timings)
@@ -0,0 +1,26 @@
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from app.deals import ingest
+
+
+class Command(BaseCommand):
+    """
+    Удаление контрольных точек брошенных поэтапных загрузок
+    вместе с накопленными staging-строками. Запускается периодически
+    (например, из cron); точка, загрузка которой возобновилась,
+    не удаляется.
+    """
+    help = 'Удаляет контрольные точки поэтапных загрузок, не обновлявшиеся дольше срока.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-age', type=int, default=settings.DEALS_CHECKPOINT_MAX_AGE,
+            help='Срок без обновления, секунд (по умолчанию DEALS_CHECKPOINT_MAX_AGE).',
+        )
+
+    def handle(self, *args, max_age, **options):
+        deleted = ingest.delete_expired_checkpoints(datetime.timedelta(seconds=max_age))
+        self.stdout.write(f'Удалено контрольных точек: {deleted}.')
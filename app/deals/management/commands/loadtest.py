@@ -0,0 +1,265 @@
+import csv
+import datetime
+import http.client
+import io
+import json
+import random
+import statistics
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from typing import Dict, List, NamedTuple, Optional
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app.deals.benchmarks import is_success, parse_url, percentile, request
+
+top_customers_path = '/api/top-customers/'
+upload_path = '/api/deals-upload/'
+
+
+class Sample(NamedTuple):
+    """Результат одного запроса."""
+    endpoint: str
+    # время начала запроса от начала прогона, секунд
+    started: float
+    latency_ms: float
+    # код ответа или имя исключения при сетевой ошибке
+    status: str
+    # заголовок X-Cache ответа (HIT/MISS), если он есть
+    cache: Optional[str]
+
+
+class Command(BaseCommand):
+    """
+    Нагрузочный прогон со смешанной нагрузкой, как в продакшене:
+    потоки-читатели запрашивают /api/top-customers/ с разными лимитами,
+    а писатель периодически загружает сгенерированные файлы сделок.
+
+    Отчет по каждому эндпоинту: пропускная способность, p50/p99 задержки
+    и доля ошибок за весь прогон и по интервалам времени, а также доля
+    попаданий в кеш страниц (по заголовку X-Cache). Результаты
+    сохраняются в JSON для сравнения прогонов.
+    """
+    help = 'Смешанная нагрузка чтения и загрузки сделок на запущенный сервер.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://localhost:8000')
+        parser.add_argument('--duration', type=float, default=60)
+        parser.add_argument('--readers', type=int, default=8)
+        parser.add_argument(
+            '--limits', nargs='+', default=['5:70', '10:20', '100:9', '1000:1'],
+            help='лимиты топа и их веса в виде limit:weight',
+        )
+        parser.add_argument(
+            '--think', type=float, default=0,
+            help='пауза читателя между запросами, секунд',
+        )
+        parser.add_argument(
+            '--upload-interval', type=float, default=5,
+            help='интервал между началами загрузок, секунд (0 - без загрузок)',
+        )
+        parser.add_argument('--upload-rows', type=int, default=1000)
+        parser.add_argument('--upload-customers', type=int, default=500)
+        parser.add_argument('--upload-gems', type=int, default=30)
+        parser.add_argument(
+            '--bucket', type=float, default=5,
+            help='длина интервала в отчете по времени, секунд',
+        )
+        parser.add_argument('--seed', type=int, default=40)
+        parser.add_argument('--output', help='файл для результатов (JSON)')
+
+    def handle(self, *args, **options):
+        url = parse_url(options['url'])
+        limits, weights = self.parse_limits(options['limits'])
+
+        samples: List[Sample] = []
+        start = time.perf_counter()
+        deadline = start + options['duration']
+        threads = [
+            threading.Thread(
+                target=self.read,
+                args=(url, samples, start, deadline, limits, weights,
+                      options['think'], random.Random(options['seed'] + i)),
+            ) for i in range(options['readers'])
+        ]
+        if options['upload_interval'] > 0:
+            threads.append(threading.Thread(
+                target=self.write,
+                args=(url, samples, start, deadline, options),
+            ))
+
+        self.stdout.write(
+            f'Прогон {options["duration"]:.0f} с: читателей {options["readers"]}, '
+            f'загрузки каждые {options["upload_interval"]} с...'
+        )
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        report = {
+            'started_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'config': {
+                key: options[key] for key in (
+                    'url', 'duration', 'readers', 'limits', 'think', 'upload_interval',
+                    'upload_rows', 'upload_customers', 'upload_gems', 'bucket', 'seed',
+                )
+            },
+            'elapsed': round(elapsed, 2),
+            'endpoints': {
+                endpoint: self.summarize(endpoint_samples, elapsed, options['bucket'])
+                for endpoint, endpoint_samples in self.group(samples).items()
+            },
+        }
+        self.print_report(report)
+
+        output = options['output'] or f'loadtest-{int(time.time())}.json'
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        self.stdout.write(f'Результаты сохранены в {output}')
+
+    @staticmethod
+    def parse_limits(values: List[str]):
+        limits, weights = [], []
+        for value in values:
+            limit, _, weight = value.partition(':')
+            try:
+                limits.append(int(limit))
+                weights.append(float(weight or 1))
+            except ValueError:
+                raise CommandError(f'Некорректный лимит: {value}, ожидается limit:weight.')
+        return limits, weights
+
+    def read(self, url, samples: List[Sample], start: float, deadline: float,
+             limits: List[int], weights: List[float], think: float,
+             rnd: random.Random) -> None:
+        """Поток-читатель топа покупателей."""
+        connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=60)
+        while (now := time.perf_counter()) < deadline:
+            limit = rnd.choices(limits, weights)[0]
+            status, cache, latency = request(
+                connection, 'GET', f'{top_customers_path}?limit={limit}'
+            )
+            samples.append(Sample('top-customers', now - start, latency, status, cache))
+            if think:
+                time.sleep(think)
+        connection.close()
+
+    def write(self, url, samples: List[Sample], start: float, deadline: float, options) -> None:
+        """Поток, периодически загружающий сгенерированные файлы сделок."""
+        connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=600)
+        rnd = random.Random(options['seed'] - 1)
+        # даты сделок уникальны в пределах прогона и не пересекаются
+        # с датами предыдущих прогонов
+        first_date = datetime.datetime.now(datetime.timezone.utc)
+        uploads = 0
+        while (now := time.perf_counter()) < deadline:
+            content = self.generate_deals(
+                rnd, options['upload_rows'], options['upload_customers'],
+                options['upload_gems'], first_date, uploads * options['upload_rows'],
+            )
+            body, content_type = self.multipart('deals', 'deals.csv', content)
+            status, _, latency = request(
+                connection, 'POST', upload_path, body, {'Content-Type': content_type}
+            )
+            samples.append(Sample('deals-upload', now - start, latency, status, None))
+            uploads += 1
+            # пауза не выходит за конец прогона, чтобы не затягивать его
+            next_upload = min(now + options['upload_interval'], deadline)
+            time.sleep(max(0.0, next_upload - time.perf_counter()))
+        connection.close()
+
+    @staticmethod
+    def generate_deals(rnd: random.Random, rows: int, customers: int, gems: int,
+                       first_date: datetime.datetime, offset: int) -> bytes:
+        """Файл сделок: покупатели и камни из фиксированных наборов имен."""
+        f = io.StringIO()
+        writer = csv.writer(f)
+        writer.writerow(['customer', 'item', 'total', 'quantity', 'date'])
+        for i in range(rows):
+            writer.writerow([
+                f'load-customer-{rnd.randrange(customers)}',
+                f'load-gem-{rnd.randrange(gems)}',
+                f'{rnd.randint(100, 10 ** 6) / 100:.2f}',
+                rnd.randint(1, 10),
+                (first_date + datetime.timedelta(milliseconds=offset + i)).isoformat(),
+            ])
+        return f.getvalue().encode('utf-8')
+
+    @staticmethod
+    def multipart(field: str, filename: str, content: bytes):
+        """Тело запроса multipart/form-data с одним файлом и его Content-Type."""
+        boundary = uuid.uuid4().hex
+        body = (
+            f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            'Content-Type: text/csv\r\n\r\n'
+        ).encode() + content + f'\r\n--{boundary}--\r\n'.encode()
+        return body, f'multipart/form-data; boundary={boundary}'
+
+    @staticmethod
+    def group(samples: List[Sample]) -> Dict[str, List[Sample]]:
+        groups = defaultdict(list)
+        for sample in samples:
+            groups[sample.endpoint].append(sample)
+        return dict(sorted(groups.items()))
+
+    def summarize(self, samples: List[Sample], elapsed: float, bucket: float) -> dict:
+        """Сводка по эндпоинту за весь прогон и по интервалам времени."""
+        summary = self.stats(samples, elapsed)
+        buckets = defaultdict(list)
+        for sample in samples:
+            buckets[int(sample.started // bucket)].append(sample)
+        # последний интервал обрывается вместе с прогоном
+        summary['timeline'] = [
+            {
+                'from': round(index * bucket, 2),
+                **self.stats(buckets[index], min(bucket, elapsed - index * bucket)),
+            }
+            for index in sorted(buckets)
+        ]
+        return summary
+
+    @staticmethod
+    def stats(samples: List[Sample], seconds: float) -> dict:
+        ok = sorted(sample.latency_ms for sample in samples if is_success(sample.status))
+        errors = Counter(sample.status for sample in samples if not is_success(sample.status))
+        cache = Counter(sample.cache for sample in samples if sample.cache)
+
+        return {
+            'requests': len(samples),
+            'rps': round(len(samples) / seconds, 2),
+            'p50_ms': round(percentile(ok, 50), 2) if ok else None,
+            'p99_ms': round(percentile(ok, 99), 2) if ok else None,
+            'mean_ms': round(statistics.mean(ok), 2) if ok else None,
+            'error_rate': round(sum(errors.values()) / len(samples), 4),
+            'errors': dict(errors),
+            'cache_hit_ratio': (
+                round(cache['HIT'] / sum(cache.values()), 4) if cache else None
+            ),
+        }
+
+    def print_report(self, report: dict) -> None:
+        def fmt(value, spec='.1f'):
+            return '-' if value is None else format(value, spec)
+
+        for endpoint, summary in report['endpoints'].items():
+            self.stdout.write(
+                f'\n{endpoint}: {summary["requests"]} запросов, {summary["rps"]} запросов/с, '
+                f'p50 {fmt(summary["p50_ms"])} мс, p99 {fmt(summary["p99_ms"])} мс, '
+                f'ошибки {summary["error_rate"]:.2%}, '
+                f'попадания в кеш {fmt(summary["cache_hit_ratio"], ".1%")}'
+            )
+            self.stdout.write(
+                f'{"с":>6} {"запросов/с":>11} {"p50, мс":>9} {"p99, мс":>9} '
+                f'{"ошибки":>7} {"кеш":>6}'
+            )
+            for row in summary['timeline']:
+                self.stdout.write(
+                    f'{row["from"]:>6.0f} {row["rps"]:>11.1f} {fmt(row["p50_ms"]):>9} '
+                    f'{fmt(row["p99_ms"]):>9} {row["error_rate"]:>7.1%} '
+                    f'{fmt(row["cache_hit_ratio"], ".0%"):>6}'
+                )
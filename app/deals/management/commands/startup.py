@@ -0,0 +1,90 @@
+import hashlib
+import os
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.migrations.executor import MigrationExecutor
+
+# отпечаток исходников статики, из которых собран STATIC_ROOT
+static_hash_name = '.static-hash'
+
+# шаблоны, которые collectstatic пропускает по умолчанию
+static_ignore_patterns = ['CVS', '.*', '*~']
+
+
+class Command(BaseCommand):
+    """
+    Подготовка контейнера к запуску одним процессом вместо отдельных
+    makemigrations, migrate и collectstatic. Миграции применяются,
+    только если в плане миграций что-то есть, а статика собирается,
+    только если изменился отпечаток исходных файлов (пути, размеры,
+    время изменения) или в STATIC_ROOT нет манифеста. На неизменившемся
+    образе команда сводится к одному запросу к базе и обходу каталогов
+    статики.
+
+    makemigrations выполняется только при DEBUG: в разработке
+    код монтируется в контейнер, а в образе миграции уже есть.
+    """
+    help = 'Применяет миграции и собирает статику, если они устарели.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+        parser.add_argument(
+            '--force', action='store_true',
+            help='Выполнить все шаги без проверок.',
+        )
+
+    def handle(self, *args, database, force, **options):
+        verbosity = options['verbosity']
+        if settings.DEBUG:
+            call_command('makemigrations', verbosity=verbosity)
+
+        if force or self.has_unapplied_migrations(database):
+            call_command('migrate', database=database, interactive=False, verbosity=verbosity)
+        else:
+            self.stdout.write('Миграции применены, migrate пропущен.')
+
+        static_hash = self.static_hash()
+        if force or static_hash != self.collected_static_hash():
+            call_command('collectstatic', interactive=False, verbosity=verbosity)
+            with open(os.path.join(settings.STATIC_ROOT, static_hash_name), 'w') as f:
+                f.write(static_hash)
+        else:
+            self.stdout.write('Статика не изменилась, collectstatic пропущен.')
+
+    @staticmethod
+    def has_unapplied_migrations(database: str) -> bool:
+        executor = MigrationExecutor(connections[database])
+        return bool(executor.migration_plan(executor.loader.graph.leaf_nodes()))
+
+    @staticmethod
+    def static_hash() -> str:
+        """Отпечаток исходных файлов статики и настроек хранилища."""
+        files = []
+        for finder in finders.get_finders():
+            for path, storage in finder.list(static_ignore_patterns):
+                stat = os.stat(storage.path(path))
+                prefix = getattr(storage, 'prefix', None) or ''
+                files.append(f'{os.path.join(prefix, path)}:{stat.st_size}:{stat.st_mtime_ns}')
+
+        digest = hashlib.sha256(f'{settings.STATICFILES_STORAGE}:{settings.STATIC_URL}'.encode())
+        for line in sorted(files):
+            digest.update(line.encode())
+            digest.update(b'\n')
+        return digest.hexdigest()
+
+    @staticmethod
+    def collected_static_hash() -> str:
+        """Отпечаток, с которым статика была собрана ('' - не собрана)."""
+        manifest_name = getattr(staticfiles_storage, 'manifest_name', None)
+        if manifest_name and not staticfiles_storage.exists(manifest_name):
+            return ''
+        try:
+            with open(os.path.join(settings.STATIC_ROOT, static_hash_name)) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return ''
@@ -0,0 +1,40 @@
+# Generated by Django 4.2.30 on 2026-10-19 02:08
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('deals', '0005_alter_customer_username_alter_gem_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fingerprint', models.CharField(max_length=64, unique=True)),
+                ('rows_committed', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StagedDeal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('line', models.PositiveIntegerField()),
+                ('customer', models.CharField(max_length=255)),
+                ('item', models.CharField(max_length=255)),
+                ('total_cost', models.DecimalField(decimal_places=2, max_digits=20)),
+                ('quantity', models.PositiveIntegerField()),
+                ('date', models.DateTimeField()),
+                ('checkpoint', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rows', to='deals.importcheckpoint')),
+            ],
+            options={
+                'unique_together': {('checkpoint', 'line')},
+            },
+        ),
+    ]
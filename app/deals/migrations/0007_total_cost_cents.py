@@ -0,0 +1,80 @@
+# Перевод сумм сделок из numeric в целые копейки (bigint).
+
+from decimal import Decimal
+
+import django.core.validators
+from django.db import migrations, models
+from django.db.models import F, Value
+from django.db.models.functions import Cast
+
+
+def decimal_to_cents(apps, schema_editor):
+    for model_name in ('Deal', 'StagedDeal'):
+        model = apps.get_model('deals', model_name)
+        model.objects.update(
+            total_cost_cents=Cast(F('total_cost') * 100, models.BigIntegerField())
+        )
+
+
+def cents_to_decimal(apps, schema_editor):
+    for model_name in ('Deal', 'StagedDeal'):
+        model = apps.get_model('deals', model_name)
+        model.objects.update(
+            # деление в numeric, а не в double: копейки больших сумм не теряются;
+            # у делимого явно две цифры после запятой, иначе PostgreSQL
+            # округлит частное до 16 значащих цифр
+            total_cost=Cast(
+                Cast(F('total_cost_cents'), models.DecimalField(decimal_places=2, max_digits=22))
+                / Value(Decimal(100)),
+                models.DecimalField(decimal_places=2, max_digits=20),
+            )
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('deals', '0006_import_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deal',
+            name='total_cost_cents',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='stageddeal',
+            name='total_cost_cents',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='deal',
+            name='total_cost',
+            field=models.DecimalField(decimal_places=2, max_digits=20, null=True),
+        ),
+        migrations.AlterField(
+            model_name='stageddeal',
+            name='total_cost',
+            field=models.DecimalField(decimal_places=2, max_digits=20, null=True),
+        ),
+        migrations.RunPython(decimal_to_cents, cents_to_decimal),
+        migrations.RemoveField(
+            model_name='deal',
+            name='total_cost',
+        ),
+        migrations.RemoveField(
+            model_name='stageddeal',
+            name='total_cost',
+        ),
+        migrations.AlterField(
+            model_name='deal',
+            name='total_cost_cents',
+            field=models.BigIntegerField(validators=[django.core.validators.MinValueValidator(1)]),
+        ),
+        migrations.AlterField(
+            model_name='stageddeal',
+            name='total_cost_cents',
+            field=models.BigIntegerField(),
+        ),
+    ]
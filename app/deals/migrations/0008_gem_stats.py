@@ -0,0 +1,54 @@
+# Generated by Django 4.2.30 on 2026-10-19 02:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count, Sum
+
+
+def fill_gem_stats(apps, schema_editor):
+    Deal = apps.get_model('deals', 'Deal')
+    GemStats = apps.get_model('deals', 'GemStats')
+    rows = (
+        Deal.objects.values('item_id')
+        .annotate(
+            revenue_cents=Sum('total_cost_cents'),
+            quantity=Sum('quantity'),
+            deals_count=Count('id'),
+            customers_count=Count('customer_id', distinct=True),
+        )
+        .order_by('item_id')
+    )
+    GemStats.objects.bulk_create(
+        (
+            GemStats(
+                gem_id=row['item_id'],
+                revenue_cents=row['revenue_cents'],
+                quantity=row['quantity'],
+                deals_count=row['deals_count'],
+                customers_count=row['customers_count'],
+            )
+            for row in rows.iterator()
+        ),
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('deals', '0007_total_cost_cents'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GemStats',
+            fields=[
+                ('gem', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='deals.gem')),
+                ('revenue_cents', models.BigIntegerField(default=0)),
+                ('quantity', models.BigIntegerField(default=0)),
+                ('deals_count', models.PositiveIntegerField(default=0)),
+                ('customers_count', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(fill_gem_stats, migrations.RunPython.noop),
+    ]
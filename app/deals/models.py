@@ -4,7 +4,63 @@ from typing import List
 from django.core.validators import MinValueValidator
 from django.db import models
 
-from sibdev_job import const
+from app.deals import changes, money
+
+
+class CustomerQuerySet(changes.TrackedQuerySet):
+
+    def changes_of(self, operation, objs=None, fields=()):
+        # новые покупатели попадают в топ с нулевой суммой
+        if operation == 'bulk_create':
+            return {}
+        if operation == 'delete':
+            # вместе с покупателями удаляются их сделки
+            return {'names': True, 'gem_ids': _gems_of(Deal.objects.filter(customer__in=self))}
+        return {'names': True}
+
+
+class GemQuerySet(changes.TrackedQuerySet):
+
+    def changes_of(self, operation, objs=None, fields=()):
+        # камни без сделок не влияют ни на топ, ни на статистику
+        if operation == 'bulk_create':
+            return {'spend_deltas': {}}
+        return {'names': True}
+
+
+class DealQuerySet(changes.TrackedQuerySet):
+
+    def changes_of(self, operation, objs=None, fields=()):
+        if operation == 'bulk_create':
+            spend_deltas = {}
+            for deal in objs:
+                spend_deltas[deal.customer_id] = (
+                    spend_deltas.get(deal.customer_id, 0) + deal.total_cost_cents
+                )
+            return {'spend_deltas': spend_deltas, 'gem_ids': {deal.item_id for deal in objs}}
+
+        if operation == 'bulk_update':
+            gem_ids = _gems_of(Deal.objects.filter(pk__in=[deal.pk for deal in objs]))
+            if 'item' in fields or 'item_id' in fields:
+                gem_ids.update(deal.item_id for deal in objs)
+            return {'gem_ids': gem_ids}
+
+        gem_ids = _gems_of(self)
+        if operation == 'update':
+            item = fields.get('item', fields.get('item_id'))
+            if isinstance(item, Gem):
+                gem_ids.add(item.pk)
+            elif isinstance(item, int):
+                gem_ids.add(item)
+            elif item is not None:
+                # выражение: новые камни заранее неизвестны
+                gem_ids = None
+        return {'gem_ids': gem_ids}
+
+
+def _gems_of(deals: models.QuerySet) -> set:
+    """Id камней переданных сделок."""
+    return set(deals.order_by().values_list('item_id', flat=True).distinct())
 
 
 class Customer(models.Model):
@@ -16,6 +72,8 @@ class Customer(models.Model):
         through='Deal'
     )
 
+    objects = CustomerQuerySet.as_manager()
+
     def __str__(self):
         return self.username
 
@@ -24,6 +82,8 @@ class Gem(models.Model):
     """Модель драгоценного камня"""
     name = models.CharField(max_length=255, unique=True)
 
+    objects = GemQuerySet.as_manager()
+
     def __str__(self):
         return self.name
 
@@ -41,13 +101,35 @@ class Deal(models.Model):
         related_name='deals',
     )
     quantity = models.PositiveIntegerField()
-    total_cost = models.DecimalField(
-        decimal_places=2,
-        max_digits=const.decimal_max_digits,
-        validators=[MinValueValidator(Decimal('0.01'))]
+    # сумма сделки в копейках
+    total_cost_cents = models.BigIntegerField(
+        validators=[MinValueValidator(1)]
     )
     date = models.DateTimeField()
 
+    objects = DealQuerySet.as_manager()
+
+    def delete(self, *args, **kwargs):
+        # не сигнал post_delete: обработчик сигнала отключил бы быстрое
+        # каскадное удаление сделок вместе с покупателями и камнями
+        result = super().delete(*args, **kwargs)
+        if changes.is_tracked():
+            changes.changed(
+                spend_deltas={self.customer_id: -self.total_cost_cents},
+                gem_ids=[self.item_id],
+                using=self._state.db,
+            )
+        return result
+
+    @property
+    def total_cost(self) -> Decimal:
+        """Сумма сделки в рублях."""
+        return money.from_cents(self.total_cost_cents)
+
+    @total_cost.setter
+    def total_cost(self, value):
+        self.total_cost_cents = money.to_cents(value)
+
     def to_list(self) -> List:
         """Возвращает данные сделки в виде списка значений."""
         return [
@@ -57,3 +139,61 @@ class Deal(models.Model):
             self.quantity,
             self.date
         ]
+
+
+class GemStats(models.Model):
+    """
+    Сводная статистика по камню. Обновляется при загрузке сделок,
+    чтобы не считать ее полным проходом по таблице сделок.
+    """
+    gem = models.OneToOneField(
+        Gem,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='stats',
+    )
+    # выручка в копейках
+    revenue_cents = models.BigIntegerField(default=0)
+    quantity = models.BigIntegerField(default=0)
+    deals_count = models.PositiveIntegerField(default=0)
+    # количество различных покупателей
+    customers_count = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.gem_id}: {self.revenue_cents}'
+
+
+class ImportCheckpoint(models.Model):
+    """
+    Контрольная точка поэтапного импорта файла со сделками.
+    Позволяет продолжить прерванную загрузку того же файла
+    с последней зафиксированной строки.
+    """
+    fingerprint = models.CharField(max_length=64, unique=True)
+    rows_committed = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.fingerprint} ({self.rows_committed})'
+
+
+class StagedDeal(models.Model):
+    """
+    Промежуточная (staging) запись сделки.
+    Строки файла накапливаются здесь до публикации в основные таблицы.
+    """
+    checkpoint = models.ForeignKey(
+        ImportCheckpoint,
+        on_delete=models.CASCADE,
+        related_name='rows',
+    )
+    line = models.PositiveIntegerField()
+    customer = models.CharField(max_length=255)
+    item = models.CharField(max_length=255)
+    total_cost_cents = models.BigIntegerField()
+    quantity = models.PositiveIntegerField()
+    date = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('checkpoint', 'line')
@@ -0,0 +1,76 @@
+"""
+Кеш соответствия имя -> id для справочников покупателей и камней.
+
+Кеш локален для процесса и общий для его потоков. Корректность
+обеспечивается штампом поколения справочников (generation.names):
+при удалении покупателей или камней поколение увеличивается,
+и все процессы сбрасывают свои кеши при следующем обращении.
+"""
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple, Type
+
+from django.db import models
+
+from app.deals import generation
+from app.deals.models import Customer, Gem
+
+# сколько покупателей помнить в пределах процесса
+customers_maxsize = 100_000
+
+
+class NameCache:
+    """LRU-кеш имя -> id одной модели-справочника."""
+
+    def __init__(self, maxsize: Optional[int] = None):
+        # maxsize=None - кеш без ограничения размера (вся таблица)
+        self.maxsize = maxsize
+        self._ids: 'OrderedDict[str, int]' = OrderedDict()
+        self._generation = None
+        self._lock = threading.Lock()
+
+    def get_many(self, names: Iterable[str]) -> Tuple[Dict[str, int], int]:
+        """
+        Возвращает найденные в кеше id и штамп поколения,
+        с которым их нужно будет дополнить через set_many.
+        """
+        current = generation.get(generation.names)
+        with self._lock:
+            if current != self._generation:
+                self._ids.clear()
+                self._generation = current
+
+            found = {}
+            for name in names:
+                pk = self._ids.get(name)
+                if pk is not None:
+                    found[name] = pk
+                    self._ids.move_to_end(name)
+            return found, current
+
+    def set_many(self, ids: Dict[str, int], stamp: int) -> None:
+        """
+        Запоминает id. Если поколение успело смениться
+        после get_many, данные могли устареть и не сохраняются.
+        """
+        with self._lock:
+            if stamp != self._generation:
+                return
+            self._ids.update(ids)
+            if self.maxsize is not None:
+                while len(self._ids) > self.maxsize:
+                    self._ids.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._ids.clear()
+            self._generation = None
+
+
+customers = NameCache(maxsize=customers_maxsize)
+# камней немного, поэтому кешируется вся таблица
+gems = NameCache()
+
+
+def for_model(model: Type[models.Model]) -> NameCache:
+    return {Customer: customers, Gem: gems}[model]
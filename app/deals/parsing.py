@@ -0,0 +1,274 @@
+"""
+Разбор и проверка csv-файлов со сделками.
+
+Модуль не зависит от моделей и не обращается к базе, поэтому файлы
+можно разбирать в отдельных процессах: при загрузке нескольких файлов
+они разбираются параллельно в пуле процессов.
+
+Разбор проверяет файл целиком и собирает все ошибки с номерами строк:
+испорченный файл отклоняется до того, как начнется запись в базу.
+"""
+import csv
+import datetime
+import functools
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from decimal import Decimal, InvalidOperation
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from app.deals import money
+from sibdev_job import const
+
+# максимальное количество процессов для разбора файлов
+parse_workers = min(os.cpu_count() or 1, 8)
+# суммарный размер файлов (в символах), начиная с которого разбор
+# распараллеливается: для небольших файлов передача строк между
+# процессами обходится дороже самого разбора
+parallel_min_size = 1024 ** 2
+
+# колонки файла со сделками
+columns = ('customer', 'item', 'total', 'quantity', 'date')
+# ограничения значений, совпадающие с ограничениями полей моделей
+max_name_length = 255
+max_quantity = 2 ** 31 - 1
+# сколько ошибок одного файла попадает в отчет (посчитаны будут все)
+max_errors = 100
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+class DealRow(NamedTuple):
+    """Разобранная строка файла со сделками."""
+    customer: str
+    item: str
+    total_cost_cents: int
+    quantity: int
+    date: datetime.datetime
+
+
+class RowError(NamedTuple):
+    """
+    Ошибка в данных файла: номер строки (заголовок - строка 1),
+    колонка (None - ошибка относится ко всей строке) и описание.
+    """
+    line: int
+    column: Optional[str]
+    message: str
+
+
+class ParsedFile(NamedTuple):
+    """
+    Разобранный файл: имя, строки, время разбора в секундах,
+    количество строк данных, первые max_errors ошибок и число всех ошибок.
+    Если в файле есть ошибки, строки не возвращаются.
+    """
+    name: str
+    rows: List[DealRow]
+    seconds: float
+    rows_count: int = 0
+    errors: List[RowError] = []
+    errors_count: int = 0
+
+
+def _parse_name(value: str) -> str:
+    if not value:
+        raise ValueError('пустое значение')
+    if len(value) > max_name_length:
+        raise ValueError(f'длиннее {max_name_length} символов')
+    return value
+
+
+def _parse_total(value: str) -> int:
+    try:
+        amount = Decimal(value)
+    except InvalidOperation:
+        raise ValueError(f'некорректная сумма: {value!r}')
+    # до перевода в копейки: огромный показатель степени (1e1000000)
+    # не должен превращаться в огромное целое
+    if amount.is_finite() and amount and amount.adjusted() + 3 > const.decimal_max_digits:
+        raise ValueError(f'больше {const.decimal_max_digits} цифр: {value!r}')
+    cents = money.to_cents(amount)
+    if cents <= 0:
+        raise ValueError(f'сумма должна быть положительной: {value!r}')
+    return cents
+
+
+def _parse_quantity(value: str) -> int:
+    try:
+        quantity = int(value)
+    except ValueError:
+        raise ValueError(f'некорректное количество: {value!r}')
+    if not 0 <= quantity <= max_quantity:
+        raise ValueError(f'количество вне диапазона 0..{max_quantity}: {value!r}')
+    return quantity
+
+
+def _parse_date(value: str) -> datetime.datetime:
+    # parse_datetime понимает и смещение вида Z, и +03:00
+    # (datetime.fromisoformat до Python 3.11 - нет)
+    date = parse_datetime(value)
+    if date is None:
+        raise ValueError(f'некорректная дата: {value!r}')
+    # дата без часового пояса считается датой в часовом поясе проекта
+    # (zoneinfo: make_aware сводится к replace, но заметно дороже)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.get_default_timezone())
+    return date
+
+
+_parsers = {
+    'customer': _parse_name,
+    'item': _parse_name,
+    'total': _parse_total,
+    'quantity': _parse_quantity,
+    'date': _parse_date,
+}
+
+
+def _parse_fields(row: Dict[str, str]) -> Tuple[Optional[DealRow], List[Tuple[Optional[str], str]]]:
+    """Строка сделки и ошибки по колонкам (пустой список, если строка корректна)."""
+    # быстрый путь для корректных строк, ошибки разбираются по колонкам ниже
+    if None not in row:
+        try:
+            return DealRow(
+                customer=_parse_name(row['customer']),
+                item=_parse_name(row['item']),
+                total_cost_cents=_parse_total(row['total']),
+                quantity=_parse_quantity(row['quantity']),
+                date=_parse_date(row['date']),
+            ), []
+        except (KeyError, TypeError, ValueError):
+            pass
+
+    values, errors = {}, []
+    # DictReader складывает лишние значения строки под ключ None
+    if None in row:
+        errors.append((None, 'лишние значения в строке'))
+    for column in columns:
+        value = row.get(column)
+        if value is None:
+            errors.append((column, 'отсутствует значение'))
+            continue
+        try:
+            values[column] = _parsers[column](value)
+        except ValueError as e:
+            errors.append((column, str(e)))
+
+    if errors:
+        return None, errors
+    return DealRow(
+        customer=values['customer'],
+        item=values['item'],
+        total_cost_cents=values['total'],
+        quantity=values['quantity'],
+        date=values['date'],
+    ), errors
+
+
+def parse_row(row: Dict[str, str]) -> DealRow:
+    """
+    Приводит строку csv-файла к типизированному виду.
+    При некорректных данных выбрасывает ValueError.
+    """
+    deal, errors = _parse_fields(row)
+    if errors:
+        raise ValueError('; '.join(
+            message if column is None else f'{column}: {message}'
+            for column, message in errors
+        ))
+    return deal
+
+
+def parse_csv(name: str, text: str, keep_rows: bool = True) -> ParsedFile:
+    """
+    Разбирает и проверяет содержимое csv-файла: наличие колонок,
+    типы и диапазоны значений, точность сумм, часовые пояса дат.
+    При keep_rows=False строки только проверяются.
+    """
+    start = time.perf_counter()
+    rows, errors, rows_count, errors_count = [], [], 0, 0
+
+    def add_error(line: int, column: Optional[str], message: str) -> None:
+        nonlocal errors_count
+        errors_count += 1
+        if len(errors) < max_errors:
+            errors.append(RowError(line, column, message))
+
+    reader = csv.DictReader(text.splitlines())
+    try:
+        # у пустого файла нет заголовка, это не ошибка данных
+        missing = [column for column in columns if column not in (reader.fieldnames or columns)]
+        for column in missing:
+            add_error(1, column, 'отсутствует колонка')
+
+        if not missing:
+            for row in reader:
+                rows_count += 1
+                deal, row_errors = _parse_fields(row)
+                for column, message in row_errors:
+                    add_error(reader.line_num, column, message)
+                if keep_rows and not errors_count:
+                    rows.append(deal)
+    except csv.Error as e:
+        add_error(reader.line_num, None, f'ошибка формата csv: {e}')
+
+    if errors_count:
+        rows = []
+    return ParsedFile(
+        name, rows, time.perf_counter() - start, rows_count, errors, errors_count
+    )
+
+
+def parse_files(files: List[Tuple[str, str]], keep_rows: bool = True) -> List[ParsedFile]:
+    """
+    Разбирает файлы (имя, содержимое), сохраняя их порядок.
+    Несколько достаточно больших файлов разбираются параллельно
+    в пуле процессов. Ошибки в данных возвращаются в ParsedFile.errors.
+    """
+    names = [name for name, _ in files]
+    texts = [text for _, text in files]
+    parallel = (
+        len(files) > 1
+        and parse_workers > 1
+        and sum(map(len, texts)) >= parallel_min_size
+    )
+    parse = functools.partial(parse_csv, keep_rows=keep_rows)
+    try:
+        return list((_get_pool().map if parallel else map)(parse, names, texts))
+    except BrokenProcessPool:
+        # процесс пула аварийно завершился: следующая загрузка
+        # получит новый пул
+        _reset_pool()
+        raise
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    """
+    Пул создается при первой загрузке нескольких файлов и живет
+    до конца процесса. Процессы пула порождаются через forkserver:
+    fork многопоточного воркера (gthread) небезопасен.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=parse_workers,
+                mp_context=multiprocessing.get_context('forkserver'),
+            )
+    return _pool
+
+
+def _reset_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
@@ -0,0 +1,74 @@
+"""
+Маршрутизация запросов чтения на реплики БД.
+
+На реплики уходят только запросы, явно выполненные внутри
+read_from_replica() (чтение списка топовых покупателей). Все остальное,
+включая загрузку сделок, работает с основной базой.
+
+После загрузки сделок чтение на некоторое время закрепляется за основной
+базой (pin_primary): реплика может отставать, и без этого в только что
+очищенный кеш страниц попали бы данные старше загрузки.
+"""
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+_primary_pinned_key = 'deals_primary_pinned_until'
+
+# реплика, выбранная для текущего блока read_from_replica()
+_replica: ContextVar[Optional[str]] = ContextVar('deals_replica', default=None)
+
+
+def pin_primary() -> None:
+    """Закрепляет чтение за основной базой во всех воркерах."""
+    window = settings.DATABASE_REPLICA_PIN_SECONDS
+    cache.set(_primary_pinned_key, time.time() + window, timeout=window)
+
+
+def is_primary_pinned() -> bool:
+    pinned_until = cache.get(_primary_pinned_key)
+    return pinned_until is not None and pinned_until > time.time()
+
+
+@contextmanager
+def read_from_replica() -> Iterator[None]:
+    """
+    Направляет запросы чтения внутри блока на случайную реплику.
+    Если реплик нет или чтение закреплено за основной базой,
+    запросы идут в основную базу.
+    """
+    replicas = settings.DATABASE_REPLICAS
+    if not replicas or is_primary_pinned():
+        yield
+        return
+
+    token = _replica.set(random.choice(replicas))
+    try:
+        yield
+    finally:
+        _replica.reset(token)
+
+
+class ReplicaRouter:
+    """Роутер, отправляющий помеченные запросы чтения на реплики."""
+
+    def db_for_read(self, model, **hints):
+        return _replica.get()
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # реплики содержат те же данные, что и основная база
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # реплики получают схему через репликацию
+        if db in settings.DATABASE_REPLICAS:
+            return False
+        return None
@@ -0,0 +1,248 @@
+"""
+Теневая (shadow) копия таблицы сделок для импорта с полной заменой данных.
+
+Новый файл загружается в отдельную таблицу, на которой заранее
+строятся индексы, а затем она подменяет основную таблицу одной короткой
+транзакцией. Пока идет загрузка, читатели работают с основной таблицей
+и не конкурируют с импортом. Работает только на PostgreSQL.
+
+Теневые копии есть у таблицы сделок и у таблицы статистики камней:
+статистика считается по теневой таблице сделок до подмены, и обе
+таблицы подменяются в одной транзакции. Справочники покупателей
+и камней изменяются на месте, в транзакции подмены. Все, что требует
+прохода по сделкам (id новых записей справочников, записи без сделок),
+вычисляется заранее по теневой таблице, поэтому в транзакции подмены
+остаются переименования и изменения справочников по готовым спискам id.
+"""
+import csv
+from io import StringIO
+from typing import Iterable, List, Tuple, Type
+
+from django.db import connection, models, transaction
+
+from app.deals.models import Deal, GemStats
+
+table = Deal._meta.db_table
+shadow_table = f'{table}__shadow'
+stats_table = GemStats._meta.db_table
+shadow_stats_table = f'{stats_table}__shadow'
+
+# подменяемые таблицы и их теневые копии в порядке блокировки:
+# пересчет статистики (stats.refresh) блокирует строки статистики
+# раньше, чем читает сделки
+tables = [(stats_table, shadow_stats_table), (table, shadow_table)]
+
+# колонки, которые заполняются при вставке в теневую таблицу
+columns = [
+    Deal._meta.get_field(name).column
+    for name in ('customer', 'item', 'total_cost_cents', 'quantity', 'date')
+]
+
+
+def is_supported() -> bool:
+    """Подмена таблиц реализована только для PostgreSQL."""
+    return connection.vendor == 'postgresql'
+
+
+def create() -> None:
+    """Создает пустую теневую таблицу по образцу основной."""
+    qn = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS {qn(shadow_table)}')
+        # INCLUDING ALL переносит значения по умолчанию, identity, check-ограничения
+        # и индексы, но не внешние ключи - их добавляем при подмене
+        cursor.execute(
+            f'CREATE TABLE {qn(shadow_table)} (LIKE {qn(table)} INCLUDING ALL)'
+        )
+
+
+def drop() -> None:
+    """Удаляет теневые таблицы (например, после ошибки импорта)."""
+    qn = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        for _, shadow_name in tables:
+            cursor.execute(f'DROP TABLE IF EXISTS {qn(shadow_name)}')
+
+
+def insert(values: Iterable[Tuple]) -> None:
+    """
+    Вставляет строки сделок (в порядке columns) в теневую таблицу
+    одной командой COPY.
+    """
+    qn = connection.ops.quote_name
+    f = StringIO()
+    csv.writer(f).writerows(values)
+    f.seek(0)
+    with connection.cursor() as cursor:
+        cursor.copy_expert(
+            f'COPY {qn(shadow_table)} '
+            f'({", ".join(qn(column) for column in columns)}) '
+            f'FROM STDIN WITH (FORMAT csv)',
+            f,
+        )
+
+
+def reserve_ids(model: Type[models.Model], count: int) -> List[int]:
+    """
+    Выделяет count id из последовательности первичного ключа модели,
+    не создавая записей: записи с этими id создаются позже явно.
+    """
+    if not count:
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)',
+            [model._meta.db_table, model._meta.pk.column, count],
+        )
+        return [id_ for id_, in cursor.fetchall()]
+
+
+def deduplicate() -> None:
+    """
+    Оставляет по одной сделке на пару покупатель + таймстамп.
+    Строки вставляются в порядке файла, поэтому побеждает последняя.
+    """
+    qn = connection.ops.quote_name
+    pk = qn(Deal._meta.pk.column)
+    customer = qn(Deal._meta.get_field('customer').column)
+    date = qn(Deal._meta.get_field('date').column)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {qn(shadow_table)} a USING {qn(shadow_table)} b '
+            f'WHERE a.{customer} = b.{customer} AND a.{date} = b.{date} '
+            f'AND a.{pk} < b.{pk}'
+        )
+        cursor.execute(f'ANALYZE {qn(shadow_table)}')
+
+
+def orphan_ids(model: Type[models.Model], field: str) -> List[int]:
+    """
+    Id записей справочника model, на которые не ссылается ни одна
+    сделка теневой таблицы (field - поле внешнего ключа сделки).
+    """
+    qn = connection.ops.quote_name
+    pk = qn(model._meta.pk.column)
+    column = qn(Deal._meta.get_field(field).column)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT r.{pk} FROM {qn(model._meta.db_table)} r '
+            f'WHERE NOT EXISTS ('
+            f'SELECT 1 FROM {qn(shadow_table)} s WHERE s.{column} = r.{pk}'
+            f') ORDER BY r.{pk}'
+        )
+        return [id_ for id_, in cursor.fetchall()]
+
+
+def build_stats() -> None:
+    """
+    Строит по теневой таблице сделок теневую таблицу статистики камней
+    (как stats.rebuild() по основной).
+    """
+    qn = connection.ops.quote_name
+    fields = ['gem', 'revenue_cents', 'quantity', 'deals_count', 'customers_count']
+    stats_columns = [GemStats._meta.get_field(name).column for name in fields]
+    customer, item, total_cost_cents, quantity, _ = (qn(column) for column in columns)
+    with connection.cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS {qn(shadow_stats_table)}')
+        cursor.execute(
+            f'CREATE TABLE {qn(shadow_stats_table)} (LIKE {qn(stats_table)} INCLUDING ALL)'
+        )
+        cursor.execute(
+            f'INSERT INTO {qn(shadow_stats_table)} '
+            f'({", ".join(qn(column) for column in stats_columns)}) '
+            f'SELECT {item}, SUM({total_cost_cents}), SUM({quantity}), '
+            f'COUNT(*), COUNT(DISTINCT {customer}) '
+            f'FROM {qn(shadow_table)} GROUP BY {item}'
+        )
+
+
+def swap(on_swap=None) -> None:
+    """
+    Атомарно подменяет основные таблицы (сделки и статистику камней)
+    теневыми, теневая статистика должна быть построена (build_stats).
+
+    Индексы и ограничения получают прежние имена, чтобы миграции
+    Django продолжали их находить. Внешние ключи добавляются как NOT VALID
+    (без полного сканирования) и проверяются уже после подмены.
+    on_swap вызывается внутри транзакции подмены.
+    """
+    qn = connection.ops.quote_name
+    foreign_keys = []
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            # отложенные проверки внешних ключей не дадут удалить таблицу
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+            for name, _ in tables:
+                cursor.execute(f'LOCK TABLE {qn(name)} IN ACCESS EXCLUSIVE MODE')
+            for name, shadow_name in tables:
+                foreign_keys += [
+                    (name, constraint) for constraint in _replace(cursor, name, shadow_name)
+                ]
+
+        if on_swap is not None:
+            on_swap()
+
+    with connection.cursor() as cursor:
+        for name, constraint in foreign_keys:
+            cursor.execute(
+                f'ALTER TABLE {qn(name)} VALIDATE CONSTRAINT {qn(constraint)}'
+            )
+
+
+def _replace(cursor, name: str, shadow_name: str) -> List[str]:
+    """
+    Подменяет таблицу name теневой таблицей shadow_name.
+    Возвращает имена внешних ключей, которые нужно проверить.
+    """
+    qn = connection.ops.quote_name
+    introspection = connection.introspection
+    constraints = introspection.get_constraints(cursor, name)
+    shadow_constraints = introspection.get_constraints(cursor, shadow_name)
+
+    cursor.execute(f'DROP TABLE {qn(name)}')
+    cursor.execute(f'ALTER TABLE {qn(shadow_name)} RENAME TO {qn(name)}')
+
+    foreign_keys = []
+    for constraint, info in constraints.items():
+        if info['foreign_key']:
+            foreign_keys.append((constraint, info))
+            continue
+        if info['check'] and not info['index']:
+            continue
+
+        shadow_constraint = _find_same(info, shadow_constraints)
+        if shadow_constraint is None or shadow_constraint == constraint:
+            continue
+        if info['primary_key'] or info['unique']:
+            cursor.execute(
+                f'ALTER TABLE {qn(name)} '
+                f'RENAME CONSTRAINT {qn(shadow_constraint)} TO {qn(constraint)}'
+            )
+        else:
+            cursor.execute(
+                f'ALTER INDEX {qn(shadow_constraint)} RENAME TO {qn(constraint)}'
+            )
+
+    for constraint, info in foreign_keys:
+        ref_table, ref_column = info['foreign_key']
+        cursor.execute(
+            f'ALTER TABLE {qn(name)} ADD CONSTRAINT {qn(constraint)} '
+            f'FOREIGN KEY ({qn(info["columns"][0])}) '
+            f'REFERENCES {qn(ref_table)} ({qn(ref_column)}) '
+            f'DEFERRABLE INITIALLY DEFERRED NOT VALID'
+        )
+    return [constraint for constraint, _ in foreign_keys]
+
+
+def _find_same(info: dict, shadow_constraints: dict):
+    """Ищет в теневой таблице индекс/ограничение, аналогичное исходному."""
+    for name, shadow_info in shadow_constraints.items():
+        if (
+            shadow_info['columns'] == info['columns']
+            and shadow_info['primary_key'] == info['primary_key']
+            and shadow_info['unique'] == info['unique']
+            and shadow_info['index'] == info['index']
+            and not shadow_info['foreign_key']
+        ):
+            return name
+    return None
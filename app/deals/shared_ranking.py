@@ -0,0 +1,327 @@
+"""
+Общий для воркеров файл рейтинга покупателей.
+
+Полный рейтинг публикуется компактным бинарным файлом
+(по умолчанию в /dev/shm): id покупателей и суммы
+в копейках в порядке рейтинга, таблица имен покупателей и камней
+и битовые карты камней каждого покупателя. Воркеры отображают файл
+в память только для чтения (mmap) и отвечают на /api/top-customers/
+с любым лимитом прямо из него, без копирования данных: страницы файла
+общие для всех процессов, поэтому память не растет с числом воркеров.
+
+Файл помечен поколением строк сделок (generation.rows) и подменяется
+атомарно: новый файл пишется рядом и переименовывается поверх старого.
+Воркер, у которого уже открыт прежний файл, дочитывает его, а при смене
+поколения открывает новый. Файл не строится при записи данных: после
+смены поколения первый запрос топа запускает его перестройку в фоновом
+потоке (одну на все процессы), а сам, как и остальные запросы до
+публикации, читает рейтинг из базы. Так несколько изменений подряд
+дают одну перестройку, запись данных не сканирует все сделки,
+а запрос не ждет построения файла.
+
+Порядок байтов и выравнивание - как на хосте: файл не переносится
+между машинами. Включается настройкой DEALS_SHARED_RANKING.
+"""
+import fcntl
+import mmap
+import os
+import struct
+import threading
+from array import array
+from typing import Dict, Iterator, List, Optional
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.db.models import Sum
+
+from app.deals import generation
+from app.deals.models import Customer, Deal, Gem
+
+magic = b'SBRK'
+version = 1
+
+# размер пачки строк при чтении рейтинга и пар покупатель + камень
+read_batch_size = 10_000
+
+# заголовок: сигнатура, версия формата, поколение строк сделок,
+# число покупателей и камней, байт битовой карты на покупателя
+# и смещения секций (id, суммы, смещения имен покупателей, смещения
+# названий камней, битовые карты, имена покупателей, названия камней)
+_header = struct.Struct('=4sIqQQQ7Q')
+
+
+def _bits(value: int) -> Iterator[int]:
+    """Номера установленных битов по возрастанию."""
+    while value:
+        low = value & -value
+        yield low.bit_length() - 1
+        value ^= low
+
+
+class RankingFile:
+    """Опубликованный файл рейтинга, отображенный в память."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # по inode понятно, подменен ли файл с момента открытия
+        self.inode = (stat.st_dev, stat.st_ino)
+
+        view = memoryview(self._mmap)
+        if len(view) < _header.size:
+            raise ValueError('Файл рейтинга обрезан.')
+        (file_magic, file_version, self.rows_generation, self.size, gems_count,
+         self.bitmap_bytes, *offsets) = _header.unpack_from(view)
+        if file_magic != magic or file_version != version:
+            raise ValueError('Неизвестный формат файла рейтинга.')
+
+        ids, cents, name_offsets, gem_name_offsets, bitmaps, names, gem_names = offsets
+        self.ids = view[ids:cents].cast('q')
+        self.cents = view[cents:name_offsets].cast('q')
+        self._name_offsets = view[name_offsets:gem_name_offsets].cast('Q')
+        gem_name_offsets = view[gem_name_offsets:bitmaps].cast('Q')
+        self._bitmaps = view[bitmaps:names]
+        self._names = view[names:gem_names]
+        # названия камней нужны целиком и их немного
+        self.gem_names = [
+            str(view[gem_names + gem_name_offsets[i]:gem_names + gem_name_offsets[i + 1]], 'utf-8')
+            for i in range(gems_count)
+        ]
+
+    def username(self, position: int) -> str:
+        """Имя покупателя на месте position рейтинга."""
+        return str(
+            self._names[self._name_offsets[position]:self._name_offsets[position + 1]], 'utf-8'
+        )
+
+    def ranking(self, limit: int) -> List[tuple]:
+        """
+        Первые limit строк рейтинга (id, имя, сумма в копейках),
+        как payloads.ranking.
+        """
+        limit = max(0, min(limit, self.size))
+        return list(zip(
+            self.ids[:limit].tolist(),
+            [self.username(position) for position in range(limit)],
+            self.cents[:limit].tolist(),
+        ))
+
+    def shared_gems(self, count: int) -> Dict[int, List[str]]:
+        """
+        Камни, которые есть как минимум у двух из первых count покупателей
+        рейтинга, по id покупателей (в порядке id камней), как payloads.shared_gems.
+        """
+        size = self.bitmap_bytes
+        bitmaps = [
+            int.from_bytes(self._bitmaps[position * size:(position + 1) * size], 'little')
+            for position in range(max(0, min(count, self.size)))
+        ]
+        seen = shared = 0
+        for bitmap in bitmaps:
+            shared |= seen & bitmap
+            seen |= bitmap
+
+        result = {}
+        for position, bitmap in enumerate(bitmaps):
+            if bitmap & shared:
+                result[self.ids[position]] = [
+                    self.gem_names[index] for index in _bits(bitmap & shared)
+                ]
+        return result
+
+
+def _read_generation(path: str) -> Optional[int]:
+    """Поколение опубликованного файла (None - файла нет или он поврежден)."""
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(_header.size)
+    except FileNotFoundError:
+        return None
+    if len(header) < _header.size:
+        return None
+    file_magic, file_version, rows_generation, *_ = _header.unpack(header)
+    if file_magic != magic or file_version != version:
+        return None
+    return rows_generation
+
+
+def write(f, rows_generation: int, using: str = DEFAULT_DB_ALIAS) -> None:
+    """Строит рейтинг по базе и записывает файл в открытый двоичный поток f."""
+    # сделки читаются раньше справочников: покупатель и камень каждой
+    # прочитанной пары уже зафиксированы в базе; изменения, пришедшие
+    # во время чтения, сменят поколение, и файл будет перестроен
+    customer_gems: Dict[int, List[int]] = {}
+    pairs = (
+        Deal.objects.using(using).order_by()
+        .values_list('customer_id', 'item_id').distinct()
+        .iterator(chunk_size=read_batch_size)
+    )
+    for customer_id, item_id in pairs:
+        customer_gems.setdefault(customer_id, []).append(item_id)
+
+    gems = list(Gem.objects.using(using).order_by('id').values_list('id', 'name'))
+    gem_index = {gem_id: index for index, (gem_id, _) in enumerate(gems)}
+    bitmap_bytes = (len(gems) + 7) // 8
+
+    # тот же порядок, что у TopCustomersView: по убыванию суммы, затем по id
+    ranking = (
+        Customer.objects.using(using)
+        .annotate(spent_money=Sum('deals__total_cost_cents', default=0))
+        .order_by('-spent_money', 'id')
+        .values_list('id', 'username', 'spent_money')
+        .iterator(chunk_size=read_batch_size)
+    )
+    ids, cents = array('q'), array('q')
+    name_offsets, names = array('Q', [0]), bytearray()
+    bitmaps = bytearray()
+    for customer_id, username, spent_money in ranking:
+        ids.append(customer_id)
+        cents.append(spent_money)
+        names += username.encode('utf-8')
+        name_offsets.append(len(names))
+        bitmap = 0
+        for item_id in customer_gems.get(customer_id, ()):
+            # камень мог быть удален после чтения пар
+            if item_id in gem_index:
+                bitmap |= 1 << gem_index[item_id]
+        bitmaps += bitmap.to_bytes(bitmap_bytes, 'little')
+
+    gem_name_offsets, gem_names = array('Q', [0]), bytearray()
+    for _, name in gems:
+        gem_names += name.encode('utf-8')
+        gem_name_offsets.append(len(gem_names))
+
+    # целочисленные секции идут первыми: их смещения кратны 8
+    sections = [ids, cents, name_offsets, gem_name_offsets, bitmaps, names, gem_names]
+    offsets, offset = [], _header.size
+    for section in sections:
+        offsets.append(offset)
+        offset += len(section) * getattr(section, 'itemsize', 1)
+
+    f.write(_header.pack(
+        magic, version, rows_generation, len(ids), len(gems), bitmap_bytes, *offsets
+    ))
+    for section in sections:
+        f.write(section)
+
+
+def publish(path: Optional[str] = None,
+            wait: bool = True,
+            using: str = DEFAULT_DB_ALIAS) -> bool:
+    """
+    Публикует рейтинг текущего поколения, если опубликованный файл старше.
+    Файл строит один процесс за раз; при wait=False занятость блокировки
+    означает, что файл уже строится, и функция сразу возвращает False.
+    """
+    path = path or settings.DEALS_SHARED_RANKING_PATH
+    with open(f'{path}.lock', 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+        except BlockingIOError:
+            return False
+
+        rows_generation = generation.get(generation.rows)
+        published = _read_generation(path)
+        if published is not None and published >= rows_generation:
+            return True
+
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                write(f, rows_generation, using)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    return True
+
+
+def rebuild(path: str) -> None:
+    """
+    Перестраивает файл, если его не строит другой процесс. Ошибка
+    не пробрасывается: без файла рейтинг читается из базы, а перестроить
+    его попробует следующий запрос.
+    """
+    try:
+        publish(path, wait=False)
+    except (DatabaseError, OSError):
+        pass
+
+
+class SharedRanking:
+    """Открытый процессом файл рейтинга с подменой по поколению."""
+
+    def __init__(self):
+        self._file: Optional[RankingFile] = None
+        self._lock = threading.Lock()
+        self._builder: Optional[threading.Thread] = None
+
+    def get(self, path: str) -> Optional[RankingFile]:
+        """
+        Файл рейтинга не старше текущего поколения строк сделок
+        или None, если актуального файла пока нет (тогда запускается
+        его перестройка в фоне).
+        """
+        rows_generation = generation.get(generation.rows)
+        ranking_file = self._file
+        if ranking_file is not None and ranking_file.path == path \
+                and ranking_file.rows_generation >= rows_generation:
+            return ranking_file
+
+        # файл открывает один поток процесса, остальные тем временем
+        # читают из базы
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            ranking_file = self._open(path)
+            if ranking_file is None or ranking_file.rows_generation < rows_generation:
+                self._start_build(path)
+                return None
+            # прежнее отображение освобождается, когда его дочитают
+            self._file = ranking_file
+            return ranking_file
+        finally:
+            self._lock.release()
+
+    def _start_build(self, path: str) -> None:
+        """Запускает перестройку файла в фоновом потоке, если она еще не идет."""
+        if self._builder is not None and self._builder.is_alive():
+            return
+        self._builder = threading.Thread(
+            target=self._build, args=(path, ), name='shared-ranking', daemon=True,
+        )
+        self._builder.start()
+
+    @staticmethod
+    def _build(path: str) -> None:
+        try:
+            rebuild(path)
+        finally:
+            # соединения с базой у потока свои
+            connections.close_all()
+
+    def _open(self, path: str) -> Optional[RankingFile]:
+        current = self._file
+        try:
+            stat = os.stat(path)
+            if current is not None and current.path == path \
+                    and current.inode == (stat.st_dev, stat.st_ino):
+                return current
+            return RankingFile(path)
+        except (FileNotFoundError, ValueError):
+            return None
+
+
+_shared = SharedRanking()
+
+
+def is_enabled() -> bool:
+    return bool(settings.DEALS_SHARED_RANKING)
+
+
+def get() -> Optional[RankingFile]:
+    """Актуальный файл рейтинга или None, если он выключен или не готов."""
+    return _shared.get(settings.DEALS_SHARED_RANKING_PATH) if is_enabled() else None
@@ -0,0 +1,136 @@
+from django.db.models.signals import (post_delete, post_migrate, post_save,
+                                      pre_delete, pre_save)
+from django.dispatch import receiver
+
+from app.deals import columnar, generation, routers, stats
+from app.deals.api import invalidation
+from app.deals.changes import Changes, changed, committed, is_tracked
+from app.deals.models import Customer, Deal, Gem
+
+
+@receiver(post_save, sender=Customer)
+def customer_saved(instance, created, using, **kwargs):
+    if is_tracked():
+        # новый покупатель попадает в топ с нулевой суммой,
+        # сохранение существующего может его переименовать
+        changed(names=not created, using=using)
+
+
+@receiver(post_save, sender=Gem)
+def gem_saved(instance, created, using, **kwargs):
+    if not is_tracked():
+        return
+    if created:
+        # камень без сделок ни на что не влияет
+        changed(spend_deltas={}, using=using)
+    else:
+        changed(names=True, using=using)
+
+
+@receiver(pre_save, sender=Deal)
+def deal_saving(instance, using, **kwargs):
+    """Запоминает прежние значения сделки, чтобы учесть их изменение."""
+    instance._saved_values = None
+    if is_tracked() and not instance._state.adding:
+        instance._saved_values = (
+            Deal.objects.using(using).filter(pk=instance.pk)
+            .values_list('customer_id', 'item_id', 'total_cost_cents')
+            .first()
+        )
+
+
+@receiver(post_save, sender=Deal)
+def deal_saved(instance, using, **kwargs):
+    if not is_tracked():
+        return
+    spend_deltas = {instance.customer_id: instance.total_cost_cents}
+    gem_ids = {instance.item_id}
+    saved_values = getattr(instance, '_saved_values', None)
+    if saved_values is not None:
+        customer_id, item_id, total_cost_cents = saved_values
+        spend_deltas[customer_id] = spend_deltas.get(customer_id, 0) - total_cost_cents
+        gem_ids.add(item_id)
+    changed(spend_deltas=spend_deltas, gem_ids=gem_ids, using=using)
+
+
+@receiver(pre_delete, sender=Customer)
+def customer_deleting(instance, using, **kwargs):
+    """Запоминает камни сделок покупателя: сделки удаляются вместе с ним."""
+    if is_tracked():
+        instance._deal_gem_ids = set(
+            instance.deals.using(using).values_list('item_id', flat=True).distinct()
+        )
+
+
+@receiver(post_delete, sender=Customer)
+def customer_deleted(instance, using, **kwargs):
+    if is_tracked():
+        changed(
+            gem_ids=getattr(instance, '_deal_gem_ids', None),
+            names=True,
+            using=using,
+        )
+
+
+@receiver(post_delete, sender=Gem)
+def gem_deleted(instance, using, **kwargs):
+    if is_tracked():
+        # статистика камня удаляется вместе с ним
+        changed(names=True, using=using)
+
+
+@receiver(committed, sender=Changes)
+def data_committed(changes: Changes, **kwargs):
+    """
+    Одна инвалидация на транзакцию, изменившую данные,
+    сколько бы строк в ней ни изменилось.
+
+    Кеши сбрасываются и поколения меняются первыми, отдельно от пересчета
+    статистики камней (refresh_gem_stats): сигнал отправляется через
+    send_robust, поэтому ошибка одного получателя не отменяет другие.
+    """
+    # реплики могут отставать: пока они не догонят основную базу,
+    # заполнять очищенный кеш нужно данными из основной базы
+    routers.pin_primary()
+
+    if changes.names:
+        # кеши имя -> id устаревают при удалении и переименовании
+        generation.bump(generation.names)
+
+    # кеш страниц топа сбрасывается, только если изменения могли его изменить;
+    # поколение строк меняется после сброса: иначе закешированная страница
+    # успела бы получить новый ETag
+    invalidation.invalidate_top_customers(changes.spend_deltas)
+    # поколение строк меняется при каждом изменении: по нему строятся ETag
+    # топа, общий файл рейтинга и снимок колоночного движка;
+    # общий файл здесь не строится: его перестройку в фоне запускает
+    # первый запрос топа после смены поколения (см. shared_ranking.py)
+    rows_generation = generation.bump(generation.rows)
+    # статистику камней загрузка обновляет в своей транзакции
+    generation.bump(generation.stats)
+    columnar.record_changes(
+        rows_generation,
+        None if changes.spend_deltas is None else changes.spend_deltas.keys(),
+    )
+
+
+@receiver(committed, sender=Changes)
+def refresh_gem_stats(changes: Changes, **kwargs):
+    """Пересчитывает статистику камней, измененных в обход загрузки."""
+    if changes.gem_ids is None or changes.gem_ids:
+        stats.refresh(changes.gem_ids)
+        # ответы, закешированные во время пересчета, построены по старой статистике
+        generation.bump(generation.stats)
+
+
+@receiver(post_migrate)
+def tables_migrated(sender, **kwargs):
+    """Миграции и flush могут менять содержимое справочников."""
+    if sender.name != 'app.deals':
+        return
+    try:
+        generation.bump(generation.names)
+    except Exception:
+        # при запуске контейнера redis может быть еще недоступен,
+        # это не должно мешать миграциям
+        pass
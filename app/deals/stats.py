@@ -0,0 +1,153 @@
+"""
+Поддержка сводной статистики по камням (GemStats).
+
+При загрузке в режиме append статистика обновляется приращениями:
+сумма, количество и число сделок - по созданным и перезаписанным
+сделкам (перезапись вычитает прежние значения старого камня),
+число покупателей - по появившимся и исчезнувшим парам
+покупатель + камень у затронутых покупателей.
+При полной замене сделок статистика пересчитывается целиком
+(на PostgreSQL - по теневой таблице сделок до подмены, см. shadow.py),
+а при изменениях в обход загрузки (админка, скрипты) - по затронутым
+камням (refresh, см. app/deals/changes.py).
+"""
+from dataclasses import dataclass
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from django.db import transaction
+from django.db.models import Count, F, Sum
+
+from app.deals.models import Deal, Gem, GemStats
+
+# размер пачки покупателей в запросах пар покупатель + камень
+# и камней при пересчете статистики
+batch_size = 500
+
+stats_fields = ('revenue_cents', 'quantity', 'deals_count', 'customers_count')
+
+
+@dataclass
+class GemDelta:
+    """Приращение статистики камня."""
+    revenue_cents: int = 0
+    quantity: int = 0
+    deals_count: int = 0
+    customers_count: int = 0
+
+    def add(self, total_cost_cents: int, quantity: int, sign: int = 1) -> None:
+        """Учитывает появление (sign=1) или исчезновение (sign=-1) сделки."""
+        self.revenue_cents += sign * total_cost_cents
+        self.quantity += sign * quantity
+        self.deals_count += sign
+
+    def __bool__(self):
+        return any((self.revenue_cents, self.quantity, self.deals_count, self.customers_count))
+
+
+def customer_gems(customer_ids: Iterable[int], gem_ids: Iterable[int]) -> Set[Tuple[int, int]]:
+    """Пары (покупатель, камень), по которым есть сделки."""
+    customer_ids, gem_ids = sorted(customer_ids), list(gem_ids)
+    pairs = set()
+    for i in range(0, len(customer_ids), batch_size):
+        pairs.update(
+            Deal.objects.filter(
+                customer_id__in=customer_ids[i:i + batch_size],
+                item_id__in=gem_ids,
+            )
+            .values_list('customer_id', 'item_id')
+            .distinct()
+        )
+    return pairs
+
+
+def count_customers(deltas: Dict[int, GemDelta],
+                    before: Set[Tuple[int, int]],
+                    after: Set[Tuple[int, int]]) -> None:
+    """Учитывает в приращениях появившиеся и исчезнувшие пары покупатель + камень."""
+    for _, gem_id in after - before:
+        deltas[gem_id].customers_count += 1
+    for _, gem_id in before - after:
+        deltas[gem_id].customers_count -= 1
+
+
+def apply(deltas: Dict[int, GemDelta]) -> None:
+    """
+    Применяет приращения к статистике. Строки обновляются в порядке id
+    камня, поэтому параллельные загрузки не блокируют друг друга взаимно.
+    """
+    deltas = {gem_id: delta for gem_id, delta in deltas.items() if delta}
+    if not deltas:
+        return
+
+    GemStats.objects.bulk_create(
+        [GemStats(gem_id=gem_id) for gem_id in sorted(deltas)],
+        ignore_conflicts=True,
+    )
+    for gem_id in sorted(deltas):
+        delta = deltas[gem_id]
+        GemStats.objects.filter(gem_id=gem_id).update(
+            revenue_cents=F('revenue_cents') + delta.revenue_cents,
+            quantity=F('quantity') + delta.quantity,
+            deals_count=F('deals_count') + delta.deals_count,
+            customers_count=F('customers_count') + delta.customers_count,
+        )
+
+
+def rebuild() -> None:
+    """Пересчитывает статистику по всем сделкам."""
+    GemStats.objects.all().delete()
+    GemStats.objects.bulk_create(
+        (
+            GemStats(gem_id=row['item_id'], **{field: row[field] for field in stats_fields})
+            for row in aggregate()
+        ),
+        batch_size=batch_size,
+    )
+
+
+def refresh(gem_ids: Optional[Iterable[int]] = None) -> None:
+    """
+    Пересчитывает по сделкам статистику переданных камней (None - всех).
+    Строки статистики блокируются в порядке id камня, как в apply:
+    параллельная загрузка либо уже зафиксирована и видна пересчету,
+    либо применит свои приращения поверх него.
+    """
+    if gem_ids is None:
+        gem_ids = Gem.objects.values_list('id', flat=True)
+    gem_ids = sorted(gem_ids)
+
+    with transaction.atomic():
+        for i in range(0, len(gem_ids), batch_size):
+            # камни могли быть удалены вместе со статистикой
+            chunk = list(
+                Gem.objects.filter(id__in=gem_ids[i:i + batch_size])
+                .order_by('id').values_list('id', flat=True)
+            )
+            GemStats.objects.bulk_create(
+                [GemStats(gem_id=gem_id) for gem_id in chunk],
+                ignore_conflicts=True,
+            )
+            rows = list(
+                GemStats.objects.select_for_update()
+                .filter(gem_id__in=chunk).order_by('gem_id')
+            )
+            totals = {row['item_id']: row for row in aggregate().filter(item_id__in=chunk)}
+            for row in rows:
+                total = totals.get(row.gem_id, {})
+                for field in stats_fields:
+                    setattr(row, field, total.get(field, 0))
+            GemStats.objects.bulk_update(rows, stats_fields)
+
+
+def aggregate():
+    """Статистика по камням, посчитанная по таблице сделок."""
+    return (
+        Deal.objects.values('item_id')
+        .annotate(
+            revenue_cents=Sum('total_cost_cents'),
+            quantity=Sum('quantity'),
+            deals_count=Count('id'),
+            customers_count=Count('customer_id', distinct=True),
+        )
+        .order_by('item_id')
+    )
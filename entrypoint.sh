@@ -11,8 +11,13 @@ then
     echo "PostgreSQL started"
 fi
 
-python manage.py makemigrations
-python manage.py migrate
-python manage.py collectstatic --noinput
+# STARTUP_MODE=full - выполнить все шаги подготовки заново,
+# иначе миграции и статика пропускаются, если они не устарели
+if [ "$STARTUP_MODE" = "full" ]
+then
+    python manage.py startup --force
+else
+    python manage.py startup
+fi
 
 exec "$@"
\ No newline at end of file
@@ -0,0 +1,55 @@
+"""
+Профиль gunicorn для запуска сервиса.
+
+Воркеры gthread: каждый процесс обслуживает несколько запросов
+одновременно в потоках, пока другие потоки ждут базу или redis,
+поэтому процессов по умолчанию столько же, сколько CPU (а не
+2 * CPU + 1, как для синхронных воркеров). Количество процессов
+и потоков переопределяется переменными окружения GUNICORN_*.
+
+Каждый поток держит постоянное соединение с базой (CONN_MAX_AGE),
+поэтому сервис открывает до workers * threads соединений -
+это число должно помещаться в max_connections PostgreSQL. Оно
+ограничено GUNICORN_MAX_DB_CONNECTIONS: при превышении сокращается
+число процессов, а если и одного процесса много - потоков.
+При DEALS_COLUMNAR_ENGINE=1 снимок сделок хранится в каждом процессе.
+"""
+import multiprocessing
+import os
+
+
+def _env_int(name: str, default: int) -> int:
+    # пустое значение в .env означает значение по умолчанию
+    return int(os.getenv(name) or default)
+
+
+cpu_count = multiprocessing.cpu_count()
+
+bind = os.getenv('GUNICORN_BIND') or '0.0.0.0:8000'
+
+worker_class = 'gthread'
+workers = _env_int('GUNICORN_WORKERS', cpu_count)
+threads = _env_int('GUNICORN_THREADS', 4)
+
+# по умолчанию max_connections PostgreSQL - 100; остаток оставлен
+# для миграций, команд manage.py и фоновых потоков воркеров
+max_db_connections = _env_int('GUNICORN_MAX_DB_CONNECTIONS', 80)
+if workers * threads > max_db_connections:
+    workers = max(1, max_db_connections // threads)
+    threads = max(1, min(threads, max_db_connections // workers))
+
+# загрузка большого файла в режиме replace может идти долго
+timeout = _env_int('GUNICORN_TIMEOUT', 120)
+graceful_timeout = _env_int('GUNICORN_GRACEFUL_TIMEOUT', 30)
+keepalive = _env_int('GUNICORN_KEEPALIVE', 5)
+
+# перезапуск воркера после N запросов ограничивает рост памяти,
+# но сбрасывает его локальные кеши (0 - не перезапускать)
+max_requests = _env_int('GUNICORN_MAX_REQUESTS', 0)
+max_requests_jitter = _env_int('GUNICORN_MAX_REQUESTS_JITTER', 0)
+
+# heartbeat воркеров в памяти, а не на overlayfs контейнера
+worker_tmp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+accesslog = os.getenv('GUNICORN_ACCESS_LOG') or None
+errorlog = '-'
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 import os
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -92,9 +93,56 @@ DATABASES = {
         'PASSWORD': os.environ.get('DB_PASSWORD', 'postgresql'),
         'HOST': os.environ.get('DB_HOST', 'db'),
         'PORT': os.environ.get('DB_PORT', '5432'),
+        # постоянные соединения: каждый поток воркера gunicorn держит
+        # свое соединение и переиспользует его между запросами
+        # (0 - закрывать соединение в конце каждого запроса).
+        # Перед повторным использованием соединение проверяется.
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', 600)),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'connect_timeout': int(os.getenv('DB_CONNECT_TIMEOUT', 5)),
+        },
     }
 }
 
+# Реплики только для чтения (хосты через пробел). На них уходят запросы
+# чтения списка топовых покупателей, см. app/deals/routers.py
+DATABASE_REPLICAS = []
+for i, host in enumerate(os.environ.get('DB_REPLICA_HOSTS', '').split()):
+    DATABASES[f'replica_{i}'] = {**DATABASES['default'], 'HOST': host}
+    DATABASE_REPLICAS.append(f'replica_{i}')
+
+# Сколько секунд после загрузки сделок читать только из основной базы
+# (должно превышать отставание реплик)
+DATABASE_REPLICA_PIN_SECONDS = int(os.getenv('DB_REPLICA_PIN_SECONDS', 10))
+
+DATABASE_ROUTERS = ['app.deals.routers.ReplicaRouter']
+
+# Колоночный движок топа покупателей в памяти каждого воркера (нужен numpy),
+# см. app/deals/columnar.py
+DEALS_COLUMNAR_ENGINE = int(os.getenv('DEALS_COLUMNAR_ENGINE', 0))
+
+# Через сколько секунд без обновления контрольная точка поэтапной загрузки
+# считается брошенной и удаляется командой clean_checkpoints
+DEALS_CHECKPOINT_MAX_AGE = int(os.getenv('DEALS_CHECKPOINT_MAX_AGE', 7 * 24 * 60 * 60))
+
+# Общий для воркеров файл рейтинга покупателей, отображаемый в память,
+# см. app/deals/shared_ranking.py. Файл должен быть общим для воркеров
+# одного хоста: по умолчанию он лежит в /dev/shm (память, а не диск).
+DEALS_SHARED_RANKING = int(os.getenv('DEALS_SHARED_RANKING', 0))
+DEALS_SHARED_RANKING_PATH = os.getenv('DEALS_SHARED_RANKING_PATH') or os.path.join(
+    '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+    'sibdev_job-ranking.bin',
+)
+
+# Для тестов реплика - это второй алиас той же базы. По умолчанию
+# чтение на нее не направляется, тесты роутера включают ее сами.
+if TESTING:
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'TEST': {'MIRROR': 'default'},
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -116,9 +164,20 @@ AUTH_PASSWORD_VALIDATORS = [
 CACHES = {
     'default': {
         'BACKEND': 'django_redis.cache.RedisCache',
-        'LOCATION': 'redis://redis:6379/',
+        'LOCATION': REDIS_URL,
         'OPTIONS': {
-            'CLIENT_CLASS': 'django_redis.client.DefaultClient'
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            'SOCKET_CONNECT_TIMEOUT': float(os.getenv('REDIS_CONNECT_TIMEOUT', 1)),
+            'SOCKET_TIMEOUT': float(os.getenv('REDIS_TIMEOUT', 2)),
+            # пул соединений общий для потоков воркера; если все соединения
+            # заняты, поток ждет освободившееся не дольше REDIS_POOL_TIMEOUT
+            'CONNECTION_POOL_CLASS': 'redis.BlockingConnectionPool',
+            'CONNECTION_POOL_KWARGS': {
+                'max_connections': int(os.getenv('REDIS_MAX_CONNECTIONS', 32)),
+                'timeout': float(os.getenv('REDIS_POOL_TIMEOUT', 2)),
+                # простаивавшее соединение проверяется перед использованием
+                'health_check_interval': 30,
+            },
         },
     }
 }